@@ -3,6 +3,7 @@ import logging
 import os
 from csv import DictWriter
 
+from data.avc.media_index import get_media_index_path, write_media_index
 from data.avc.subsets import get_subset_split
 from log import init_console_logger
 
@@ -12,15 +13,21 @@ LOGGER.setLevel(logging.DEBUG)
 
 def write_subset_file(path, subset_list):
     with open(path, 'w') as f:
-        field_names = list(subset_list[0].keys())
+        # Media properties are written to a separate media index
+        field_names = [key for key in subset_list[0].keys() if key != 'media_info']
         writer = DictWriter(f, field_names)
         writer.writeheader()
 
         for item in subset_list:
             item = dict(item)
+            item.pop('media_info', None)
             item['labels'] = ';'.join(item['labels'])
             writer.writerow(item)
 
+    if 'media_info' in subset_list[0]:
+        write_media_index(get_media_index_path(path),
+                          [item['media_info'] for item in subset_list])
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Creates CSVs containing a train-valid-test split for the given dataset')
@@ -72,6 +79,29 @@ def parse_arguments():
                         help='Path to filter csv file(s).')
 
 
+    parser.add_argument('-pm',
+                        '--probe-media',
+                        dest='probe_media',
+                        action='store_true',
+                        default=False,
+                        help='If True, probe the media of each file and write a media index next to each subset file, dropping broken or short files')
+
+    parser.add_argument('-nw',
+                        '--num-workers',
+                        dest='num_workers',
+                        action='store',
+                        type=int,
+                        default=8,
+                        help='Number of processes used to probe media')
+
+    parser.add_argument('-md',
+                        '--min-duration',
+                        dest='min_duration',
+                        action='store',
+                        type=float,
+                        default=1.0,
+                        help='Minimum duration (seconds) of probed video and audio')
+
     parser.add_argument('-r',
                         '--random-state',
                         dest='random_state',
@@ -110,7 +140,10 @@ if __name__ == '__main__':
                            random_state=args.random_state,
                            metadata_path=args.metadata_path,
                            filter_path=args.filter_path,
-                           ontology_path=args.ontology_path)
+                           ontology_path=args.ontology_path,
+                           probe_media=args.probe_media,
+                           num_workers=args.num_workers,
+                           min_duration=args.min_duration)
 
     output_dir = args.output_dir
     filename_prefix = args.filename_prefix
@@ -1,13 +1,19 @@
 import argparse
 import logging
 import math
+import multiprocessing
+import os
+import time
 from functools import partial
 
-import multiprocessing_logging
-
+from data.avc.bad_media import BadMediaRegistry, get_bad_media_path
+from data.avc.media_pool import SharedMediaPool
+from data.avc.partition import get_audio_pool_path, write_audio_pool
 from data.avc.sample import sample_and_save
+from data.avc.shards import COMPRESSION_TYPES, write_manifest
 from data.utils import map_iterate_in_parallel
-from log import init_console_logger
+from log import init_console_logger, init_queue_logging, init_queue_worker, \
+    merge_traces, LogTimer, METRICS, TRACER
 
 LOGGER = logging.getLogger('sampling')
 LOGGER.setLevel(logging.DEBUG)
@@ -46,6 +52,20 @@ if __name__ == '__main__':
                         default=False,
                         help='If True, performs data augmentation on audio and images')
 
+    parser.add_argument('-ba',
+                        '--batch-augment',
+                        dest='batch_augment',
+                        action='store_true',
+                        default=False,
+                        help='If True, video augmentation is applied to whole batches at once instead of to each sample')
+
+    parser.add_argument('-ibn',
+                        '--in-batch-negatives',
+                        dest='in_batch_negatives',
+                        action='store_true',
+                        default=False,
+                        help='If True, each streamer decodes a single clip, and negative samples are made by exchanging audio between clips within each batch')
+
     parser.add_argument('-pc',
                         '--precompute',
                         dest='precompute',
@@ -74,6 +94,136 @@ if __name__ == '__main__':
                         type=int,
                         help='Maximum number of videos to use for generating examples. If not specified, all videos will be used')
 
+    parser.add_argument('-fcd',
+                        '--frame-cache-dir',
+                        dest='frame_cache_dir',
+                        action='store',
+                        type=str,
+                        help='Path to directory where decoded video frames are cached. If not specified, frames are not cached')
+
+    parser.add_argument('-fcs',
+                        '--frame-cache-size',
+                        dest='frame_cache_size',
+                        action='store',
+                        type=float,
+                        help='Maximum size of the decoded video frame cache in GB. If not specified, the cache is not size limited')
+
+    parser.add_argument('-sv',
+                        '--sparse-video',
+                        dest='sparse_video',
+                        action='store_true',
+                        default=False,
+                        help='If True, only decode sampled video frames by seeking to them, instead of decoding whole videos. The frame cache is not used in this mode')
+
+    parser.add_argument('-df',
+                        '--decode-fps',
+                        dest='decode_fps',
+                        action='store',
+                        type=int,
+                        help='If provided, decode videos at this frame rate instead of their native frame rate. Sampled frame indices are still reported at the native frame rate')
+
+    parser.add_argument('-mps',
+                        '--media-pool-size',
+                        dest='media_pool_size',
+                        action='store',
+                        type=float,
+                        help='Size in GB of a pool of decoded media shared by all workers. If not specified, each worker decodes media into its own memory')
+
+    parser.add_argument('-ss',
+                        '--shard-size',
+                        dest='shard_size',
+                        action='store',
+                        type=int,
+                        help='Number of samples per HDF5 shard file. If not specified, each batch is written to its own file')
+
+    parser.add_argument('-cs',
+                        '--chunk-size',
+                        dest='chunk_size',
+                        action='store',
+                        type=int,
+                        help='Number of samples per HDF5 chunk in shard files. Should match the training batch size. By default, the batch size is used')
+
+    parser.add_argument('-c',
+                        '--compression',
+                        dest='compression',
+                        action='store',
+                        type=str,
+                        default='gzip',
+                        choices=COMPRESSION_TYPES,
+                        help='HDF5 compression filter. blosc and zstd require hdf5plugin')
+
+    parser.add_argument('-wm',
+                        '--write-manifest',
+                        dest='write_manifest',
+                        action='store_true',
+                        help='Write a manifest of the sample files in the output directory when done, so training can resume without scanning the files. Only use this if no other job is writing to the output directory; otherwise run "python -m data.avc.shards OUTPUT_DIR" once all jobs are done')
+
+    parser.add_argument('-acd',
+                        '--audio-corpus-dir',
+                        dest='audio_corpus_dir',
+                        action='store',
+                        type=str,
+                        help='Path to packed audio corpus built with data.avc.audio_corpus. If provided, audio is read from the corpus instead of decoding audio files')
+
+    parser.add_argument('-wa',
+                        '--windowed-audio',
+                        dest='windowed_audio',
+                        action='store_true',
+                        default=False,
+                        help='If True, only read the sampled one second windows of audio by seeking instead of decoding whole audio files')
+
+    parser.add_argument('-nmi',
+                        '--no-media-index',
+                        dest='use_media_index',
+                        action='store_false',
+                        default=True,
+                        help='If provided, ignore the media index next to the subset file and probe videos when they are read')
+
+    parser.add_argument('-bmp',
+                        '--bad-media-path',
+                        dest='bad_media_path',
+                        action='store',
+                        type=str,
+                        help='Path to registry of media files that could not be decoded, shared between workers and runs. By default, "bad_media.tsv" in the output directory is used')
+
+    parser.add_argument('-np',
+                        '--num-partitions',
+                        dest='num_partitions',
+                        action='store',
+                        type=int,
+                        help='Number of tasks that split the videos of the subset into hash partitions. Each task only decodes videos in its own partition')
+
+    parser.add_argument('-pi',
+                        '--partition-index',
+                        dest='partition_index',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='Index of the partition owned by this task')
+
+    parser.add_argument('-apd',
+                        '--audio-pool-dir',
+                        dest='audio_pool_dir',
+                        action='store',
+                        type=str,
+                        help='Directory, shared between partitioned tasks, where audio for cross-partition negative samples is exchanged')
+
+    parser.add_argument('-aps',
+                        '--audio-pool-size',
+                        dest='audio_pool_size',
+                        action='store',
+                        type=int,
+                        default=2048,
+                        help='Total number of one second audio windows in the exchanged audio pool, split between the partitions')
+
+    parser.add_argument('-apt',
+                        '--audio-pool-timeout',
+                        dest='audio_pool_timeout',
+                        action='store',
+                        type=float,
+                        default=3600,
+                        help='Number of seconds to wait for the other partitions to write their audio pools. Partitions whose pools are not written by then are not used for negative samples. To avoid waiting, write all of the pools beforehand with "python -m data.avc.partition"')
+
     parser.add_argument('-r',
                         '--random-state',
                         dest='random_state',
@@ -90,6 +240,20 @@ if __name__ == '__main__':
                         default=4,
                         help='Number of multiprocessing workers used to download videos')
 
+    parser.add_argument('-tm',
+                        '--timing-metrics',
+                        dest='timing_metrics',
+                        action='store_true',
+                        default=False,
+                        help='If True, record the time spent in each stage of sample generation and log a breakdown at the end')
+
+    parser.add_argument('-td',
+                        '--trace-dir',
+                        dest='trace_dir',
+                        action='store',
+                        type=str,
+                        help='If provided, record a timeline of sample generation in all workers in Chrome trace format to this directory')
+
     parser.add_argument('-v',
                         '--verbose',
                         dest='verbose',
@@ -116,13 +280,43 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     init_console_logger(LOGGER, verbose=args.verbose)
-    multiprocessing_logging.install_mp_handler()
+    # Workers enqueue log records, which are written by a listener thread
+    _, log_worker_args = init_queue_logging([LOGGER])
 
     # Just round up for now
     num_workers = args.num_workers
     batch_size = args.batch_size
     batches_per_worker = int(math.ceil(args.num_samples / (num_workers * batch_size)))
 
+    if args.frame_cache_size is not None:
+        frame_cache_size = int(args.frame_cache_size * 2**30)
+    else:
+        frame_cache_size = None
+
+    if not args.bad_media_path:
+        os.makedirs(args.output_dir, exist_ok=True)
+    bad_media_path = args.bad_media_path or get_bad_media_path(args.output_dir)
+    start_time = time.time()
+
+    if args.trace_dir:
+        TRACER.start(args.trace_dir, process_name='generate_samples')
+
+    if args.num_partitions and args.num_partitions > 1 and args.audio_pool_dir \
+            and not os.path.exists(get_audio_pool_path(args.audio_pool_dir, args.partition_index)):
+        # Share audio from this partition for the negative samples of the
+        # others, unless the pools were written before the tasks were started
+        with LogTimer(LOGGER, 'Writing audio pool'):
+            write_audio_pool(args.subset_path, args.audio_pool_dir,
+                             args.partition_index, args.num_partitions,
+                             pool_size=int(math.ceil(args.audio_pool_size / args.num_partitions)),
+                             random_state=args.random_state)
+
+    if args.media_pool_size:
+        manager = multiprocessing.Manager()
+        media_pool = SharedMediaPool(manager, int(args.media_pool_size * 2**30))
+    else:
+        media_pool = None
+
     worker_func = partial(sample_and_save,
         subset_path=args.subset_path,
         num_batches=batches_per_worker,
@@ -135,9 +329,57 @@ if __name__ == '__main__':
         augment=args.augment,
         rate=args.mux_rate,
         max_videos=args.max_videos,
-        include_metadata=args.include_metadata)
+        include_metadata=args.include_metadata,
+        frame_cache_dir=args.frame_cache_dir,
+        frame_cache_size=frame_cache_size,
+        sparse_video=args.sparse_video,
+        decode_fps=args.decode_fps,
+        batch_augment=args.batch_augment,
+        media_pool=media_pool,
+        shard_size=args.shard_size,
+        chunk_size=args.chunk_size,
+        compression=args.compression,
+        audio_corpus_dir=args.audio_corpus_dir,
+        windowed_audio=args.windowed_audio,
+        use_media_index=args.use_media_index,
+        bad_media_path=bad_media_path,
+        in_batch_negatives=args.in_batch_negatives,
+        partition_index=args.partition_index,
+        num_partitions=args.num_partitions,
+        audio_pool_dir=args.audio_pool_dir,
+        audio_pool_timeout=args.audio_pool_timeout,
+        timing_metrics=args.timing_metrics,
+        trace_dir=args.trace_dir)
+
+    try:
+        worker_metrics = map_iterate_in_parallel(range(num_workers), worker_func,
+                                                 processes=num_workers,
+                                                 initializer=init_queue_worker,
+                                                 initargs=log_worker_args)
+    finally:
+        if media_pool is not None:
+            media_pool.close()
+
+    if args.write_manifest:
+        # Record sample counts so training can resume without scanning the files
+        write_manifest(args.output_dir)
+
+    num_bad, reason_counts = BadMediaRegistry(bad_media_path).get_summary(since=start_time)
+    if num_bad:
+        reasons = ', '.join('{}: {}'.format(reason, count)
+                            for reason, count in reason_counts.most_common())
+        LOGGER.info('Found {} bad media files ({}). See {}'.format(
+            num_bad, reasons, bad_media_path))
+    else:
+        LOGGER.info('Found no new bad media files')
+
+    if args.timing_metrics:
+        for snapshot in worker_metrics:
+            METRICS.merge(snapshot)
+        LOGGER.info('Time breakdown over all workers:\n' + METRICS.format_summary())
 
-    map_iterate_in_parallel(range(num_workers), worker_func,
-                            processes=num_workers)
+    if args.trace_dir:
+        TRACER.stop()
+        LOGGER.info('Wrote trace to {}'.format(merge_traces(args.trace_dir)))
 
     LOGGER.info('Done!')
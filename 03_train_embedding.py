@@ -79,6 +79,13 @@ def parse_arguments():
                         default=10,
                         help='The number of epochs between model checkpoints')
 
+    parser.add_argument('-kc',
+                        '--keep-checkpoints',
+                        dest='keep_checkpoints',
+                        action='store',
+                        type=int,
+                        help='If provided, the number of most recent periodic model checkpoints to keep')
+
     parser.add_argument('-r',
                         '--random-state',
                         dest='random_state',
@@ -93,6 +100,43 @@ def parse_arguments():
                         default=1,
                         help='Number of gpus used for data parallelism.')
 
+    parser.add_argument('-dw',
+                        '--data-workers',
+                        dest='data_workers',
+                        action='store',
+                        type=int,
+                        default=2,
+                        help='Number of threads used to load batches ahead of training. If 0, batches are loaded serially.')
+
+    parser.add_argument('-dqs',
+                        '--data-queue-size',
+                        dest='data_queue_size',
+                        action='store',
+                        type=int,
+                        default=8,
+                        help='Maximum number of batches loaded ahead of training')
+
+    parser.add_argument('-tm',
+                        '--timing-metrics',
+                        dest='timing_metrics',
+                        action='store_true',
+                        default=False,
+                        help='If True, record the time spent loading and training on batches and log a breakdown at the end')
+
+    parser.add_argument('-td',
+                        '--trace-dir',
+                        dest='trace_dir',
+                        action='store',
+                        type=str,
+                        help='If provided, record a timeline of data loading and training in Chrome trace format to this directory')
+
+    parser.add_argument('-mp',
+                        '--metrics-port',
+                        dest='metrics_port',
+                        action='store',
+                        type=int,
+                        help='If provided, serve training throughput metrics over HTTP on this local port')
+
     parser.add_argument('-gsid',
                         '--gsheet-id',
                         dest='gsheet_id',
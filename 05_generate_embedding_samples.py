@@ -6,7 +6,7 @@ from l3embedding.model import load_embedding
 from data.usc.dcase2013 import generate_dcase2013_folds, generate_dcase2013_fold_data
 from data.usc.esc50 import generate_esc50_folds, generate_esc50_fold_data
 from data.usc.us8k import generate_us8k_folds, generate_us8k_fold_data
-from log import init_console_logger
+from log import init_console_logger, init_queue_logging, METRICS
 
 LOGGER = logging.getLogger('cls-data-generation')
 LOGGER.setLevel(logging.DEBUG)
@@ -95,6 +95,13 @@ def parse_arguments():
                         action='store',
                         help='Path to UrbanSound8K metadata file')
 
+    parser.add_argument('-tm',
+                        '--timing-metrics',
+                        dest='timing_metrics',
+                        action='store_true',
+                        default=False,
+                        help='If True, record the time spent in each stage of feature generation and log a breakdown at the end')
+
     parser.add_argument('dataset_name',
                         action='store',
                         type=str,
@@ -117,6 +124,9 @@ if __name__ == '__main__':
     args = parse_arguments()
 
     init_console_logger(LOGGER, verbose=args['verbose'])
+    # Write log records from a listener thread so that per-file logging does
+    # not block feature generation
+    init_queue_logging([LOGGER])
     LOGGER.debug('Initialized logging.')
 
     # Unpack CL args
@@ -135,6 +145,8 @@ if __name__ == '__main__':
 
     LOGGER.info('Configuration: {}'.format(str(args)))
 
+    METRICS.enabled = args['timing_metrics']
+
     is_l3_feature = features == 'l3'
     if is_l3_feature and not model_path:
         raise ValueError('Must provide model path is L3 embedding features are used')
@@ -216,4 +228,7 @@ if __name__ == '__main__':
     else:
         LOGGER.error('Invalid dataset name: {}'.format(dataset_name))
 
+    if METRICS.enabled:
+        LOGGER.info('Time breakdown:\n' + METRICS.format_summary())
+
     LOGGER.info('Done!')
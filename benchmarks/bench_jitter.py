@@ -0,0 +1,131 @@
+import argparse
+import timeit
+
+import numpy as np
+import skimage
+import skimage.color
+
+from l3embedding.jitter import adjust_saturation, adjust_brightness
+
+
+def skimage_adjust_saturation(rgb_img, factor):
+    """
+    Reference saturation adjustment through a float64 HSV round trip
+    """
+    hsv_img = skimage.color.rgb2hsv(rgb_img)
+    imin, imax = skimage.dtype_limits(hsv_img, clip_negative=True)
+    hsv_img[:,:,1] = np.clip(hsv_img[:,:,1] * factor, imin, imax)
+    return skimage.color.hsv2rgb(hsv_img)
+
+
+def skimage_adjust_brightness(rgb_img, delta):
+    """
+    Reference brightness adjustment
+    """
+    imin, imax = skimage.dtype_limits(rgb_img, clip_negative=True)
+    delta = rgb_img.dtype.type((imax - imin) * delta)
+    return np.clip(rgb_img + delta, imin, imax)
+
+
+def validate(num_images=32, size=224, tolerance=1e-5, random_state=20171021):
+    """
+    Check that the fast jitter kernels match the skimage implementation
+
+    Returns:
+        max_errors: Dictionary of maximum absolute error for each kernel
+    """
+    rng = np.random.RandomState(random_state)
+    imgs = rng.rand(num_images, size, size, 3)
+    # Include gray and black pixels, where saturation is undefined
+    imgs[:, 0, :, :] = imgs[:, 0, :, :1]
+    imgs[:, 1, :, :] = 0
+
+    factors = rng.uniform(0.5, 1.5, num_images).astype(np.float32)
+    deltas = rng.uniform(-32. / 255., 32. / 255., num_images).astype(np.float32)
+
+    max_errors = {'saturation': 0.0, 'brightness': 0.0,
+                  'saturation_batch': 0.0}
+    ref_sat = []
+    for img, factor, delta in zip(imgs, factors, deltas):
+        ref = skimage_adjust_saturation(img, factor)
+        ref_sat.append(ref)
+        out = adjust_saturation(img.astype(np.float32), factor)
+        max_errors['saturation'] = max(max_errors['saturation'],
+                                       float(np.abs(out - ref).max()))
+
+        ref = skimage_adjust_brightness(img, delta)
+        out = adjust_brightness(img.astype(np.float32), delta)
+        max_errors['brightness'] = max(max_errors['brightness'],
+                                       float(np.abs(out - ref).max()))
+
+    out = adjust_saturation(imgs.astype(np.float32), factors)
+    max_errors['saturation_batch'] = float(np.abs(out - np.array(ref_sat)).max())
+
+    for name, err in max_errors.items():
+        if err > tolerance:
+            err_msg = '{} kernel differs from skimage by {} (tolerance {})'
+            raise AssertionError(err_msg.format(name, err, tolerance))
+
+    return max_errors
+
+
+def benchmark(num_images=64, size=224, number=5, random_state=20171021):
+    """
+    Time saturation and brightness jitter for the skimage and fast kernels
+
+    Returns:
+        timings: Dictionary of seconds per image for each implementation
+    """
+    rng = np.random.RandomState(random_state)
+    imgs_u8 = (rng.rand(num_images, size, size, 3) * 255).astype(np.uint8)
+    imgs_f64 = skimage.img_as_float(imgs_u8)
+    imgs_f32 = imgs_f64.astype(np.float32)
+    factor = np.float32(1.3)
+    delta = np.float32(0.05)
+
+    def run_skimage():
+        for img in imgs_f64:
+            skimage_adjust_brightness(skimage_adjust_saturation(img, factor), delta)
+
+    def run_fast():
+        for img in imgs_f32:
+            adjust_brightness(adjust_saturation(img, factor), delta)
+
+    def run_fast_batch():
+        out = imgs_f32.copy()
+        adjust_saturation(out, factor, out=out)
+        adjust_brightness(out, delta, out=out)
+
+    def run_fast_uint8():
+        for img in imgs_u8:
+            adjust_brightness(adjust_saturation(img, factor), delta)
+
+    timings = {}
+    for name, func in (('skimage', run_skimage),
+                       ('fast_float32', run_fast),
+                       ('fast_float32_batch', run_fast_batch),
+                       ('fast_uint8', run_fast_uint8)):
+        total = min(timeit.repeat(func, number=1, repeat=number))
+        timings[name] = total / num_images
+
+    return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Validate and benchmark fast color jitter kernels against skimage')
+    parser.add_argument('-n', '--num-images', dest='num_images', type=int, default=64,
+                        help='Number of 224x224 images to process')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=5,
+                        help='Number of timing repetitions')
+    parser.add_argument('-t', '--tolerance', dest='tolerance', type=float, default=1e-5,
+                        help='Maximum absolute difference from skimage')
+    args = parser.parse_args()
+
+    max_errors = validate(tolerance=args.tolerance)
+    for name, err in sorted(max_errors.items()):
+        print('{:<20} max abs error: {:.3g}'.format(name, err))
+
+    timings = benchmark(num_images=args.num_images, number=args.repeat)
+    baseline = timings['skimage']
+    for name, t in sorted(timings.items(), key=lambda x: -x[1]):
+        print('{:<20} {:8.3f} ms/image ({:5.1f}x)'.format(name, t * 1000, baseline / t))
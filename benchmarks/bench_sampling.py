@@ -0,0 +1,426 @@
+import argparse
+import csv
+import itertools
+import json
+import logging
+import multiprocessing as mp
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+import skvideo
+import soundfile as sf
+
+from data.avc.media_index import build_media_index, get_media_index_path, \
+    load_media_index, write_media_index
+from data.avc.sample import data_generator, sample_and_save, sampler
+from data.utils import read_csv_as_dicts
+
+LOGGER = logging.getLogger('sampling')
+
+# Generation modes to compare, as keyword arguments to the sampling functions
+MODES = OrderedDict([
+    ('default', {}),
+    ('sparse_video', {'sparse_video': True}),
+    ('windowed_audio', {'windowed_audio': True}),
+    ('decode_fps', {'decode_fps': 2}),
+    ('no_media_index', {'use_media_index': False}),
+])
+
+# Pipeline stage of each block timed with LogTimer
+STAGES = {
+    'Reading video': 'decode',
+    'Reading audio': 'decode',
+    'Cropping frame': 'crop',
+    'Flipping frame': 'augment',
+    'Adjusting saturation': 'augment',
+    'Adjusting brightness': 'augment',
+    'Augmenting video batch': 'augment',
+    'Writing batch': 'write',
+}
+
+TIMER_MSG_RE = re.compile(r'^(.*) took ([0-9.eE+-]+) seconds$')
+
+
+class StageTimeHandler(logging.Handler):
+    """
+    Logging handler that accumulates the durations logged by LogTimer
+    """
+
+    def __init__(self):
+        super(StageTimeHandler, self).__init__(level=logging.DEBUG)
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def emit(self, record):
+        match = TIMER_MSG_RE.match(record.getMessage())
+        if match:
+            desc = match.group(1)
+            self.totals[desc] += float(match.group(2))
+            self.counts[desc] += 1
+
+    def get_summary(self, elapsed):
+        """
+        Summarize the accumulated durations
+
+        Args:
+            elapsed: Total wall time of the run (seconds)
+
+        Returns:
+            stages: Dictionary of total seconds in each pipeline stage,
+                    including time not covered by any stage
+            timers: Dictionary of count and total seconds of each timed block
+        """
+        stages = OrderedDict((stage, 0.0) for stage in ('decode', 'crop', 'augment', 'write'))
+        for desc, total in self.totals.items():
+            if desc in STAGES:
+                stages[STAGES[desc]] += total
+        stages['other'] = max(elapsed - sum(stages.values()), 0.0)
+
+        timers = OrderedDict((desc, {'count': self.counts[desc], 'total': self.totals[desc]})
+                             for desc in sorted(self.totals))
+        return stages, timers
+
+
+def make_synthetic_video(path, duration, width=320, height=240, fps=30):
+    """
+    Write a synthetic test pattern video with ffmpeg
+
+    Args:
+        path: Path to output video file
+        duration: Duration of video (seconds)
+
+    Keyword Args:
+        width: Frame width
+        height: Frame height
+        fps: Frames per second
+    """
+    cmd = [os.path.join(skvideo.getFFmpegPath(), 'ffmpeg'),
+           '-nostdin', '-loglevel', 'error', '-y',
+           '-f', 'lavfi',
+           '-i', 'testsrc=size={}x{}:rate={}:duration={}'.format(width, height, fps, duration),
+           '-c:v', 'mpeg4', '-q:v', '5',
+           path]
+    subprocess.check_call(cmd)
+
+
+def make_synthetic_audio(path, duration, sr=48000, random_state=None):
+    """
+    Write a synthetic stereo audio file of tones and noise
+
+    Args:
+        path: Path to output audio file
+        duration: Duration of audio (seconds)
+
+    Keyword Args:
+        sr: Sample rate
+        random_state: Value used to initialize state of RNG
+    """
+    rng = np.random.RandomState(random_state)
+    t = np.arange(int(duration * sr)) / float(sr)
+    freqs = rng.uniform(100, 4000, size=2)
+    audio = 0.3 * np.sin(2 * np.pi * freqs[None, :] * t[:, None])
+    audio += 0.05 * rng.randn(len(t), 2)
+    sf.write(path, (audio * 32767).astype(np.int16), sr)
+
+
+def make_synthetic_dataset(data_dir, num_videos=8, duration=10, width=320,
+                           height=240, fps=30, sr=48000, media_index=True,
+                           random_state=20171021):
+    """
+    Create a directory of synthetic videos and audio with a subset file
+    listing them
+
+    Args:
+        data_dir: Directory where media and subset files are written
+
+    Keyword Args:
+        num_videos: Number of videos
+        duration: Duration of each video (seconds)
+        width: Frame width
+        height: Frame height
+        fps: Frames per second
+        sr: Audio sample rate
+        media_index: If True, write a media index next to the subset file
+        random_state: Value used to initialize state of RNG
+
+    Returns:
+        subset_path: Path to subset file
+    """
+    video_dir = os.path.join(data_dir, 'video')
+    audio_dir = os.path.join(data_dir, 'audio')
+    for path in (video_dir, audio_dir):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    items = []
+    for idx in range(num_videos):
+        ytid = 'synth{:04d}'.format(idx)
+        video_path = os.path.join(video_dir, ytid + '.mp4')
+        audio_path = os.path.join(audio_dir, ytid + '.flac')
+        make_synthetic_video(video_path, duration, width=width, height=height, fps=fps)
+        make_synthetic_audio(audio_path, duration, sr=sr, random_state=random_state + idx)
+
+        item = OrderedDict()
+        item['ytid'] = ytid
+        item['audio_filepath'] = audio_path
+        item['video_filepath'] = video_path
+        item['labels'] = 'synthetic'
+        items.append(item)
+
+    subset_path = os.path.join(data_dir, 'synthetic_train.csv')
+    with open(subset_path, 'w') as f:
+        writer = csv.DictWriter(f, list(items[0].keys()))
+        writer.writeheader()
+        writer.writerows(items)
+
+    if media_index:
+        index = build_media_index(items, num_workers=1)
+        write_media_index(get_media_index_path(subset_path), index.values())
+
+    return subset_path
+
+
+def bench_sampler(subset_path, num_samples, augment=False, **kwargs):
+    """
+    Draw samples from streamers created directly with sampler
+
+    Returns:
+        num_samples: Number of samples drawn
+    """
+    media_index_path = get_media_index_path(subset_path)
+    if kwargs.pop('use_media_index', True) and os.path.exists(media_index_path):
+        kwargs['media_index'] = load_media_index(media_index_path)
+
+    items = read_csv_as_dicts(subset_path)
+    pairs = itertools.cycle(zip(items, items[1:] + items[:1]))
+    count = 0
+    num_empty = 0
+    while count < num_samples:
+        video_1, video_2 = next(pairs)
+        streamer = sampler(video_1, video_2, augment=augment, **kwargs)
+        num_drawn = sum(1 for _ in itertools.islice(streamer, min(32, num_samples - count)))
+        streamer.close()
+
+        count += num_drawn
+        num_empty = 0 if num_drawn else num_empty + 1
+        if num_empty >= len(items):
+            raise RuntimeError('No streamers produced samples')
+
+    return count
+
+
+def bench_data_generator(subset_path, num_samples, augment=False,
+                         num_streamers=32, batch_size=64, **kwargs):
+    """
+    Draw batches from data_generator
+
+    Returns:
+        num_samples: Number of samples drawn
+    """
+    num_batches = int(np.ceil(num_samples / float(batch_size)))
+    data_gen = data_generator(subset_path, k=num_streamers, batch_size=batch_size,
+                              augment=augment, **kwargs)
+    count = 0
+    for batch in itertools.islice(data_gen, num_batches):
+        count += len(batch['label'])
+
+    return count
+
+
+def bench_sample_and_save(subset_path, num_samples, augment=False,
+                          num_streamers=32, batch_size=64, output_dir=None,
+                          **kwargs):
+    """
+    Generate and write batches with sample_and_save
+
+    Returns:
+        num_samples: Number of samples written
+    """
+    num_batches = int(np.ceil(num_samples / float(batch_size)))
+    output_dir = tempfile.mkdtemp(dir=output_dir)
+    try:
+        sample_and_save(0, subset_path, num_batches, output_dir,
+                        num_streamers=num_streamers, batch_size=batch_size,
+                        augment=augment, **kwargs)
+    finally:
+        shutil.rmtree(output_dir)
+
+    return num_batches * batch_size
+
+
+BENCHMARKS = OrderedDict([
+    ('sampler', bench_sampler),
+    ('data_generator', bench_data_generator),
+    ('sample_and_save', bench_sample_and_save),
+])
+
+
+def run_benchmark(config):
+    """
+    Run a single benchmark configuration. Meant to be run in a fresh process
+    so that peak memory usage is measured for the configuration alone.
+
+    Args:
+        config: Dictionary with the benchmark name, subset path, number of
+                samples, and keyword arguments to the benchmark function
+
+    Returns:
+        result: Dictionary of benchmark results
+    """
+    handler = StageTimeHandler()
+    LOGGER.addHandler(handler)
+    LOGGER.setLevel(logging.DEBUG)
+    try:
+        func = BENCHMARKS[config['benchmark']]
+        start_time = time.time()
+        num_samples = func(config['subset_path'], config['num_samples'],
+                           **config['kwargs'])
+        elapsed = time.time() - start_time
+    finally:
+        LOGGER.removeHandler(handler)
+
+    stages, timers = handler.get_summary(elapsed)
+
+    result = OrderedDict()
+    result['benchmark'] = config['benchmark']
+    result['mode'] = config['mode']
+    result['params'] = config['kwargs']
+    result['num_samples'] = num_samples
+    result['elapsed'] = elapsed
+    result['samples_per_sec'] = num_samples / elapsed if elapsed > 0 else None
+    # ru_maxrss is reported in kilobytes on Linux
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    result['stages'] = stages
+    result['timers'] = timers
+    return result
+
+
+def get_configs(subset_path, benchmarks, modes, num_streamers_list, batch_sizes,
+                augment_list, num_samples, output_dir=None):
+    """
+    Get the grid of benchmark configurations
+
+    Returns:
+        configs: List of benchmark configuration dictionaries
+    """
+    configs = []
+    for benchmark, mode, augment in itertools.product(benchmarks, modes, augment_list):
+        if benchmark == 'sampler':
+            # Streamer count and batch size do not apply
+            grid = [{}]
+        else:
+            grid = [{'num_streamers': k, 'batch_size': batch_size}
+                    for k, batch_size in itertools.product(num_streamers_list, batch_sizes)]
+
+        for params in grid:
+            kwargs = OrderedDict(augment=augment)
+            kwargs.update(params)
+            kwargs.update(MODES[mode])
+            if benchmark == 'sample_and_save' and output_dir:
+                kwargs['output_dir'] = output_dir
+            configs.append({'benchmark': benchmark, 'mode': mode,
+                            'subset_path': subset_path,
+                            'num_samples': num_samples, 'kwargs': kwargs})
+    return configs
+
+
+def get_environment():
+    """
+    Get information about the environment the benchmarks were run in
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return OrderedDict([
+        ('timestamp', time.time()),
+        ('commit', commit),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__),
+        ('platform', platform.platform()),
+        ('cpu_count', mp.cpu_count()),
+    ])
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark sample generation on synthetic media')
+    parser.add_argument('-b', '--benchmarks', dest='benchmarks', nargs='+',
+                        choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help='Benchmarks to run')
+    parser.add_argument('-m', '--modes', dest='modes', nargs='+',
+                        choices=list(MODES), default=['default'],
+                        help='Generation modes to compare')
+    parser.add_argument('-k', '--num-streamers', dest='num_streamers', nargs='+', type=int,
+                        default=[4, 32], help='Numbers of concurrent streamers')
+    parser.add_argument('-bs', '--batch-sizes', dest='batch_sizes', nargs='+', type=int,
+                        default=[16, 64], help='Batch sizes')
+    parser.add_argument('-a', '--augment', dest='augment', choices=['on', 'off', 'both'],
+                        default='both', help='Whether to run with data augmentation')
+    parser.add_argument('-n', '--num-samples', dest='num_samples', type=int, default=512,
+                        help='Number of samples drawn in each run')
+    parser.add_argument('-nv', '--num-videos', dest='num_videos', type=int, default=16,
+                        help='Number of synthetic videos')
+    parser.add_argument('-d', '--duration', dest='duration', type=float, default=10,
+                        help='Duration of synthetic videos (seconds)')
+    parser.add_argument('-dd', '--data-dir', dest='data_dir', type=str,
+                        help='Directory for synthetic media. If it contains a subset file, '
+                             'the media is reused. By default, a temporary directory is used')
+    parser.add_argument('-o', '--output-path', dest='output_path', type=str,
+                        help='Path to JSON results file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='bench_sampling_')
+    subset_path = os.path.join(data_dir, 'synthetic_train.csv')
+    if not os.path.exists(subset_path):
+        print('Creating synthetic dataset in {}'.format(data_dir))
+        subset_path = make_synthetic_dataset(data_dir, num_videos=args.num_videos,
+                                             duration=args.duration)
+
+    augment_list = {'on': [True], 'off': [False], 'both': [False, True]}[args.augment]
+    configs = get_configs(subset_path, args.benchmarks, args.modes,
+                          args.num_streamers, args.batch_sizes, augment_list,
+                          args.num_samples, output_dir=data_dir)
+
+    # Run each configuration in a fresh process to isolate peak memory usage
+    ctx = mp.get_context('spawn')
+    results = []
+    for config in configs:
+        pool = ctx.Pool(1)
+        try:
+            result = pool.apply(run_benchmark, (config,))
+        finally:
+            pool.close()
+            pool.join()
+        results.append(result)
+
+        params = ' '.join('{}={}'.format(k, v) for k, v in result['params'].items()
+                          if k != 'output_dir')
+        stages = ' '.join('{}={:.2f}s'.format(k, v) for k, v in result['stages'].items())
+        print('{:<16} {:<15} {:<50} {:8.1f} samples/s {:8.1f} MB  {}'.format(
+            result['benchmark'], result['mode'], params, result['samples_per_sec'],
+            result['peak_rss_mb'], stages))
+
+    output = OrderedDict([('environment', get_environment()), ('results', results)])
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+    if not args.data_dir:
+        shutil.rmtree(data_dir)
@@ -0,0 +1,231 @@
+import logging
+import os
+import warnings
+from multiprocessing import Pool
+
+import numpy as np
+import soundfile as sf
+
+from data.utils import read_csv_as_dicts
+
+LOGGER = logging.getLogger('sampling')
+
+AUDIO_CORPUS_SR = 48000
+AUDIO_DATA_FILENAME = 'audio.int16'
+AUDIO_INDEX_FILENAME = 'index.npz'
+
+
+def read_corpus_audio(audio_path, sr=AUDIO_CORPUS_SR):
+    """
+    Read an audio file as mono 16-bit PCM at the corpus sample rate
+
+    Audio is downmixed in the same way as the sampler, and resampled if the
+    file has a different sample rate.
+
+    Args:
+        audio_path: Path to audio file
+
+    Keyword Args:
+        sr: Target sample rate
+
+    Returns:
+        audio_data: int16 audio data array
+    """
+    audio_data, sampling_frequency = sf.read(audio_path, dtype='int16',
+                                             always_2d=True)
+    audio_data = audio_data.mean(axis=-1).astype('int16')
+
+    if sampling_frequency != sr:
+        import resampy
+        audio_data = resampy.resample(audio_data.astype('float32'),
+                                      sampling_frequency, sr)
+        audio_data = np.clip(np.rint(audio_data), -32768, 32767).astype('int16')
+
+    return audio_data
+
+
+def _read_corpus_audio_safe(audio_path):
+    """
+    Read corpus audio in a worker process, returning None on failure
+    """
+    try:
+        return read_corpus_audio(audio_path)
+    except Exception as e:
+        warn_msg = 'Could not read audio file {} - {}: {}; Skipping...'
+        warnings.warn(warn_msg.format(audio_path, type(e), e))
+        return None
+
+
+def build_audio_corpus(subset_path, corpus_dir, n_jobs=1):
+    """
+    Decode the audio files in a subset into a single packed int16 corpus
+
+    The corpus consists of a raw mono 16-bit PCM file holding the audio of
+    every file in the subset back to back at 48 kHz, and an index mapping the
+    filename of each audio file to its offset and length in the corpus. Since
+    audio is looked up by filename, every audio file in the subset must have a
+    different filename.
+
+    Args:
+        subset_path: Path to subset file
+        corpus_dir: Directory where the corpus is written
+
+    Keyword Args:
+        n_jobs: Number of processes used to decode audio
+
+    Returns:
+        corpus: AudioCorpus for the written corpus
+    """
+    audio_paths = []
+    filename_to_path = {}
+    for item in read_csv_as_dicts(subset_path):
+        audio_path = item['audio_filepath']
+        filename = os.path.basename(audio_path)
+        if filename not in filename_to_path:
+            filename_to_path[filename] = audio_path
+            audio_paths.append(audio_path)
+        elif filename_to_path[filename] != audio_path:
+            # Audio is looked up by filename, so the audio of one file would
+            # be returned for the other
+            raise ValueError('Audio files {} and {} have the same filename'.format(
+                filename_to_path[filename], audio_path))
+
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+
+    data_path = os.path.join(corpus_dir, AUDIO_DATA_FILENAME)
+    tmp_data_path = '{}.{}.tmp'.format(data_path, os.getpid())
+
+    filenames = []
+    offsets = []
+    lengths = []
+    offset = 0
+
+    pool = Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        if pool is not None:
+            audio_gen = pool.imap(_read_corpus_audio_safe, audio_paths,
+                                  chunksize=4)
+        else:
+            audio_gen = map(_read_corpus_audio_safe, audio_paths)
+
+        # Write the audio in subset order as it is decoded
+        with open(tmp_data_path, 'wb') as f:
+            for idx, (audio_path, audio_data) in enumerate(zip(audio_paths, audio_gen)):
+                if audio_data is None:
+                    continue
+
+                f.write(audio_data.astype('<i2').tobytes())
+                filenames.append(os.path.basename(audio_path))
+                offsets.append(offset)
+                lengths.append(len(audio_data))
+                offset += len(audio_data)
+
+                if (idx + 1) % 1000 == 0:
+                    LOGGER.info('Packed {}/{} audio files'.format(idx + 1, len(audio_paths)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    os.rename(tmp_data_path, data_path)
+    np.savez(os.path.join(corpus_dir, AUDIO_INDEX_FILENAME),
+             filenames=np.array(filenames),
+             offsets=np.array(offsets, dtype=np.int64),
+             lengths=np.array(lengths, dtype=np.int64),
+             sr=np.array(AUDIO_CORPUS_SR))
+
+    LOGGER.info('Packed {} samples from {} audio files into {}'.format(
+        offset, len(filenames), corpus_dir))
+
+    return AudioCorpus(corpus_dir)
+
+
+class AudioCorpus(object):
+    """
+    Read-only view of a packed int16 audio corpus.
+
+    The corpus data is memory mapped, so audio for a file is returned as a
+    zero-copy view of the corpus. The memory map is opened lazily in each
+    process, so the corpus can be passed to worker processes.
+    """
+
+    def __init__(self, corpus_dir):
+        """
+        Opens an audio corpus.
+
+        Args:
+            corpus_dir:  Directory containing the corpus
+                         (Type: str)
+        """
+        self.corpus_dir = corpus_dir
+
+        index = np.load(os.path.join(corpus_dir, AUDIO_INDEX_FILENAME))
+        self.sr = int(index['sr'])
+        self._index = {
+            str(filename): (int(offset), int(length))
+            for filename, offset, length
+            in zip(index['filenames'], index['offsets'], index['lengths'])
+        }
+        self._data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Don't pickle the contents of the memory map
+        state['_data'] = None
+        return state
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(os.path.join(self.corpus_dir, AUDIO_DATA_FILENAME),
+                                   dtype='<i2', mode='r')
+        return self._data
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, audio_path):
+        return os.path.basename(audio_path) in self._index
+
+    def get(self, audio_path):
+        """
+        Get the audio of a file in the corpus
+
+        Args:
+            audio_path:  Path or filename of the audio file
+                         (Type: str)
+
+        Returns:
+            audio_data:          Read-only int16 audio data array
+            sampling_frequency:  Audio sample rate
+        """
+        offset, length = self._index[os.path.basename(audio_path)]
+        return self.data[offset:offset + length], self.sr
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from log import init_console_logger
+
+    parser = argparse.ArgumentParser(description='Pack the audio of a subset into a memory mapped int16 corpus')
+    parser.add_argument('-n',
+                        '--n-jobs',
+                        dest='n_jobs',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='Number of processes used to decode audio')
+    parser.add_argument('subset_path',
+                        action='store',
+                        type=str,
+                        help='Path to subset file')
+    parser.add_argument('corpus_dir',
+                        action='store',
+                        type=str,
+                        help='Path to directory where the corpus is written')
+    args = parser.parse_args()
+
+    init_console_logger(LOGGER, verbose=True)
+    build_audio_corpus(args.subset_path, args.corpus_dir, n_jobs=args.n_jobs)
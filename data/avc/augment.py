@@ -0,0 +1,93 @@
+import logging
+
+import numpy as np
+
+from l3embedding.jitter import adjust_saturation, adjust_brightness
+from log import LogTimer
+
+LOGGER = logging.getLogger('sampling')
+
+# Ranges taken from https://github.com/tensorflow/models/blob/master/research/slim/preprocessing/inception_preprocessing.py
+MAX_BRIGHTNESS_DELTA = 32. / 255.
+MIN_SATURATION_FACTOR = 0.5
+MAX_SATURATION_FACTOR = 1.5
+
+
+def augment_video_batch(video):
+    """
+    Randomly flip and jitter the saturation and brightness of a batch of
+    video frames
+
+    Parameters for all of the frames are drawn up front and applied with
+    vectorized operations on the whole batch. As with per-sample augmentation,
+    the order of the saturation and brightness jitter is randomized for each
+    frame.
+
+    Args:
+        video: (B, H, W, 3) uint8 video frame data array
+
+    Returns:
+        video: Augmented (B, H, W, 3) uint8 video frame data array
+        video_aug_params: Dictionary of (B,) augmentation parameter arrays
+    """
+    batch_size = video.shape[0]
+
+    horizontal_flip = np.random.random(batch_size) < 0.5
+    saturation_first = np.random.random(batch_size) < 0.5
+    saturation_factor = np.random.uniform(MIN_SATURATION_FACTOR,
+                                          MAX_SATURATION_FACTOR,
+                                          batch_size).astype(np.float32)
+    brightness_delta = np.random.uniform(-MAX_BRIGHTNESS_DELTA,
+                                         MAX_BRIGHTNESS_DELTA,
+                                         batch_size).astype(np.float32)
+
+    with LogTimer(LOGGER, 'Augmenting video batch'):
+        frames = video.astype(np.float32)
+        frames /= 255
+
+        frames[horizontal_flip] = frames[horizontal_flip, :, ::-1, :]
+
+        # Brightness jitter with a zero delta is a no-op, so the order can be
+        # randomized by applying the jitter either before or after saturation
+        zero = np.zeros_like(brightness_delta)
+        adjust_brightness(frames, np.where(saturation_first, zero,
+                                           brightness_delta), out=frames)
+        adjust_saturation(frames, saturation_factor, out=frames)
+        adjust_brightness(frames, np.where(saturation_first,
+                                           brightness_delta, zero), out=frames)
+
+        frames *= 255
+        np.rint(frames, out=frames)
+        video = frames.astype(np.uint8)
+
+    video_aug_params = {
+        'horizontal_flip': horizontal_flip,
+        'saturation_factor': saturation_factor,
+        'brightness_delta': brightness_delta,
+    }
+
+    return video, video_aug_params
+
+
+def augment_batches(batches, include_metadata=False):
+    """
+    Apply batch video augmentation to a stream of sample batches
+
+    Args:
+        batches: Iterable of sample batch dictionaries
+
+    Keyword Args:
+        include_metadata: If True, add augmentation parameters to the batch
+                          using the same keys as per-sample augmentation
+
+    Returns:
+        A generator that yields augmented sample batch dictionaries
+    """
+    for batch in batches:
+        batch['video'], video_aug_params = augment_video_batch(batch['video'])
+
+        if include_metadata:
+            for key, value in video_aug_params.items():
+                batch['video_' + key] = value
+
+        yield batch
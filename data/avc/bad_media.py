@@ -0,0 +1,178 @@
+import fcntl
+import logging
+import os
+import subprocess
+import time
+from collections import Counter
+
+LOGGER = logging.getLogger('sampling')
+
+
+BAD_MEDIA_FILENAME = 'bad_media.tsv'
+
+
+class MediaDecodeError(IOError):
+    """
+    Raised when a media file is read, but no data could be decoded from it
+    """
+    pass
+
+
+# Errors caused by the contents of a media file, rather than by the system,
+# e.g. running out of memory or a network filesystem timing out. Generic
+# errors such as ValueError are left out, since they are as likely to be
+# caused by a bug as by the file, and recorded files are skipped in later runs.
+# soundfile raises RuntimeError for files it cannot decode.
+DECODE_ERRORS = (MediaDecodeError, subprocess.CalledProcessError, RuntimeError)
+
+
+def is_decode_error(error):
+    """
+    Check whether an error raised while reading a media file means that the
+    file cannot be decoded, so that it should be recorded as bad media
+
+    Args:
+        error: Error raised while reading the media file
+
+    Returns:
+        is_decode_error: True if the error is a decoding or format error
+    """
+    return isinstance(error, DECODE_ERRORS)
+
+
+def get_bad_media_path(output_dir):
+    """
+    Get the path of the bad media registry stored in an output directory
+
+    Args:
+        output_dir: Directory where sample files are written
+
+    Returns:
+        bad_media_path: Path to bad media registry file
+    """
+    return os.path.join(output_dir, BAD_MEDIA_FILENAME)
+
+
+class BadMediaRegistry(object):
+    """
+    File-backed set of media files that could not be decoded.
+
+    The registry is an append-only tab separated file of media path, reason,
+    process ID and timestamp, locked with ``fcntl`` so that it can be shared
+    by worker processes and persist between runs. Each process keeps an
+    in-memory copy, which is refreshed with entries appended by other
+    processes whenever the file grows. If the file cannot be written, only
+    the in-memory copy is kept.
+    """
+
+    def __init__(self, path):
+        """
+        Opens a bad media registry, creating the file if it does not exist.
+
+        Args:
+            path:  Path to registry file
+                   (Type: str)
+        """
+        self.path = path
+        self._entries = {}
+        self._offset = 0
+
+        try:
+            open(path, 'a').close()
+        except OSError as e:
+            warn_msg = 'Could not open bad media registry {} - {}: {}; Only keeping it in memory'
+            LOGGER.warning(warn_msg.format(path, type(e), e))
+            self.path = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Read entries appended to the registry file since the last refresh
+        """
+        if self.path is None or os.path.getsize(self.path) <= self._offset:
+            return
+
+        with open(self.path, 'rb') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            try:
+                f.seek(self._offset)
+                data = f.read()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        # Only consume complete lines
+        data = data[:data.rfind(b'\n') + 1]
+        self._offset += len(data)
+        for line in data.decode('utf-8').splitlines():
+            fields = line.split('\t')
+            if len(fields) == 4:
+                self._entries[fields[0]] = fields[1:]
+
+    def add(self, media_path, reason):
+        """
+        Record a media file as bad
+
+        Args:
+            media_path:  Path to media file
+                         (Type: str)
+
+            reason:      Reason why the file is bad
+                         (Type: str)
+        """
+        reason = ' '.join(str(reason).split())
+        fields = [media_path, reason, str(os.getpid()), '{:.3f}'.format(time.time())]
+
+        if self.path is not None:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.write('\t'.join(fields) + '\n')
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+        self._entries[media_path] = fields[1:]
+        LOGGER.warning('Marked {} as bad media: {}'.format(media_path, reason))
+
+    def get_paths(self):
+        """
+        Get the paths of the media files in the registry. The registry file is
+        only read once, so this is cheaper than repeated membership tests when
+        checking many files.
+
+        Returns:
+            media_paths: Set of paths of bad media files
+                         (Type: frozenset[str])
+        """
+        self.refresh()
+        return frozenset(self._entries)
+
+    def __contains__(self, media_path):
+        self.refresh()
+        return media_path in self._entries
+
+    def __len__(self):
+        self.refresh()
+        return len(self._entries)
+
+    def get_summary(self, since=None):
+        """
+        Summarize the entries in the registry
+
+        Keyword Args:
+            since: If provided, only include entries recorded after this time
+                   (Type: float)
+
+        Returns:
+            num_files: Number of bad media files
+            reason_counts: Counter of the error type of each reason
+        """
+        self.refresh()
+        reason_counts = Counter()
+        num_files = 0
+        for reason, _, timestamp in self._entries.values():
+            if since is not None and float(timestamp) < since:
+                continue
+            num_files += 1
+            reason_counts[reason.split(':', 1)[0]] += 1
+
+        return num_files, reason_counts
@@ -0,0 +1,152 @@
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+LOGGER = logging.getLogger('sampling')
+
+
+class VideoFrameCache(object):
+    """
+    Persistent on-disk cache of decoded and resized video frames.
+
+    Frames are stored as uint8 ``.npy`` files of shape (n_frames, H, W, 3) and
+    are loaded as read-only memory maps, so repeated streamer activations can
+    slice frames without decoding the video again. Entries are keyed by video
+    path, modification time and target size, so re-encoded videos are not
+    served stale frames. When the total size of the cache exceeds the size
+    cap, the least recently used entries are evicted.
+
+    The cache can be shared by multiple processes; entries are written to a
+    temporary file and atomically renamed into place.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        """
+        Creates a video frame cache.
+
+        Args:
+            cache_dir:  Directory where cached frames are stored
+                        (Type: str)
+
+        Keyword Args:
+            max_size:   Maximum total size of the cache in bytes. If None,
+                        the cache is not size limited.
+                        (Type: int or None)
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_path(self, video_path, target_size):
+        """
+        Get the path of the cache entry for the given video
+
+        Args:
+            video_path:   Path to video file
+            target_size:  Size the frames were resized to
+
+        Returns:
+            entry_path: Path to cache entry
+        """
+        video_path = os.path.abspath(video_path)
+        mtime = os.path.getmtime(video_path)
+        key = '{}:{}:{}'.format(video_path, mtime, target_size)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + '.npy')
+
+    def get(self, video_path, target_size):
+        """
+        Get the cached frames for the given video
+
+        Args:
+            video_path:   Path to video file
+            target_size:  Size the frames were resized to
+
+        Returns:
+            frames: Read-only memory mapped frame array, or None if the video
+                    is not in the cache
+        """
+        entry_path = self.get_path(video_path, target_size)
+        try:
+            frames = np.load(entry_path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+
+        return frames
+
+    def put(self, video_path, target_size, frames):
+        """
+        Add decoded frames for the given video to the cache
+
+        Args:
+            video_path:   Path to video file
+            target_size:  Size the frames were resized to
+            frames:       (n_frames, H, W, 3) uint8 array, or sequence of
+                          (H, W, 3) uint8 frames
+
+        Returns:
+            frames: Read-only memory mapped frame array
+        """
+        entry_path = self.get_path(video_path, target_size)
+        tmp_path = '{}.{}.tmp'.format(entry_path, os.getpid())
+
+        num_frames = len(frames)
+        shape = (num_frames,) + tuple(frames[0].shape)
+        data = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                         dtype=np.uint8, shape=shape)
+        if isinstance(frames, np.ndarray):
+            data[:] = frames
+        else:
+            for idx in range(num_frames):
+                data[idx] = frames[idx]
+        data.flush()
+        del data
+
+        os.rename(tmp_path, entry_path)
+        self.evict()
+
+        return np.load(entry_path, mmap_mode='r')
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is within its size
+        cap
+        """
+        if self.max_size is None:
+            return
+
+        entries = []
+        total_size = 0
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith('.npy'):
+                continue
+            path = os.path.join(self.cache_dir, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Entry was evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                # Memory maps that are still open remain valid after unlinking
+                os.remove(path)
+                LOGGER.debug('Evicted {} from frame cache'.format(path))
+            except OSError:
+                pass
+            total_size -= size
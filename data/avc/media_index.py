@@ -0,0 +1,201 @@
+import csv
+import logging
+import os
+from collections import OrderedDict
+
+import soundfile as sf
+from skvideo.io import ffprobe
+
+from data.utils import read_csv_as_dicts, map_iterate_in_parallel
+
+LOGGER = logging.getLogger('data')
+
+MEDIA_INDEX_FIELDS = ('video_filepath', 'audio_filepath', 'width', 'height',
+                      'fps', 'num_frames', 'duration', 'audio_sr',
+                      'audio_channels', 'audio_duration')
+MEDIA_INDEX_TYPES = {
+    'width': int,
+    'height': int,
+    'fps': float,
+    'num_frames': int,
+    'duration': float,
+    'audio_sr': int,
+    'audio_channels': int,
+    'audio_duration': float,
+}
+
+
+def get_media_index_path(subset_path):
+    """
+    Get the path of the media index stored next to a subset file
+
+    Args:
+        subset_path: Path to subset file
+
+    Returns:
+        media_index_path: Path to media index file
+    """
+    return os.path.splitext(subset_path)[0] + '_media_index.csv'
+
+
+def get_video_fps(vinfo):
+    """
+    Get the frame rate of a video
+
+    Args:
+        vinfo: Video stream information returned by ffprobe
+
+    Returns:
+        fps: Frames per second
+    """
+    num, _, denom = vinfo['@avg_frame_rate'].partition('/')
+    if float(num) == 0 or (denom and float(denom) == 0):
+        num, _, denom = vinfo['@r_frame_rate'].partition('/')
+    return float(num) / float(denom or 1)
+
+
+def get_num_frames(vinfo):
+    """
+    Get the number of frames in a video, as reported by the container or
+    estimated from its duration
+
+    Args:
+        vinfo: Video stream information returned by ffprobe
+
+    Returns:
+        num_frames: Number of frames
+    """
+    if vinfo.get('@nb_frames', 'N/A') != 'N/A':
+        return int(vinfo['@nb_frames'])
+
+    return int(float(vinfo.get('@duration', 0)) * get_video_fps(vinfo))
+
+
+def probe_media(item):
+    """
+    Probe the video and audio files of a subset item
+
+    Args:
+        item: Subset item dictionary with video_filepath and audio_filepath
+
+    Returns:
+        media_info: Dictionary of media properties, or None if either file
+                    could not be probed
+    """
+    video_path = item['video_filepath']
+    audio_path = item['audio_filepath']
+
+    try:
+        vinfo = ffprobe(video_path)['video']
+        fps = get_video_fps(vinfo)
+        num_frames = get_num_frames(vinfo)
+        if vinfo.get('@duration', 'N/A') != 'N/A':
+            duration = float(vinfo['@duration'])
+        else:
+            duration = num_frames / fps
+
+        ainfo = sf.info(audio_path)
+    except Exception as e:
+        warn_msg = 'Could not probe media for {} - {}: {}; Skipping...'
+        LOGGER.warning(warn_msg.format(video_path, type(e), e))
+        return None
+
+    media_info = OrderedDict()
+    media_info['video_filepath'] = video_path
+    media_info['audio_filepath'] = audio_path
+    media_info['width'] = int(vinfo['@width'])
+    media_info['height'] = int(vinfo['@height'])
+    media_info['fps'] = fps
+    media_info['num_frames'] = num_frames
+    media_info['duration'] = duration
+    media_info['audio_sr'] = ainfo.samplerate
+    media_info['audio_channels'] = ainfo.channels
+    media_info['audio_duration'] = ainfo.frames / float(ainfo.samplerate)
+    return media_info
+
+
+def is_valid_media(media_info, min_duration=1.0):
+    """
+    Check whether probed media can be sampled from
+
+    Args:
+        media_info: Dictionary of media properties, or None
+
+    Keyword Args:
+        min_duration: Minimum duration (seconds) of both the video and audio
+
+    Returns:
+        valid: True if the media is valid
+    """
+    return (media_info is not None
+            and media_info['num_frames'] > 0
+            and media_info['fps'] > 0
+            and media_info['duration'] >= min_duration
+            and media_info['audio_duration'] >= min_duration)
+
+
+def build_media_index(file_list, num_workers=8, min_duration=1.0):
+    """
+    Probe the media of a list of subset items in parallel
+
+    Args:
+        file_list: List of subset item dictionaries
+
+    Keyword Args:
+        num_workers: Number of processes used to probe media
+        min_duration: Minimum duration (seconds) of both the video and audio
+
+    Returns:
+        media_index: Dictionary mapping video paths to media properties of
+                     the valid items
+    """
+    if num_workers > 1:
+        media_infos = map_iterate_in_parallel(file_list, probe_media,
+                                              processes=num_workers)
+    else:
+        media_infos = [probe_media(item) for item in file_list]
+
+    media_index = OrderedDict()
+    for item, media_info in zip(file_list, media_infos):
+        if is_valid_media(media_info, min_duration=min_duration):
+            media_index[item['video_filepath']] = media_info
+
+    num_invalid = len(file_list) - len(media_index)
+    if num_invalid:
+        LOGGER.info('Dropping {} items with broken or short media'.format(num_invalid))
+
+    return media_index
+
+
+def write_media_index(path, media_infos):
+    """
+    Write a media index file
+
+    Args:
+        path: Path to media index file
+        media_infos: Iterable of media property dictionaries
+    """
+    with open(path, 'w') as f:
+        writer = csv.DictWriter(f, MEDIA_INDEX_FIELDS)
+        writer.writeheader()
+        for media_info in media_infos:
+            writer.writerow(media_info)
+
+
+def load_media_index(path):
+    """
+    Load a media index file
+
+    Args:
+        path: Path to media index file
+
+    Returns:
+        media_index: Dictionary mapping video paths to media properties
+    """
+    media_index = OrderedDict()
+    for media_info in read_csv_as_dicts(path):
+        for key, type_ in MEDIA_INDEX_TYPES.items():
+            media_info[key] = type_(media_info[key])
+        media_index[media_info['video_filepath']] = media_info
+
+    return media_index
@@ -0,0 +1,259 @@
+import logging
+import mmap
+import os
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+LOGGER = logging.getLogger('sampling')
+
+# Files in /dev/shm are backed by memory, rather than by a disk
+DEFAULT_SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+class SharedMediaPool(object):
+    """
+    Pool of decoded media shared between worker processes.
+
+    Each audio or video file is decoded once, by the first worker that needs
+    it, into a memory mapped file in a shared memory directory. Other workers
+    map zero-copy read-only views of the same file. Entries are reference
+    counted, and entries that are no longer referenced are evicted in least
+    recently used order so that the total size of the pool stays under a
+    global cap. If the pool is full of referenced entries, media is decoded
+    into private memory instead.
+
+    The pool state is kept in a ``multiprocessing.Manager`` so the pool object
+    can be passed to worker processes.
+    """
+
+    def __init__(self, manager, max_size, load_timeout=600, shm_dir=None):
+        """
+        Creates a shared media pool. Should be created in the parent process
+        before the workers are started.
+
+        Args:
+            manager:   Manager used to share the pool state between processes
+                       (Type: multiprocessing.managers.SyncManager)
+
+            max_size:  Maximum total size of the pool in bytes
+                       (Type: int)
+
+        Keyword Args:
+            load_timeout:  Number of seconds after which a worker stops waiting
+                           for another worker to decode a file and decodes it
+                           itself
+                           (Type: float)
+
+            shm_dir:       Directory where the shared files are created. By
+                           default, /dev/shm if it exists.
+                           (Type: str)
+        """
+        self.max_size = max_size
+        self.load_timeout = load_timeout
+        self.shm_dir = shm_dir or DEFAULT_SHM_DIR
+        self._prefix = 'l3media_{}_'.format(os.getpid())
+        self._entries = manager.dict()
+        self._lock = manager.Lock()
+        self._segments = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Mapped files are local to each process
+        state['_segments'] = {}
+        return state
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, nbytes):
+        """
+        Remove unreferenced entries in least recently used order until there
+        is room for the given number of bytes. Must be called with the lock
+        held. Removing a file does not affect processes that still map it.
+
+        Returns:
+            success: True if there is room for the given number of bytes
+        """
+        entries = dict(self._entries.items())
+        total_size = sum(entry['nbytes'] for entry in entries.values())
+        if total_size + nbytes <= self.max_size:
+            return True
+
+        unreferenced = sorted((entry['last_used'], key)
+                              for key, entry in entries.items()
+                              if entry['state'] == 'ready' and entry['refcount'] == 0)
+        for _, key in unreferenced:
+            entry = entries[key]
+            self._remove_file(entry['path'])
+            del self._entries[key]
+            total_size -= entry['nbytes']
+            LOGGER.debug('Evicted {} from shared media pool'.format(key))
+
+            if total_size + nbytes <= self.max_size:
+                return True
+
+        return False
+
+    def _attach(self, key, entry):
+        """
+        Map the file of an entry in this process
+
+        Returns:
+            data: Read-only view of the decoded media array
+        """
+        if key in self._segments:
+            segment, count = self._segments[key]
+        else:
+            with open(entry['path'], 'rb') as f:
+                segment = mmap.mmap(f.fileno(), max(entry['nbytes'], 1),
+                                    access=mmap.ACCESS_READ)
+            count = 0
+        self._segments[key] = (segment, count + 1)
+
+        data = np.ndarray(entry['shape'], dtype=np.dtype(entry['dtype']),
+                          buffer=segment)
+        data.flags.writeable = False
+        return data
+
+    def _write_file(self, data):
+        """
+        Copy an array into a new file in the shared memory directory
+
+        Returns:
+            path: Path to the file
+        """
+        path = os.path.join(self.shm_dir, self._prefix + uuid.uuid4().hex)
+        try:
+            with open(path, 'w+b') as f:
+                f.truncate(max(data.nbytes, 1))
+                segment = mmap.mmap(f.fileno(), max(data.nbytes, 1))
+                try:
+                    np.ndarray(data.shape, dtype=data.dtype, buffer=segment)[...] = data
+                finally:
+                    segment.close()
+        except Exception:
+            self._remove_file(path)
+            raise
+        return path
+
+    def acquire(self, key, load_func):
+        """
+        Get decoded media from the pool, decoding and adding it if it is not
+        already in the pool. Every call must be matched by a call to release.
+
+        Args:
+            key:        Unique identifier for the media
+                        (Type: str)
+
+            load_func:  Function with no arguments that decodes the media and
+                        returns a (data array, info) tuple, where info is a
+                        picklable object stored alongside the data
+                        (Type: callable)
+
+        Returns:
+            data:  Decoded media data array
+            info:  Info returned by load_func
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                now = time.time()
+                if entry is None or (entry['state'] == 'loading'
+                                     and now - entry['last_used'] > self.load_timeout):
+                    # Reserve the entry so other workers wait for us to decode
+                    self._entries[key] = {'state': 'loading', 'nbytes': 0,
+                                          'refcount': 0, 'last_used': now,
+                                          'pid': os.getpid()}
+                    break
+
+                if entry['state'] == 'ready':
+                    entry['refcount'] += 1
+                    entry['last_used'] = now
+                    self._entries[key] = entry
+                    return self._attach(key, entry), entry['info']
+
+            # Another worker is decoding this file
+            time.sleep(0.05)
+
+        try:
+            data, info = load_func()
+        except Exception:
+            with self._lock:
+                self._entries.pop(key, None)
+            raise
+
+        data = np.ascontiguousarray(data)
+        with self._lock:
+            if not self._evict(data.nbytes):
+                # No room in the pool, so use the privately decoded data
+                self._entries.pop(key, None)
+                return data, info
+
+            # Reserve room for the data, so the copy can be done without
+            # holding the lock
+            self._entries[key] = {'state': 'loading', 'nbytes': data.nbytes,
+                                  'refcount': 0, 'last_used': time.time(),
+                                  'pid': os.getpid()}
+
+        try:
+            path = self._write_file(data)
+        except Exception:
+            with self._lock:
+                self._entries.pop(key, None)
+            raise
+
+        entry = {'state': 'ready', 'nbytes': data.nbytes, 'refcount': 1,
+                 'last_used': time.time(), 'pid': os.getpid(), 'path': path,
+                 'shape': data.shape, 'dtype': data.dtype.str, 'info': info}
+        with self._lock:
+            self._entries[key] = entry
+
+        return self._attach(key, entry), info
+
+    def release(self, key):
+        """
+        Release media acquired from the pool
+
+        Args:
+            key:  Unique identifier for the media
+                  (Type: str)
+        """
+        if key not in self._segments:
+            # Media was decoded privately
+            return
+
+        # Views of the file keep it mapped until they are garbage collected,
+        # so it is never unmapped explicitly
+        segment, count = self._segments.pop(key)
+        if count > 1:
+            self._segments[key] = (segment, count - 1)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['refcount'] = max(entry['refcount'] - 1, 0)
+                entry['last_used'] = time.time()
+                self._entries[key] = entry
+
+    def close(self):
+        """
+        Remove all of the files in the pool. Should be called by the parent
+        process once all of the workers are done.
+        """
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry['state'] == 'ready':
+                    self._remove_file(entry['path'])
+            self._entries.clear()
+
+        # Also remove files of workers that were killed while copying
+        for fname in os.listdir(self.shm_dir):
+            if fname.startswith(self._prefix):
+                self._remove_file(os.path.join(self.shm_dir, fname))
@@ -0,0 +1,242 @@
+import csv
+import logging
+import os
+import random
+import time
+import zlib
+
+import numpy as np
+import soundfile as sf
+
+from data.avc.audio_corpus import AUDIO_CORPUS_SR
+
+LOGGER = logging.getLogger('sampling')
+
+
+def get_partition(video_path, num_partitions):
+    """
+    Get the partition that owns a video. Partitions are assigned by a hash of
+    the video filename, so they are the same on every node.
+
+    Args:
+        video_path: Path to video file
+        num_partitions: Number of partitions
+
+    Returns:
+        partition_idx: Index of the partition that owns the video
+    """
+    filename = os.path.basename(video_path).encode('utf-8')
+    return (zlib.crc32(filename) & 0xffffffff) % num_partitions
+
+
+def get_audio_pool_path(pool_dir, partition_idx):
+    """
+    Get the path of the audio pool file written by a partition
+
+    Args:
+        pool_dir: Directory where audio pools are exchanged
+        partition_idx: Index of the partition
+
+    Returns:
+        pool_path: Path to audio pool file
+    """
+    return os.path.join(pool_dir, 'audio_pool_{}.npz'.format(partition_idx))
+
+
+def read_audio_window(audio_path, start, num_samples):
+    """
+    Read a window of an audio file as mono 16-bit PCM
+
+    Args:
+        audio_path: Path to audio file
+        start: Index of the first sample of the window
+        num_samples: Number of samples in the window
+
+    Returns:
+        audio_data: int16 audio data array
+    """
+    audio_data, _ = sf.read(audio_path, start=start, frames=num_samples,
+                            dtype='int16', always_2d=True)
+    return audio_data.mean(axis=-1).astype('int16')
+
+
+def write_audio_pool(subset_path, pool_dir, partition_idx, num_partitions,
+                     pool_size=4096, random_state=20171021):
+    """
+    Extract one second windows of audio from random videos owned by a
+    partition, and write them to the audio pool directory so that other
+    partitions can use them for negative samples
+
+    Args:
+        subset_path: Path to subset file
+        pool_dir: Directory where audio pools are exchanged
+        partition_idx: Index of this partition
+        num_partitions: Number of partitions
+
+    Keyword Args:
+        pool_size: Maximum number of audio windows in the pool
+        random_state: Value used to initialize state of RNG
+
+    Returns:
+        pool_path: Path to written audio pool file
+    """
+    rng = random.Random(random_state)
+
+    audio_paths = []
+    with open(subset_path, 'r') as f:
+        for item in csv.DictReader(f):
+            if get_partition(item['video_filepath'], num_partitions) == partition_idx:
+                audio_paths.append(item['audio_filepath'])
+
+    rng.shuffle(audio_paths)
+
+    sr = AUDIO_CORPUS_SR
+    audio = []
+    audio_files = []
+    audio_starts = []
+    for audio_path in audio_paths:
+        if len(audio) >= pool_size:
+            break
+
+        try:
+            info = sf.info(audio_path)
+            if info.samplerate != sr or info.frames < sr:
+                continue
+            start = rng.randrange(info.frames - sr + 1)
+            audio_data = read_audio_window(audio_path, start, sr)
+        except Exception as e:
+            warn_msg = 'Could not read audio file {} - {}: {}; Skipping...'
+            LOGGER.warning(warn_msg.format(audio_path, type(e), e))
+            continue
+
+        if len(audio_data) != sr:
+            continue
+
+        audio.append(audio_data)
+        audio_files.append(os.path.basename(audio_path).encode('utf-8'))
+        audio_starts.append(start)
+
+    if not os.path.isdir(pool_dir):
+        os.makedirs(pool_dir, exist_ok=True)
+
+    # Write atomically, since other partitions poll for the file
+    pool_path = get_audio_pool_path(pool_dir, partition_idx)
+    tmp_path = '{}.{}.tmp.npz'.format(pool_path[:-len('.npz')], os.getpid())
+    np.savez(tmp_path,
+             audio=np.array(audio, dtype=np.int16).reshape((-1, sr)),
+             audio_file=np.array(audio_files, dtype=bytes),
+             audio_start_sample_idx=np.array(audio_starts, dtype=np.int64),
+             sr=np.array(sr))
+    os.rename(tmp_path, pool_path)
+
+    LOGGER.info('Wrote audio pool of {} windows to {}'.format(len(audio), pool_path))
+    return pool_path
+
+
+class AudioPool(object):
+    """
+    Pool of one second audio windows extracted by the other partitions, used
+    for negative samples with audio from videos outside of this partition.
+    """
+
+    def __init__(self, pool_dir, partition_idx, num_partitions, timeout=3600):
+        """
+        Loads the audio pools written by the other partitions, waiting for
+        them to be written.
+
+        Args:
+            pool_dir:        Directory where audio pools are exchanged
+                             (Type: str)
+
+            partition_idx:   Index of this partition
+                             (Type: int)
+
+            num_partitions:  Number of partitions
+                             (Type: int)
+
+        Keyword Args:
+            timeout:         Number of seconds to wait for the other partitions
+                             before continuing with the pools that exist
+                             (Type: float)
+        """
+        other_idxs = [idx for idx in range(num_partitions) if idx != partition_idx]
+
+        start_time = time.time()
+        while True:
+            missing = [idx for idx in other_idxs
+                       if not os.path.exists(get_audio_pool_path(pool_dir, idx))]
+            if not missing or time.time() - start_time > timeout:
+                break
+            time.sleep(10)
+
+        if missing:
+            LOGGER.warning('Audio pools for partitions {} are missing'.format(missing))
+
+        audio = []
+        audio_files = []
+        audio_starts = []
+        self.sr = AUDIO_CORPUS_SR
+        for idx in other_idxs:
+            if idx in missing:
+                continue
+            pool = np.load(get_audio_pool_path(pool_dir, idx))
+            audio.append(pool['audio'])
+            audio_files.append(pool['audio_file'])
+            audio_starts.append(pool['audio_start_sample_idx'])
+
+        if audio:
+            self.audio = np.concatenate(audio)
+            self.audio_file = np.concatenate(audio_files)
+            self.audio_start_sample_idx = np.concatenate(audio_starts)
+        else:
+            self.audio = np.zeros((0, self.sr), dtype=np.int16)
+            self.audio_file = np.zeros((0,), dtype=bytes)
+            self.audio_start_sample_idx = np.zeros((0,), dtype=np.int64)
+
+        LOGGER.info('Loaded audio pool of {} windows'.format(len(self)))
+
+    def __len__(self):
+        return len(self.audio)
+
+
+if __name__ == '__main__':
+    import argparse
+    import math
+
+    parser = argparse.ArgumentParser(description='Write the audio pools of all partitions of a subset, '
+                                                 'so that partitioned sample generation tasks do not '
+                                                 'wait for each other')
+    parser.add_argument('subset_path',
+                        action='store',
+                        type=str,
+                        help='Path to subset file')
+    parser.add_argument('pool_dir',
+                        action='store',
+                        type=str,
+                        help='Directory where audio pools are exchanged')
+    parser.add_argument('num_partitions',
+                        action='store',
+                        type=int,
+                        help='Number of partitions')
+    parser.add_argument('-aps',
+                        '--audio-pool-size',
+                        dest='audio_pool_size',
+                        action='store',
+                        type=int,
+                        default=2048,
+                        help='Total number of one second audio windows in the audio pools, split between the partitions')
+    parser.add_argument('-r',
+                        '--random-state',
+                        dest='random_state',
+                        action='store',
+                        type=int,
+                        default=20171021,
+                        help='Random seed used to set the RNG state')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for partition_idx in range(args.num_partitions):
+        write_audio_pool(args.subset_path, args.pool_dir, partition_idx,
+                         args.num_partitions,
+                         pool_size=int(math.ceil(args.audio_pool_size / args.num_partitions)),
+                         random_state=args.random_state + partition_idx)
@@ -1,59 +1,40 @@
+import array
+import csv
 import glob
 import math
 import logging
 import os
 import random
+import subprocess
 import warnings
+from collections import OrderedDict
+from functools import partial
 
 import h5py
 import numpy as np
 import pescador
 import scipy.misc
 import skimage
-import skimage.color
-from skvideo.io import FFmpegReader, ffprobe
+from skvideo.io import ffprobe
+import skvideo
 import soundfile as sf
-from tqdm import tqdm
-from data.utils import read_csv_as_dicts, flatten_dict
-from log import LogTimer
+from data.avc.audio_corpus import AudioCorpus
+from data.avc.augment import augment_batches
+from data.avc.bad_media import BadMediaRegistry, MediaDecodeError, is_decode_error
+from data.avc.cache import VideoFrameCache
+from data.avc.media_index import get_media_index_path, load_media_index, \
+    get_video_fps, get_num_frames
+from data.avc.partition import AudioPool, get_partition
+from data.avc.shards import ShardWriter, get_compression_kwargs
+from data.utils import flatten_dict
+from l3embedding.jitter import adjust_saturation, adjust_brightness
+from log import LogTimer, METRICS, TRACER
 
 LOGGER = logging.getLogger('sampling')
 LOGGER.setLevel(logging.ERROR)
 
-
-def adjust_saturation(rgb_img, factor):
-    """
-    Adjust the saturation of an RGB image
-
-    Args:
-        rgb_img: RGB image data array
-        factor: Multiplicative scaling factor to be applied to saturation
-
-    Returns:
-        adjusted_img: RGB image with adjusted saturation
-    """
-    hsv_img = skimage.color.rgb2hsv(rgb_img)
-    imin, imax = skimage.dtype_limits(hsv_img)
-    hsv_img[:,:,1] = np.clip(hsv_img[:,:,1] * factor, imin, imax)
-    return skimage.color.hsv2rgb(hsv_img)
-
-
-def adjust_brightness(rgb_img, delta):
-    """
-    Adjust the brightness of an RGB image
-
-    Args:
-        rgb_img: RGB image data array
-        delta: Additive (normalized) gain factor applied to each pixel
-
-    Returns:
-        adjusted_img: RGB image with adjusted saturation
-    """
-    imin, imax = skimage.dtype_limits(rgb_img)
-    # Convert delta into the range of the image data
-    delta = rgb_img.dtype.type((imax - imin) * delta)
-
-    return np.clip(rgb_img + delta, imin, imax)
+# Length of the shortest side of decoded video frames
+FRAME_MIN_SIDE = 256
 
 
 def horiz_flip(rgb_img):
@@ -200,7 +181,7 @@ def sample_one_frame(video_data, start=None, fps=30, augment=False):
         video_data: video data to sample from
 
     Keyword Args:
-        start: start frame of a one second window from which to sample
+        start: start time (seconds) of a one second window from which to sample
         fps: frame per second
         augment: if True, perturb the data in some fashion
 
@@ -217,8 +198,11 @@ def sample_one_frame(video_data, start=None, fps=30, augment=False):
         # Audio should always be sampled one second from the end of the audio,
         # so video frames we're sampling from should also be a second. If it's
         # not, then our video is probably less than a second
-        duration = min(fps, num_frames - start_frame)
-        if duration != fps:
+        # Frame rates may be fractional (e.g. 30000/1001), so the window is
+        # rounded to a whole number of frames
+        window = int(round(fps))
+        duration = min(window, num_frames - start_frame)
+        if duration != window:
             warnings.warn('Got video that is less than one second', UserWarning)
 
         if duration > 0:
@@ -234,11 +218,12 @@ def sample_one_frame(video_data, start=None, fps=30, augment=False):
     frame_data = video_data[frame]
     frame_data, bbox = sample_cropped_frame(frame_data)
 
-    frame_data = skimage.img_as_float(frame_data)
-
     video_aug_params = {'bounding_box': bbox}
 
     if augment:
+        # Jitter kernels operate on float32 data in [0, 1]
+        frame_data = np.divide(frame_data, 255, dtype=np.float32)
+
         # Randomly horizontally flip the image
         horizontal_flip = False
         if random.random() < 0.5:
@@ -278,12 +263,152 @@ def sample_one_frame(video_data, start=None, fps=30, augment=False):
             'brightness_delta': brightness_delta
         })
 
-    frame_data = skimage.img_as_ubyte(frame_data)
+        frame_data = skimage.img_as_ubyte(frame_data)
 
     return frame_data, frame, video_aug_params
 
 
-def read_video(video_path):
+def get_resized_shape(width, height):
+    """
+    Get the frame shape of a video after resizing so that the minimum side is
+    256 pixels
+
+    Args:
+        width: Width of video frames
+        height: Height of video frames
+
+    Returns:
+        new_width: Width of resized frames
+        new_height: Height of resized frames
+    """
+    scaling = float(FRAME_MIN_SIDE) / min(width, height)
+    new_width = math.ceil(scaling * width)
+    new_height = math.ceil(scaling * height)
+    return new_width, new_height
+
+
+def get_video_info(video_path, media_info=None):
+    """
+    Get the frame size, frame rate and number of frames of a video, from the
+    media index if available and otherwise by probing the video
+
+    Args:
+        video_path: Path to video file
+
+    Keyword Args:
+        media_info: If provided, media index entry for the video
+
+    Returns:
+        width: Width of video frames
+        height: Height of video frames
+        fps: Frames per second
+        num_frames: Number of frames
+    """
+    if media_info is not None:
+        return (media_info['width'], media_info['height'],
+                media_info['fps'], media_info['num_frames'])
+
+    try:
+        vinfo = ffprobe(video_path)['video']
+        return (int(vinfo['@width']), int(vinfo['@height']),
+                get_video_fps(vinfo), get_num_frames(vinfo))
+    except (KeyError, ValueError, ZeroDivisionError) as e:
+        # Missing or malformed stream metadata
+        err_msg = 'Could not probe video stream of {} - {}: {}'
+        raise MediaDecodeError(err_msg.format(video_path, type(e), e)) from e
+
+
+def read_frame(video_path, timestamp, width, height):
+    """
+    Decode a single resized video frame by seeking to the given timestamp
+
+    Args:
+        video_path: Path to video file
+        timestamp: Time (seconds) of the frame to decode
+        width: Width of the resized frame
+        height: Height of the resized frame
+
+    Returns:
+        frame: (height, width, 3) uint8 frame data array
+    """
+    # Seeking before the input is frame accurate when transcoding
+    cmd = [os.path.join(skvideo.getFFmpegPath(), 'ffmpeg'),
+           '-nostdin', '-loglevel', 'error',
+           '-ss', '{:.6f}'.format(timestamp),
+           '-i', video_path,
+           '-frames:v', '1',
+           '-s', '{}x{}'.format(width, height),
+           '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          check=True)
+
+    frame_size = width * height * 3
+    if len(proc.stdout) < frame_size:
+        err_msg = 'Could not decode frame at {} seconds from {}'
+        raise MediaDecodeError(err_msg.format(timestamp, video_path))
+
+    frame = np.frombuffer(proc.stdout, dtype=np.uint8, count=frame_size)
+    return frame.reshape((height, width, 3))
+
+
+class SparseVideo(object):
+    """
+    A video whose frames are only decoded when they are accessed.
+
+    Frames are decoded individually by seeking ffmpeg directly to their
+    timestamps, so only the frames that are actually sampled are decoded and
+    kept in memory.
+    """
+
+    def __init__(self, video_path, max_cached_frames=8, media_info=None):
+        """
+        Creates a sparse video reader.
+
+        Args:
+            video_path:  Path to video file
+                         (Type: str)
+
+        Keyword Args:
+            max_cached_frames:  Maximum number of decoded frames kept in
+                                memory
+                                (Type: int)
+
+            media_info:         If provided, media index entry for the video,
+                                used instead of probing the video
+                                (Type: dict or None)
+        """
+        width, height, self.fps, self.num_frames \
+            = get_video_info(video_path, media_info=media_info)
+        self.video_path = video_path
+        self.width, self.height = get_resized_shape(width, height)
+
+        self.max_cached_frames = max_cached_frames
+        self._frames = OrderedDict()
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.num_frames
+        if not 0 <= idx < self.num_frames:
+            raise IndexError('Frame index {} out of range'.format(idx))
+
+        if idx in self._frames:
+            self._frames.move_to_end(idx)
+            return self._frames[idx]
+
+        frame = read_frame(self.video_path, idx / self.fps,
+                           self.width, self.height)
+
+        self._frames[idx] = frame
+        if len(self._frames) > self.max_cached_frames:
+            self._frames.popitem(last=False)
+
+        return frame
+
+
+def read_video(video_path, frame_cache=None, media_info=None, decode_fps=None):
     """
     Read a video file as a numpy array
 
@@ -292,33 +417,161 @@ def read_video(video_path):
     Args:
         video_path: Path to video file
 
+    Keyword Args:
+        frame_cache: If provided, decoded frames are read from and stored in
+                     this cache
+                     (Type: data.avc.cache.VideoFrameCache or None)
+        media_info: If provided, media index entry for the video, used instead
+                    of probing the video
+                    (Type: dict or None)
+        decode_fps: If provided, frame rate at which the video is decoded.
+                    Frames are dropped by ffmpeg before they are resized, so
+                    frame i of the result is at time i / decode_fps.
+                    (Type: int or None)
+
     Returns:
-        video: Numpy data array
+        video: (n_frames, height, width, 3) uint8 data array
 
     """
-    vinfo = ffprobe(video_path)['video']
-    width = int(vinfo['@width'])
-    height = int(vinfo['@height'])
+    if decode_fps:
+        cache_key = '{}@{}fps'.format(FRAME_MIN_SIDE, decode_fps)
+    else:
+        cache_key = FRAME_MIN_SIDE
+
+    if frame_cache is not None:
+        frames = frame_cache.get(video_path, cache_key)
+        if frames is not None:
+            return frames
+
+    width, height, fps, num_frames = get_video_info(video_path, media_info=media_info)
+    new_width, new_height = get_resized_shape(width, height)
+
+    # Resize frames, decoding them straight into a single contiguous buffer.
+    # The buffer is grown geometrically if the frame count is too small.
+    cmd = [os.path.join(skvideo.getFFmpegPath(), 'ffmpeg'),
+           '-nostdin', '-loglevel', 'error',
+           '-i', video_path]
+    if decode_fps:
+        cmd += ['-vf', 'fps={}'.format(decode_fps)]
+        if fps > 0:
+            num_frames = int(np.ceil(num_frames * decode_fps / float(fps))) + 1
+    cmd += ['-s', '{}x{}'.format(new_width, new_height),
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+
+    frame_size = new_width * new_height * 3
+    capacity = max(num_frames, 1)
+    frames = np.empty((capacity, new_height, new_width, 3), dtype=np.uint8)
+    num_frames = 0
+    try:
+        while True:
+            if num_frames == capacity:
+                capacity *= 2
+                new_frames = np.empty((capacity, new_height, new_width, 3),
+                                      dtype=np.uint8)
+                new_frames[:num_frames] = frames
+                frames = new_frames
+
+            buf = memoryview(frames[num_frames]).cast('B')
+            num_bytes = 0
+            while num_bytes < frame_size:
+                n = proc.stdout.readinto(buf[num_bytes:])
+                if not n:
+                    break
+                num_bytes += n
+
+            if num_bytes < frame_size:
+                break
+            num_frames += 1
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+    if num_frames == 0:
+        raise MediaDecodeError('Could not decode any frames from {}'.format(video_path))
+
+    frames = frames[:num_frames]
+
+    if frame_cache is not None:
+        frames = frame_cache.put(video_path, cache_key, frames)
 
-    scaling = 256.0 / min(width, height)
-    new_width = math.ceil(scaling * width)
-    new_height = math.ceil(scaling * height)
+    return frames
 
-    # Resize frames
-    reader = FFmpegReader(video_path,
-                          outputdict={'-s': "{}x{}".format(new_width,
-                                                           new_height) })
 
-    frames = []
-    for frame in reader.nextFrame():
-        frames.append(frame)
-    reader.close()
-    return frames
+def read_audio(audio_path):
+    """
+    Read an audio file as mono 16-bit PCM
+
+    Args:
+        audio_path: Path to audio file
+
+    Returns:
+        audio_data: int16 audio data array
+        sampling_frequency: audio sample rate
+    """
+    audio_data, sampling_frequency = sf.read(audio_path, dtype='int16',
+                                             always_2d=True)
+    audio_data = audio_data.mean(axis=-1).astype('int16')
+    return audio_data, sampling_frequency
+
+
+class WindowedAudio(object):
+    """
+    An audio file whose samples are only read when they are accessed.
+
+    The length of the audio is taken from the file header, and slices are read
+    by seeking to their start, so reading a window of audio does not require
+    decoding the whole file. Formats that cannot seek are decoded in full on
+    first access.
+    """
+
+    def __init__(self, audio_path):
+        """
+        Creates a windowed audio reader.
+
+        Args:
+            audio_path:  Path to audio file
+                         (Type: str)
+        """
+        self.audio_path = audio_path
+        with sf.SoundFile(audio_path) as f:
+            self.sampling_frequency = f.samplerate
+            self.num_samples = f.frames
+            seekable = f.seekable()
+
+        self._data = None
+        if not seekable or self.num_samples <= 0:
+            self._data, _ = read_audio(audio_path)
+            self.num_samples = len(self._data)
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, idx):
+        if self._data is not None:
+            return self._data[idx]
+
+        if not isinstance(idx, slice) or idx.step not in (None, 1):
+            raise TypeError('Windowed audio only supports contiguous slices')
+
+        start, stop, _ = idx.indices(self.num_samples)
+        if stop <= start:
+            return np.zeros((0,), dtype='int16')
+
+        with sf.SoundFile(self.audio_path) as f:
+            f.seek(start)
+            audio_data = f.read(stop - start, dtype='int16', always_2d=True)
+
+        # Downmix in the same way as read_audio
+        return audio_data.mean(axis=-1).astype('int16')
 
 
 def generate_sample(audio_file_1, audio_data_1, audio_file_2, audio_data_2,
                     video_file_1, video_data_1, video_file_2, video_data_2,
-                    audio_sampling_frequency, augment=False, include_metadata=False):
+                    audio_sampling_frequency, augment=False, include_metadata=False,
+                    augment_video=None, video_fps_1=30, video_fps_2=30,
+                    decode_fps=None):
     """
     Generate a sample from the given audio and video files
 
@@ -329,7 +582,8 @@ def generate_sample(audio_file_1, audio_data_1, audio_file_2, audio_data_2,
     Args:
         audio_file_1: audio filename
         audio_data_1: audio data array
-        audio_file_2: audio filename
+        audio_file_2: audio filename. If None, a positive sample is produced
+                      from the first audio and video
         audio_data_2: audio data array
         video_file_1: video filename
         video_data_1: video data array
@@ -339,12 +593,26 @@ def generate_sample(audio_file_1, audio_data_1, audio_file_2, audio_data_2,
 
     Keyword Args
         augment: If True, perform data augmention
+        augment_video: If provided, overrides whether data augmentation is
+                       performed on the video frame
+        video_fps_1: native frame rate of video_data_1
+        video_fps_2: native frame rate of video_data_2
+        decode_fps: If provided, frame rate at which video_data_1 and
+                    video_data_2 were decoded. The sampled frame index is
+                    converted back to native frames.
 
     Returns:
         sample: sample dictionary
     """
-    video_choice = random.random() < 0.5
-    audio_choice = random.random() < 0.5
+    if augment_video is None:
+        augment_video = augment
+
+    if audio_file_2 is None:
+        # Only one clip, so produce a positive sample
+        video_choice = audio_choice = True
+    else:
+        video_choice = random.random() < 0.5
+        audio_choice = random.random() < 0.5
 
     if audio_choice:
         audio_file = audio_file_1
@@ -356,23 +624,39 @@ def generate_sample(audio_file_1, audio_data_1, audio_file_2, audio_data_2,
     if video_choice:
         video_file = video_file_1
         video_data = video_data_1
+        video_fps = video_fps_1
     else:
         video_file = video_file_2
         video_data = video_data_2
+        video_fps = video_fps_2
 
     label = int(video_choice != audio_choice)
 
     sample_audio_data, audio_start, audio_aug_params \
         = sample_one_second(audio_data, audio_sampling_frequency, augment=augment)
 
+    # Sample the frame from the same second as the audio
+    audio_start_time = audio_start / float(audio_sampling_frequency)
+    if decode_fps:
+        # Decoded frames are further apart, so start the window at the first
+        # decoded frame within the second of audio
+        video_start_time = (np.ceil(audio_start_time * decode_fps) + 0.5) / decode_fps
+    else:
+        video_start_time = audio_start_time
     sample_video_data, video_start, video_aug_params \
-        = sample_one_frame(video_data, start=audio_start, augment=augment)
+        = sample_one_frame(video_data, start=video_start_time,
+                           fps=decode_fps or video_fps, augment=augment_video)
+    if decode_fps:
+        # Report the frame index at the native frame rate for compatibility
+        video_start = int(round(video_start * video_fps / float(decode_fps)))
 
     sample_audio_data = sample_audio_data.reshape((1, sample_audio_data.shape[0]))
 
+    # Copy the frame and audio, since they may be views of decoded media held
+    # by the shared media pool, which must not be kept alive by the sample
     sample = {
-        'video': np.ascontiguousarray(sample_video_data),
-        'audio': np.ascontiguousarray(sample_audio_data),
+        'video': np.array(sample_video_data, order='C'),
+        'audio': np.array(sample_audio_data, order='C'),
         'label': np.ascontiguousarray(np.array([label, 1 - label])),
     }
 
@@ -387,19 +671,44 @@ def generate_sample(audio_file_1, audio_data_1, audio_file_2, audio_data_2,
     return sample
 
 
-def sampler(video_1, video_2, rate=32, augment=False, precompute=False, include_metadata=False):
+def sampler(video_1, video_2, rate=32, augment=False, precompute=False,
+            include_metadata=False, frame_cache=None, sparse_video=False,
+            augment_video=None, media_pool=None, audio_corpus=None,
+            windowed_audio=False, media_index=None, bad_media=None,
+            decode_fps=None):
     """Sample one frame from video_file, with 50% chance sample one second from corresponding audio_file,
        50% chance sample one second from another audio_file in the list of audio_files.
 
     Args:
         video_1: dict for candidate video to sample from
-        video_2: dict for candidate video to sample from
+        video_2: dict for candidate video to sample from. If None, only
+                 positive samples with aligned video and audio are produced
+                 from video_1
 
     Keyword Args:
         rate: Poisson rate parameter. Used for precomputing samples
         augment: If True, perform data augmention
         precompute: If True, precompute samples during initialization so that
                     memory can be discarded
+        frame_cache: If provided, cache of decoded video frames
+        sparse_video: If True, only decode the sampled video frames by seeking
+                      to them instead of decoding the whole video
+        augment_video: If provided, overrides whether data augmentation is
+                       performed on video frames
+        media_pool: If provided, pool of decoded media shared between
+                    processes
+        audio_corpus: If provided, packed audio corpus from which audio is
+                      read instead of decoding audio files
+        windowed_audio: If True, only read the sampled windows of audio by
+                        seeking to them instead of decoding the whole file
+        media_index: If provided, dictionary mapping video paths to probed
+                     media properties, used instead of probing the videos
+        bad_media: If provided, registry of media files that could not be
+                   decoded. Streamers with known bad media are skipped, and
+                   files that fail to open are added to the registry.
+        decode_fps: If provided, videos are decoded at this frame rate
+                    instead of their native frame rate. Not used with sparse
+                    videos, which only decode the sampled frames.
 
     Returns:
         A generator that yields dictionary of video sample, audio sample,
@@ -407,77 +716,180 @@ def sampler(video_1, video_2, rate=32, augment=False, precompute=False, include_
 
     """
     video_file_1 = video_1['video_filepath']
-    video_file_2 = video_2['video_filepath']
     audio_file_1 = video_1['audio_filepath']
-    audio_file_2 = video_2['audio_filepath']
+    if video_2 is not None:
+        video_file_2 = video_2['video_filepath']
+        audio_file_2 = video_2['audio_filepath']
+    else:
+        video_file_2 = None
+        audio_file_2 = None
 
     debug_msg = 'Initializing streamer with videos "{}" and "{}"'
     LOGGER.debug(debug_msg.format(video_file_1, video_file_2))
 
+    if bad_media is not None:
+        # Another streamer may have found bad media since this one was created
+        for media_path in (video_file_1, video_file_2, audio_file_1, audio_file_2):
+            if media_path is not None and media_path in bad_media:
+                LOGGER.debug('Skipping known bad media file {}'.format(media_path))
+                return
+
     # Hack: choose a number of samples such that we with high probability, we
     #       won't run out of samples, but is also less than the entire length of
     #       the video so we don't have to resize all of the frames
     num_samples = int(scipy.stats.poisson.ppf(0.999, rate))
 
 
+    if sparse_video:
+        decode_video = SparseVideo
+        decode_fps = None
+    else:
+        decode_video = partial(read_video, frame_cache=frame_cache,
+                               decode_fps=decode_fps)
+
+    # Keys of media acquired from the shared media pool
+    media_keys = []
+
+    def get_media_info(video_path):
+        if media_index is None:
+            return None
+        return media_index.get(video_path)
+
+    def load_video(video_path):
+        media_info = get_media_info(video_path)
+        if media_pool is None or sparse_video:
+            return decode_video(video_path, media_info=media_info)
+
+        key = 'video:' + os.path.abspath(video_path)
+        if decode_fps:
+            key += '@{}fps'.format(decode_fps)
+        video_data, _ = media_pool.acquire(
+            key, lambda: (decode_video(video_path, media_info=media_info), None))
+        media_keys.append(key)
+        return video_data
+
+    def get_fps(video_path, video_data):
+        # Probed frame rates may be fractional, e.g. for sparse videos or when
+        # decoding at a reduced frame rate, so sample_one_frame rounds its
+        # one second window to whole frames
+        media_info = get_media_info(video_path)
+        if media_info is not None:
+            return media_info['fps']
+        if decode_fps:
+            # Needed to convert sampled frames back to native frames
+            return get_video_info(video_path)[2]
+        # Sparse videos are probed when they are opened
+        return getattr(video_data, 'fps', 30)
+
+    def load_audio(audio_path):
+        if audio_corpus is not None and audio_path in audio_corpus:
+            return audio_corpus.get(audio_path)
+
+        if windowed_audio:
+            audio_data = WindowedAudio(audio_path)
+            return audio_data, audio_data.sampling_frequency
+
+        if media_pool is None:
+            return read_audio(audio_path)
+
+        key = 'audio:' + os.path.abspath(audio_path)
+        audio_data, sampling_frequency = media_pool.acquire(
+            key, partial(read_audio, audio_path))
+        media_keys.append(key)
+        return audio_data, sampling_frequency
+
+    def release_media():
+        for key in media_keys:
+            media_pool.release(key)
+        del media_keys[:]
+
     try:
         with LogTimer(LOGGER, 'Reading video'):
-            video_data_1 = read_video(video_file_1)
+            video_data_1 = load_video(video_file_1)
     except Exception as e:
         warn_msg = 'Could not open video file {} - {}: {}; Skipping...'
         warn_msg = warn_msg.format(video_file_1, type(e), e)
         LOGGER.warning(warn_msg)
         warnings.warn(warn_msg)
-        raise StopIteration()
+        if bad_media is not None and is_decode_error(e):
+            bad_media.add(video_file_1, '{}: {}'.format(type(e).__name__, e))
+        release_media()
+        return
 
-    try:
-        with LogTimer(LOGGER, 'Reading video'):
-            video_data_2 = read_video(video_file_2)
-    except Exception as e:
-        warn_msg = 'Could not open video file {} - {}: {}; Skipping...'
-        warn_msg = warn_msg.format(video_file_2, type(e), e)
-        LOGGER.warning(warn_msg)
-        warnings.warn(warn_msg)
-        raise StopIteration()
+    if video_2 is None:
+        video_data_2 = None
+    else:
+        try:
+            with LogTimer(LOGGER, 'Reading video'):
+                video_data_2 = load_video(video_file_2)
+        except Exception as e:
+            warn_msg = 'Could not open video file {} - {}: {}; Skipping...'
+            warn_msg = warn_msg.format(video_file_2, type(e), e)
+            LOGGER.warning(warn_msg)
+            warnings.warn(warn_msg)
+            if bad_media is not None and is_decode_error(e):
+                bad_media.add(video_file_2, '{}: {}'.format(type(e).__name__, e))
+            release_media()
+            return
 
     try:
         with LogTimer(LOGGER, 'Reading audio'):
-            audio_data_1, sampling_frequency = sf.read(audio_file_1,
-                                                       dtype='int16',
-                                                       always_2d=True)
-            audio_data_1 = audio_data_1.mean(axis=-1).astype('int16')
+            audio_data_1, sampling_frequency = load_audio(audio_file_1)
 
     except Exception as e:
         warn_msg = 'Could not open audio file {} - {}: {}; Skipping...'
         warn_msg = warn_msg.format(audio_file_1, type(e), e)
         LOGGER.warning(warn_msg)
         warnings.warn(warn_msg)
-        raise StopIteration()
+        if bad_media is not None and is_decode_error(e):
+            bad_media.add(audio_file_1, '{}: {}'.format(type(e).__name__, e))
+        release_media()
+        return
 
-    try:
-        with LogTimer(LOGGER, 'Reading audio'):
-            audio_data_2, sampling_frequency = sf.read(audio_file_2,
-                                                       dtype='int16',
-                                                       always_2d=True)
-            audio_data_2 = audio_data_2.mean(axis=-1).astype('int16')
-    except Exception as e:
-        warn_msg = 'Could not open audio file {} - {}: {}; Skipping...'
-        warn_msg = warn_msg.format(audio_file_2, type(e), e)
-        LOGGER.warning(warn_msg)
-        warnings.warn(warn_msg)
-        raise StopIteration()
+    if video_2 is None:
+        audio_data_2 = None
+    else:
+        try:
+            with LogTimer(LOGGER, 'Reading audio'):
+                audio_data_2, sampling_frequency = load_audio(audio_file_2)
+        except Exception as e:
+            warn_msg = 'Could not open audio file {} - {}: {}; Skipping...'
+            warn_msg = warn_msg.format(audio_file_2, type(e), e)
+            LOGGER.warning(warn_msg)
+            warnings.warn(warn_msg)
+            if bad_media is not None and is_decode_error(e):
+                bad_media.add(audio_file_2, '{}: {}'.format(type(e).__name__, e))
+            release_media()
+            return
+
+    video_fps_1 = get_fps(video_file_1, video_data_1)
+    if video_2 is None:
+        video_fps_2 = None
+    else:
+        video_fps_2 = get_fps(video_file_2, video_data_2)
 
     if precompute:
         samples = []
         for _ in range(num_samples):
-            sample = generate_sample(
-                audio_file_1, audio_data_1, audio_file_2, audio_data_2,
-                video_file_1, video_data_1, video_file_2, video_data_2,
-                sampling_frequency, augment=augment, include_metadata=include_metadata)
+            try:
+                sample = generate_sample(
+                    audio_file_1, audio_data_1, audio_file_2, audio_data_2,
+                    video_file_1, video_data_1, video_file_2, video_data_2,
+                    sampling_frequency, augment=augment, include_metadata=include_metadata,
+                    augment_video=augment_video, video_fps_1=video_fps_1,
+                    video_fps_2=video_fps_2, decode_fps=decode_fps)
+            except (IOError, subprocess.CalledProcessError) as e:
+                # Frames are decoded on demand when using sparse videos
+                warn_msg = 'Could not decode frame - {}: {}; Skipping...'
+                warn_msg = warn_msg.format(type(e), e)
+                LOGGER.warning(warn_msg)
+                warnings.warn(warn_msg)
+                break
 
             samples.append(sample)
 
         # Clear the data from memory
+        release_media()
         video_data_1 = None
         video_data_2 = None
         audio_data_1 = None
@@ -495,19 +907,240 @@ def sampler(video_1, video_2, rate=32, augment=False, precompute=False, include_
             # Yield the sample, and remove from the list to free up some memory
             yield samples.pop()
     else:
-        while True:
-            yield generate_sample(
-                audio_file_1, audio_data_1, audio_file_2, audio_data_2,
-                video_file_1, video_data_1, video_file_2, video_data_2,
-                sampling_frequency, augment=augment, include_metadata=include_metadata)
+        try:
+            while True:
+                try:
+                    sample = generate_sample(
+                        audio_file_1, audio_data_1, audio_file_2, audio_data_2,
+                        video_file_1, video_data_1, video_file_2, video_data_2,
+                        sampling_frequency, augment=augment, include_metadata=include_metadata,
+                        augment_video=augment_video, video_fps_1=video_fps_1,
+                        video_fps_2=video_fps_2, decode_fps=decode_fps)
+                except (IOError, subprocess.CalledProcessError) as e:
+                    # Frames are decoded on demand when using sparse videos
+                    warn_msg = 'Could not decode frame - {}: {}; Skipping...'
+                    warn_msg = warn_msg.format(type(e), e)
+                    LOGGER.warning(warn_msg)
+                    warnings.warn(warn_msg)
+                    return
+
+                yield sample
+        finally:
+            # Runs when the streamer is exhausted or deactivated by the mux
+            release_media()
+
+
+
+class PathTable(object):
+    """
+    Compact append-only list of paths, stored as a single UTF-8 byte string
+    with an array of offsets instead of as separate Python strings.
+    """
+
+    def __init__(self):
+        self._data = bytearray()
+        self._offsets = array.array('q', [0])
 
-    raise StopIteration()
+    def append(self, path):
+        self._data.extend(path.encode('utf-8'))
+        self._offsets.append(len(self._data))
 
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        start, end = self._offsets[idx], self._offsets[idx + 1]
+        return self._data[start:end].decode('utf-8')
+
+
+class StreamerSequence(object):
+    """
+    Lazy sequence of sampler streamers for every (video, distractor) pair.
+
+    Behaves like a shuffled list of ``num_distractors`` streamers per video,
+    each pairing the video with a different random video, but only stores
+    the video indices. Streamers are created when they are accessed, so
+    pescador.Mux only holds streamers for its active streams. The distractor
+    for each pair is drawn from an RNG seeded with the pair index, so a
+    streamer always samples from the same pair of videos. If pairs is False,
+    there is a single streamer for each video, with no distractor.
+    """
+
+    def __init__(self, video_paths, audio_paths, indices, num_distractors=1,
+                 random_state=20171021, pairs=True, **sampler_kwargs):
+        """
+        Creates a lazy streamer sequence.
+
+        Args:
+            video_paths:      Video paths of the subset
+                              (Type: PathTable)
+
+            audio_paths:      Audio paths of the subset
+                              (Type: PathTable)
+
+            indices:          Indices of the videos in the path tables to use
+                              (Type: np.ndarray)
+
+        Keyword Args:
+            num_distractors:  Number of pairs to generate a stream for each
+                              video
+                              (Type: int)
+
+            random_state:     Value used to initialize state of RNG
+                              (Type: int)
+
+            pairs:            If False, streamers sample from a single video
+                              (Type: bool)
+
+            **sampler_kwargs: Keyword arguments passed to the sampler
+        """
+        if len(indices) < 2:
+            raise ValueError('Need at least two videos to sample pairs')
+
+        if not pairs:
+            num_distractors = 1
+
+        self.video_paths = video_paths
+        self.audio_paths = audio_paths
+        self.indices = indices
+        self.pairs = pairs
+        self.num_distractors = num_distractors
+        self.random_state = random_state
+        self.sampler_kwargs = sampler_kwargs
+
+        num_pairs = len(indices) * num_distractors
+        dtype = np.int32 if num_pairs < 2**31 else np.int64
+        self._order = np.random.RandomState(random_state).permutation(num_pairs).astype(dtype)
+
+    def __len__(self):
+        return len(self._order)
+
+    def _get_video(self, idx):
+        idx = self.indices[idx]
+        return {
+            'video_filepath': self.video_paths[idx],
+            'audio_filepath': self.audio_paths[idx],
+        }
+
+    def __getitem__(self, idx):
+        pair_idx = int(self._order[idx])
+        idx_1 = pair_idx // self.num_distractors
+
+        if not self.pairs:
+            return pescador.Streamer(sampler, self._get_video(idx_1), None,
+                                     **self.sampler_kwargs)
+
+        # Pick a different video uniformly at random
+        rng = np.random.RandomState([self.random_state % 2**32, pair_idx])
+        idx_2 = rng.randint(len(self.indices) - 1)
+        if idx_2 >= idx_1:
+            idx_2 += 1
+
+        return pescador.Streamer(sampler, self._get_video(idx_1),
+                                 self._get_video(idx_2), **self.sampler_kwargs)
+
+
+def make_in_batch_negatives(batch, include_metadata=False):
+    """
+    Turn half of a batch of positive samples into negative samples by
+    exchanging audio between samples from different clips
+
+    All of the audio fields (the audio data and audio metadata) of each
+    negative sample are replaced with those of another sample in the batch, so
+    the metadata stays consistent with the data.
+
+    Args:
+        batch: Batch dictionary of positive samples, including metadata
+
+    Keyword Args:
+        include_metadata: If False, metadata fields are removed from the batch
+
+    Returns:
+        batch: Batch dictionary with about half negative samples
+    """
+    batch_size = len(batch['label'])
+    audio_files = batch['audio_file']
+
+    neg_idxs = np.zeros((0,), dtype=int)
+    src_idxs = neg_idxs
+    for _ in range(10):
+        # Give each chosen sample the audio of the next chosen sample
+        idxs = np.random.permutation(batch_size)[:batch_size // 2]
+        shifted_idxs = np.roll(idxs, 1)
+        valid = audio_files[idxs] != audio_files[shifted_idxs]
+        if valid.sum() > len(neg_idxs):
+            neg_idxs, src_idxs = idxs[valid], shifted_idxs[valid]
+        if valid.all():
+            break
+
+    if len(neg_idxs) < batch_size // 2:
+        LOGGER.debug('Only made {} of {} in-batch negatives'.format(
+            len(neg_idxs), batch_size // 2))
+
+    for key in batch:
+        if key.startswith('audio'):
+            batch[key][neg_idxs] = batch[key][src_idxs]
+    batch['label'][neg_idxs] = [1, 0]
+
+    if not include_metadata:
+        batch = {key: batch[key] for key in ('video', 'audio', 'label')}
+
+    return batch
+
+
+def add_audio_pool_negatives(batch, audio_pool, fraction, augment=False):
+    """
+    Replace the audio of some negative samples with audio from the pool of
+    audio extracted by other partitions
+
+    Args:
+        batch: Batch dictionary
+        audio_pool: Pool of audio windows from other partitions
+        fraction: Probability of replacing the audio of each negative sample
+
+    Keyword Args:
+        augment: If True, perform data augmentation on the pool audio
+
+    Returns:
+        batch: Batch dictionary
+    """
+    neg_idxs = np.nonzero(batch['label'][:, 0] == 1)[0]
+    neg_idxs = neg_idxs[np.random.random(len(neg_idxs)) < fraction]
+    if len(neg_idxs) == 0:
+        return batch
+
+    pool_idxs = np.random.randint(len(audio_pool), size=len(neg_idxs))
+
+    if 'audio_file' in batch:
+        # Make sure the pool filenames fit in the filename array
+        itemsize = max(batch['audio_file'].dtype.itemsize,
+                       audio_pool.audio_file.dtype.itemsize)
+        batch['audio_file'] = batch['audio_file'].astype('S{}'.format(itemsize))
+
+    for idx, pool_idx in zip(neg_idxs, pool_idxs):
+        audio_data, _, audio_aug_params = sample_one_second(
+            audio_pool.audio[pool_idx], audio_pool.sr, augment=augment)
+        batch['audio'][idx] = audio_data.reshape((1, -1))
+
+        if 'audio_file' in batch:
+            batch['audio_file'][idx] = audio_pool.audio_file[pool_idx]
+        if 'audio_start_sample_idx' in batch:
+            batch['audio_start_sample_idx'][idx] = audio_pool.audio_start_sample_idx[pool_idx]
+        for key, value in flatten_dict(audio_aug_params, 'audio').items():
+            if key in batch:
+                batch[key][idx] = value
+
+    return batch
 
 
 def data_generator(subset_path, k=32, batch_size=64, random_state=20171021,
                    precompute=False, num_distractors=1, augment=False, rate=32,
-                   max_videos=None, include_metadata=False, cycle=True):
+                   max_videos=None, include_metadata=False, cycle=True,
+                   frame_cache=None, sparse_video=False, batch_augment=False,
+                   media_pool=None, audio_corpus=None, windowed_audio=False,
+                   use_media_index=True, bad_media=None,
+                   in_batch_negatives=False, partition=None, audio_pool=None,
+                   decode_fps=None):
     """Sample video and audio from data_dir, returns a streamer that yield samples infinitely.
 
     Args:
@@ -516,6 +1149,31 @@ def data_generator(subset_path, k=32, batch_size=64, random_state=20171021,
         batch_size: batch size
         random_state: Value used to initialize state of RNG
         num_distractors: Number of pairs to generate a stream for each video
+        frame_cache: If provided, cache of decoded video frames
+        sparse_video: If True, only decode the sampled video frames
+        batch_augment: If True and augment is True, augment video frames for
+                       a whole batch at once instead of for each sample
+        media_pool: If provided, pool of decoded media shared between
+                    processes
+        audio_corpus: If provided, packed audio corpus from which audio is
+                      read
+        windowed_audio: If True, only read the sampled windows of audio
+        use_media_index: If True and a media index exists next to the subset
+                         file, use it instead of probing videos and skip
+                         items that are not in the index
+        bad_media: If provided, registry of media files that could not be
+                   decoded. Items with known bad media are skipped.
+        in_batch_negatives: If True, each streamer samples aligned video and
+                            audio from a single clip, and negative samples
+                            are made by exchanging audio between clips within
+                            each batch
+        partition: If provided, (partition index, number of partitions) tuple.
+                   Only videos owned by the partition are sampled.
+        audio_pool: If provided, pool of audio from other partitions, used for
+                    the share of negative samples that would have audio from
+                    videos in other partitions
+        decode_fps: If provided, videos are decoded at this frame rate
+                    instead of their native frame rate
 
     Returns:
         A generator that yield infinite video and audio samples from data_dir
@@ -526,31 +1184,82 @@ def data_generator(subset_path, k=32, batch_size=64, random_state=20171021,
     np.random.seed(random_state)
 
 
+    media_index_path = get_media_index_path(subset_path)
+    if use_media_index and os.path.exists(media_index_path):
+        LOGGER.info("Loading media index")
+        media_index = load_media_index(media_index_path)
+    else:
+        media_index = None
+
+    # Read the registry once, rather than checking the file for every item
+    if bad_media is not None:
+        bad_media_paths = bad_media.get_paths()
+    else:
+        bad_media_paths = frozenset()
+
     LOGGER.info("Loading subset list")
-    file_list = read_csv_as_dicts(subset_path)
+    video_paths = PathTable()
+    audio_paths = PathTable()
+    num_skipped_index = 0
+    num_skipped_bad = 0
+    with open(subset_path, 'r') as f:
+        for item in csv.DictReader(f):
+            video_path = item['video_filepath']
+            audio_path = item['audio_filepath']
+
+            if partition is not None and get_partition(video_path, partition[1]) != partition[0]:
+                continue
+
+            # Skip broken or short media that was dropped from the index
+            if media_index is not None and video_path not in media_index:
+                num_skipped_index += 1
+                continue
+
+            if video_path in bad_media_paths or audio_path in bad_media_paths:
+                num_skipped_bad += 1
+                continue
+
+            video_paths.append(video_path)
+            audio_paths.append(audio_path)
+
+    if num_skipped_index:
+        LOGGER.info("Skipping {} videos not in the media index".format(num_skipped_index))
+    if num_skipped_bad:
+        LOGGER.info("Skipping {} videos with known bad media".format(num_skipped_bad))
 
     LOGGER.info("Creating streamers...")
-    if max_videos is not None and max_videos < len(file_list):
+    num_videos = len(video_paths)
+    if max_videos is not None and max_videos < num_videos:
         LOGGER.info("Using a subset of {} videos".format(max_videos))
-        random.shuffle(file_list)
-        file_list = file_list[:max_videos]
-
-    seeds = []
-    for video_1 in tqdm(file_list):
-        for _ in range(num_distractors):
-            video_2 = video_1
-            # Make sure we sample a different file
-            while video_2 == video_1:
-                video_2 = random.choice(file_list)
-
-            streamer = pescador.Streamer(sampler, video_1, video_2,
-                                         rate=rate, augment=augment,
-                                         precompute=precompute,
-                                         include_metadata=include_metadata)
-            seeds.append(streamer)
-
-    # Randomly shuffle the seeds
-    random.shuffle(seeds)
+        indices = np.random.permutation(num_videos)[:max_videos]
+    else:
+        indices = np.arange(num_videos)
+
+    # Video augmentation is deferred until the samples are batched
+    batch_augment = batch_augment and augment and batch_size > 1
+    augment_video = augment and not batch_augment
+
+    if in_batch_negatives and batch_size < 2:
+        raise ValueError('In-batch negatives require a batch size of at least 2')
+
+    # Streamers are created lazily as the mux activates them
+    seeds = StreamerSequence(video_paths, audio_paths, indices,
+                             num_distractors=num_distractors,
+                             random_state=random_state,
+                             pairs=not in_batch_negatives,
+                             rate=rate, augment=augment,
+                             precompute=precompute,
+                             # Metadata is needed to pair clips within batches
+                             include_metadata=include_metadata or in_batch_negatives,
+                             frame_cache=frame_cache,
+                             sparse_video=sparse_video,
+                             augment_video=augment_video,
+                             media_pool=media_pool,
+                             audio_corpus=audio_corpus,
+                             windowed_audio=windowed_audio,
+                             media_index=media_index,
+                             bad_media=bad_media,
+                             decode_fps=decode_fps)
 
     mux = pescador.Mux(seeds, k, rate=rate, random_state=random_state)
     if cycle:
@@ -558,20 +1267,78 @@ def data_generator(subset_path, k=32, batch_size=64, random_state=20171021,
 
     if batch_size == 1:
         return mux
-    else:
-        return pescador.maps.buffer_stream(mux, batch_size)
 
-
-def write_to_h5(path, batch):
+    batches = pescador.maps.buffer_stream(mux, batch_size)
+    if in_batch_negatives:
+        batches = (make_in_batch_negatives(batch, include_metadata=include_metadata)
+                   for batch in batches)
+    if audio_pool is not None and len(audio_pool) > 0 and partition is not None:
+        # Under global sampling, this share of negatives would use audio from
+        # videos in other partitions
+        pool_fraction = (partition[1] - 1) / float(partition[1])
+        batches = (add_audio_pool_negatives(batch, audio_pool, pool_fraction,
+                                            augment=augment)
+                   for batch in batches)
+    if batch_augment:
+        batches = augment_batches(batches, include_metadata=include_metadata)
+
+    return batches
+
+
+def write_to_h5(path, batch, compression='gzip'):
+    compression_kwargs = get_compression_kwargs(compression)
     with h5py.File(path, 'w') as f:
         for key in batch.keys():
-            f.create_dataset(key, data=batch[key], compression='gzip')
+            f.create_dataset(key, data=batch[key], **compression_kwargs)
 
 
 def sample_and_save(index, subset_path, num_batches, output_dir,
                     num_streamers=32, batch_size=64, random_state=20171021,
                     precompute=False, num_distractors=1, augment=False, rate=32,
-                    max_videos=None, include_metadata=False):
+                    max_videos=None, include_metadata=False,
+                    frame_cache_dir=None, frame_cache_size=None,
+                    sparse_video=False, batch_augment=False, media_pool=None,
+                    shard_size=None, chunk_size=None, compression='gzip',
+                    audio_corpus_dir=None, windowed_audio=False,
+                    use_media_index=True, bad_media_path=None,
+                    in_batch_negatives=False, partition_index=None,
+                    num_partitions=None, audio_pool_dir=None,
+                    audio_pool_timeout=3600, decode_fps=None,
+                    timing_metrics=False, trace_dir=None):
+    if timing_metrics:
+        # Only record the metrics of this worker
+        METRICS.reset()
+        METRICS.enabled = True
+
+    if trace_dir:
+        TRACER.start(trace_dir, process_name='Sampling worker {}'.format(index))
+
+    if frame_cache_dir:
+        frame_cache = VideoFrameCache(frame_cache_dir, max_size=frame_cache_size)
+    else:
+        frame_cache = None
+
+    if audio_corpus_dir:
+        audio_corpus = AudioCorpus(audio_corpus_dir)
+    else:
+        audio_corpus = None
+
+    if bad_media_path:
+        bad_media = BadMediaRegistry(bad_media_path)
+    else:
+        bad_media = None
+
+    if num_partitions and num_partitions > 1:
+        partition = (partition_index, num_partitions)
+    else:
+        partition = None
+
+    if partition is not None and audio_pool_dir:
+        audio_pool = AudioPool(audio_pool_dir, partition_index, num_partitions,
+                               timeout=audio_pool_timeout)
+    else:
+        audio_pool = None
+
     data_gen = data_generator(
         subset_path,
         batch_size=batch_size,
@@ -582,14 +1349,49 @@ def sample_and_save(index, subset_path, num_batches, output_dir,
         max_videos=max_videos,
         precompute=precompute,
         rate=rate,
-        include_metadata=include_metadata)
+        include_metadata=include_metadata,
+        frame_cache=frame_cache,
+        sparse_video=sparse_video,
+        batch_augment=batch_augment,
+        media_pool=media_pool,
+        audio_corpus=audio_corpus,
+        windowed_audio=windowed_audio,
+        use_media_index=use_media_index,
+        bad_media=bad_media,
+        in_batch_negatives=in_batch_negatives,
+        partition=partition,
+        audio_pool=audio_pool,
+        decode_fps=decode_fps)
 
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
 
-    for sub_index, batch in enumerate(data_gen):
-        batch_path = os.path.join(output_dir, '{}_{}_{}.h5'.format(random_state + index, index, sub_index))
-        write_to_h5(batch_path, batch)
+    prefix = '{}_{}'.format(random_state + index, index)
+    if shard_size:
+        # Append batches to large shard files
+        writer = ShardWriter(output_dir, prefix, shard_size=shard_size,
+                             chunk_size=chunk_size or batch_size,
+                             compression=compression)
+    else:
+        writer = None
 
-        if sub_index == (num_batches - 1):
-            break
+    try:
+        for sub_index, batch in enumerate(data_gen):
+            with LogTimer(LOGGER, 'Writing batch'):
+                if writer is not None:
+                    writer.write(batch)
+                else:
+                    batch_path = os.path.join(output_dir, '{}_{}.h5'.format(prefix, sub_index))
+                    write_to_h5(batch_path, batch, compression=compression)
+
+            if sub_index == (num_batches - 1):
+                break
+    finally:
+        if writer is not None:
+            writer.close()
+        if trace_dir:
+            # Worker processes exit without running exit handlers
+            TRACER.stop()
+
+    if timing_metrics:
+        return METRICS.snapshot()
@@ -0,0 +1,300 @@
+import json
+import logging
+import os
+
+import h5py
+import numpy as np
+
+LOGGER = logging.getLogger('sampling')
+
+COMPRESSION_TYPES = ('none', 'gzip', 'lzf', 'blosc', 'zstd')
+
+
+def get_compression_kwargs(compression):
+    """
+    Get the h5py dataset keyword arguments for a compression filter
+
+    Args:
+        compression: Name of compression filter. One of 'none', 'gzip', 'lzf',
+                     'blosc' or 'zstd'. 'blosc' and 'zstd' require hdf5plugin.
+
+    Returns:
+        kwargs: Keyword arguments for h5py.Group.create_dataset
+    """
+    if compression in (None, 'none'):
+        return {}
+    elif compression in ('gzip', 'lzf'):
+        return {'compression': compression}
+    elif compression in ('blosc', 'zstd'):
+        try:
+            import hdf5plugin
+        except ImportError:
+            err_msg = 'Compression "{}" requires the hdf5plugin package'
+            raise ValueError(err_msg.format(compression))
+
+        if compression == 'blosc':
+            return dict(hdf5plugin.Blosc(cname='lz4', clevel=5,
+                                         shuffle=hdf5plugin.Blosc.SHUFFLE))
+        else:
+            return dict(hdf5plugin.Zstd(clevel=3))
+    else:
+        raise ValueError('Invalid compression type: {}'.format(compression))
+
+
+def get_index_path(output_dir, prefix):
+    """
+    Get the path of the shard index file for a shard writer
+
+    Args:
+        output_dir: Directory where shards are written
+        prefix: Shard filename prefix
+
+    Returns:
+        index_path: Path to shard index file
+    """
+    return os.path.join(output_dir, prefix + '_index.json')
+
+
+def write_json_atomic(path, obj):
+    """
+    Write an object to a JSON file, replacing the file atomically
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class ShardWriter(object):
+    """
+    Appends batches of samples to large chunked HDF5 shard files.
+
+    Each dataset is chunked along the sample axis with the given chunk size,
+    which should match the training batch size so that training batches can
+    be read with few chunk decompressions. Once a shard holds at least
+    shard_size samples, a new shard is started. An index of shard filenames
+    and sample counts is kept next to the shards.
+    """
+
+    def __init__(self, output_dir, prefix, shard_size=16384, chunk_size=64,
+                 compression='lzf'):
+        """
+        Creates a shard writer.
+
+        Args:
+            output_dir:   Directory where shards are written
+                          (Type: str)
+
+            prefix:       Shard filename prefix, unique to this writer
+                          (Type: str)
+
+        Keyword Args:
+            shard_size:   Number of samples after which a new shard is started
+                          (Type: int)
+
+            chunk_size:   Number of samples per HDF5 chunk
+                          (Type: int)
+
+            compression:  Name of compression filter
+                          (Type: str)
+        """
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self._compression_kwargs = get_compression_kwargs(compression)
+
+        self.index_path = get_index_path(output_dir, prefix)
+        self.shards = []
+        self._file = None
+        self._num_samples = 0
+
+    def _open_shard(self):
+        fname = '{}_{}.h5'.format(self.prefix, len(self.shards))
+        self._file = h5py.File(os.path.join(self.output_dir, fname), 'w')
+        self._num_samples = 0
+        self.shards.append({'filename': fname, 'num_samples': 0})
+
+    def _create_dataset(self, key, data):
+        if data.dtype.kind in 'SO':
+            # Variable length strings, since lengths differ between batches
+            dtype = h5py.special_dtype(vlen=bytes)
+        else:
+            dtype = data.dtype
+
+        shape = data.shape[1:]
+        chunks = (min(self.chunk_size, self.shard_size),) + shape
+        return self._file.create_dataset(key, shape=(0,) + shape,
+                                         maxshape=(None,) + shape,
+                                         dtype=dtype, chunks=chunks,
+                                         **self._compression_kwargs)
+
+    def write(self, batch):
+        """
+        Append a batch of samples to the current shard
+
+        Args:
+            batch: Dictionary of sample arrays, with samples along the first
+                   axis
+        """
+        if self._file is None:
+            self._open_shard()
+
+        batch_size = None
+        for key, data in batch.items():
+            data = np.asarray(data)
+            if batch_size is None:
+                batch_size = data.shape[0]
+
+            if key in self._file:
+                dset = self._file[key]
+            else:
+                dset = self._create_dataset(key, data)
+
+            start_idx = self._num_samples
+            dset.resize(start_idx + batch_size, axis=0)
+            dset[start_idx:start_idx + batch_size] = data
+
+        self._num_samples += batch_size
+        self.shards[-1]['num_samples'] = self._num_samples
+        self._file.flush()
+
+        if self._num_samples >= self.shard_size:
+            self._close_shard()
+
+    def _close_shard(self):
+        self._file.close()
+        self._file = None
+        self.write_index()
+
+    def write_index(self):
+        """
+        Write the index of shard filenames and sample counts
+        """
+        write_json_atomic(self.index_path, {
+            'shards': self.shards,
+            'chunk_size': self.chunk_size,
+            'compression': self.compression,
+        })
+
+    def close(self):
+        """
+        Close the current shard and write the index
+        """
+        if self._file is not None:
+            self._close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, tb):
+        self.close()
+
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def build_manifest(data_dir):
+    """
+    Build a manifest of all sample files in a directory
+
+    Sample counts are taken from shard index files where available, and
+    otherwise read from the sample files. Files are listed in sorted order,
+    along with the offset of their first sample within the whole directory
+    and their size in bytes.
+
+    Args:
+        data_dir: Directory containing sample files
+
+    Returns:
+        manifest: Manifest dictionary
+    """
+    fnames = sorted(fname for fname in os.listdir(data_dir)
+                    if fname.endswith('.h5'))
+
+    # Use the counts recorded by shard writers to avoid opening the shards
+    counts = {}
+    for fname in os.listdir(data_dir):
+        if not fname.endswith('_index.json'):
+            continue
+        with open(os.path.join(data_dir, fname), 'r') as f:
+            index = json.load(f)
+        for shard in index['shards']:
+            counts[shard['filename']] = shard['num_samples']
+
+    shards = []
+    start_idx = 0
+    for fname in fnames:
+        path = os.path.join(data_dir, fname)
+        if fname in counts:
+            num_samples = counts[fname]
+        else:
+            with h5py.File(path, 'r') as f:
+                num_samples = len(f['label'])
+
+        shards.append({
+            'filename': fname,
+            'num_samples': num_samples,
+            'start_idx': start_idx,
+            'size_bytes': os.path.getsize(path),
+        })
+        start_idx += num_samples
+
+    return {'shards': shards, 'num_samples': start_idx}
+
+
+def write_manifest(data_dir):
+    """
+    Build and write the manifest of all sample files in a directory
+
+    Args:
+        data_dir: Directory containing sample files
+
+    Returns:
+        manifest: Manifest dictionary
+    """
+    manifest = build_manifest(data_dir)
+    write_json_atomic(os.path.join(data_dir, MANIFEST_FILENAME), manifest)
+    LOGGER.info('Wrote manifest of {} samples in {} files to {}'.format(
+        manifest['num_samples'], len(manifest['shards']), data_dir))
+    return manifest
+
+
+def load_manifest(data_dir):
+    """
+    Load the manifest of the sample files in a directory
+
+    Args:
+        data_dir: Directory containing sample files
+
+    Returns:
+        manifest: Manifest dictionary, or None if there is no manifest or the
+                  manifest does not match the sample files in the directory
+    """
+    manifest_path = os.path.join(data_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    fnames = set(fname for fname in os.listdir(data_dir) if fname.endswith('.h5'))
+    if fnames != set(shard['filename'] for shard in manifest['shards']):
+        LOGGER.warning('Manifest in {} is out of date; ignoring it'.format(data_dir))
+        return None
+
+    return manifest
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Write a manifest of the sample files in a directory')
+    parser.add_argument('data_dir',
+                        action='store',
+                        type=str,
+                        help='Path to directory where sample files are stored')
+    args = parser.parse_args()
+
+    write_manifest(args.data_dir)
@@ -5,6 +5,7 @@ import logging
 import random
 from audioset.ontology import ASOntology
 from collections import OrderedDict
+from data.avc.media_index import build_media_index
 from data.utils import read_csv_as_dicts
 
 LOGGER = logging.getLogger('data')
@@ -52,7 +53,8 @@ def load_metadata(metadata_path):
     return metadata
 
 
-def get_file_list(data_dir, metadata_path=None, filter_path=None, ontology_path=None):
+def get_file_list(data_dir, metadata_path=None, filter_path=None, ontology_path=None,
+                  probe_media=False, num_workers=8, min_duration=1.0):
     """Return audio and video file list.
 
     Args:
@@ -62,6 +64,11 @@ def get_file_list(data_dir, metadata_path=None, filter_path=None, ontology_path=
         metadata_path: Path to audioset metadata file
         filter_path: Path to filter specification file
         ontology_path: Path to AudioSet ontology file
+        probe_media: If True, probe the media of each file in parallel, add
+                     the properties to each item under 'media_info', and drop
+                     files that are broken or too short
+        num_workers: Number of processes used to probe media
+        min_duration: Minimum duration (seconds) of probed media
 
     Returns:
         audio_files: list of audio files
@@ -179,17 +186,29 @@ def get_file_list(data_dir, metadata_path=None, filter_path=None, ontology_path=
 
         file_list = filtered_file_list
 
+    if probe_media:
+        LOGGER.info('Probing media...')
+        media_index = build_media_index(file_list, num_workers=num_workers,
+                                        min_duration=min_duration)
+        file_list = [item for item in file_list
+                     if item['video_filepath'] in media_index]
+        for item in file_list:
+            item['media_info'] = media_index[item['video_filepath']]
+
     LOGGER.info('Total videos used: {}'.format(len(file_list)))
     return file_list
 
 
 def get_subset_split(data_dir, valid_ratio=0.1, test_ratio=0.1, random_state=12345678,
-                     metadata_path=None, filter_path=None, ontology_path=None):
+                     metadata_path=None, filter_path=None, ontology_path=None,
+                     probe_media=False, num_workers=8, min_duration=1.0):
     # Set random seed for reproducability
     random.seed(random_state)
 
     file_list = get_file_list(data_dir, metadata_path=metadata_path,
-                              filter_path=filter_path, ontology_path=ontology_path)
+                              filter_path=filter_path, ontology_path=ontology_path,
+                              probe_media=probe_media, num_workers=num_workers,
+                              min_duration=min_duration)
 
     # Shuffle file list
     random.shuffle(file_list)
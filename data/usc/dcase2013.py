@@ -59,7 +59,7 @@ def generate_dcase2013_fold_data(data_dir, fold_idx, output_dir, l3embedding_mod
     for idx, f in enumerate(files):
         fname = f.split('/')[-1]
         desc = '({}/{}) Processed {} -'.format(idx+1, num_files, fname)
-        with LogTimer(LOGGER, desc, log_level=logging.DEBUG):
+        with LogTimer(LOGGER, desc, log_level=logging.DEBUG, metric='Processing file'):
             generate_dcase2013_file_data(fname, audio_fold_dir, output_fold_dir,
                                      features, l3embedding_model, **feature_args)
 
@@ -45,7 +45,7 @@ def generate_esc50_fold_data(data_dir, fold_idx, output_dir, l3embedding_model=N
     for idx, f in enumerate(files):
         fname = f.split('/')[-1]
         desc = '({}/{}) Processed {} -'.format(idx+1, num_files, fname)
-        with LogTimer(LOGGER, desc, log_level=logging.DEBUG):
+        with LogTimer(LOGGER, desc, log_level=logging.DEBUG, metric='Processing file'):
             generate_esc50_file_data(fname, audio_fold_dir, output_fold_dir,
                                      features, l3embedding_model, **feature_args)
 
@@ -10,6 +10,7 @@ from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from .vggish import vggish_input
 from .vggish import vggish_postprocess
 from .vggish import vggish_slim
+from log import LogTimer
 
 LOGGER = logging.getLogger('cls-data-generation')
 LOGGER.setLevel(logging.DEBUG)
@@ -273,7 +274,8 @@ def get_l3_frames_uniform(audio, l3embedding_model, hop_size=0.1, sr=48000):
                    (Type: np.ndarray)
     """
     if type(audio) == str:
-        audio = load_audio(audio, sr)
+        with LogTimer(LOGGER, 'Loading audio'):
+            audio = load_audio(audio, sr)
 
     hop_size = hop_size
     hop_length = int(hop_size * sr)
@@ -301,7 +303,8 @@ def get_l3_frames_uniform(audio, l3embedding_model, hop_size=0.1, sr=48000):
     x = x.reshape((x.shape[0], 1, x.shape[-1]))
 
     # Get the L3 embedding for each frame
-    l3embedding = l3embedding_model.predict(x)
+    with LogTimer(LOGGER, 'Computing L3 embedding'):
+        l3embedding = l3embedding_model.predict(x)
 
     return l3embedding
 
@@ -316,7 +319,8 @@ def compute_file_features(path, feature_type, l3embedding_model=None, **feature_
                                               hop_size=hop_size)
     elif feature_type == 'vggish':
         hop_size = feature_args.get('hop_size', 0.1)
-        file_features = get_vggish_frames_uniform(path, hop_size=hop_size)
+        with LogTimer(LOGGER, 'Computing VGGish embedding'):
+            file_features = get_vggish_frames_uniform(path, hop_size=hop_size)
     else:
         raise ValueError('Invalid feature type: {}'.format(feature_type))
 
@@ -12,8 +12,9 @@ def read_csv_as_dicts(path):
 
     return items
 
-def map_iterate_in_parallel(iterable, function, processes=8):
-    pool = Pool(processes=processes)
+def map_iterate_in_parallel(iterable, function, processes=8, initializer=None,
+                            initargs=()):
+    pool = Pool(processes=processes, initializer=initializer, initargs=initargs)
     output = pool.map(function, iterable)
     return list(output)
 
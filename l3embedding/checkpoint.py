@@ -0,0 +1,328 @@
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+
+import h5py
+import keras
+import keras.backend as K
+import numpy as np
+import tensorflow as tf
+
+try:
+    from keras.engine.saving import save_weights_to_hdf5_group
+except ImportError:
+    # Keras < 2.2
+    from keras.engine.topology import save_weights_to_hdf5_group
+
+from log import LogTimer
+
+LOGGER = logging.getLogger('l3embedding')
+
+LATEST_FILENAME = 'model_latest.h5'
+# Monitored quantities, whether they should be maximized or minimized, and
+# the file the weights with their best value are saved to
+BEST_MONITORS = (
+    ('val_acc', 'max', 'model_best_valid_accuracy.h5'),
+    ('val_loss', 'min', 'model_best_valid_loss.h5'),
+)
+PERIODIC_FILENAME_FORMAT = 'model_checkpoint.{epoch:02d}.h5'
+PERIODIC_FILENAME_REGEX = re.compile(r'^model_checkpoint\.(\d+)\.h5$')
+
+
+def snapshot_weights(model):
+    """
+    Copy the weights of a model into memory
+
+    Args:
+        model:     Keras model
+                   (Type: keras.models.Model)
+
+    Returns:
+        snapshot:  Values of the weights of each layer, in order
+                   (Type: list[np.ndarray])
+    """
+    # Fetch all of the weights at once, rather than once per layer
+    return K.batch_get_value([w for layer in model.layers for w in layer.weights])
+
+
+class ShadowLayer(object):
+    """
+    Stands in for a layer of a model when writing weights with Keras
+    """
+
+    def __init__(self, name, weights):
+        self.name = name
+        self.weights = weights
+
+
+class WeightsWriter(object):
+    """
+    Writes snapshots of the weights of a model to HDF5 files with Keras' own
+    weights file writer, so they can be loaded with `model.load_weights`.
+
+    Snapshots are loaded into CPU copies of the model's variables and written
+    from those, so the model can keep training while weights are written.
+    """
+
+    def __init__(self, model):
+        """
+        Creates a weights writer. Must be created in the thread that builds
+        the model, since it adds the copies of the variables to the graph.
+
+        Args:
+            model:  Keras model
+                    (Type: keras.models.Model)
+        """
+        self.layers = []
+        self.variables = []
+        values = snapshot_weights(model)
+        idx = 0
+        with tf.device('/cpu:0'):
+            for layer in model.layers:
+                weights = []
+                for w in layer.weights:
+                    value = values[idx]
+                    weights.append(K.variable(value, dtype=value.dtype.name,
+                                              name=w.name.split(':')[0]))
+                    idx += 1
+                self.layers.append(ShadowLayer(layer.name, weights))
+                self.variables += weights
+
+        # Set the values once, so that the assign ops are also added to the
+        # graph in this thread
+        self._set_values(values)
+
+    def _set_values(self, snapshot):
+        K.batch_set_value(list(zip(self.variables, snapshot)))
+
+    def write(self, path, snapshot):
+        """
+        Write a snapshot of model weights to an HDF5 file
+
+        Args:
+            path:      Path to weights file
+                       (Type: str)
+
+            snapshot:  Snapshot of model weights, as returned by
+                       `snapshot_weights`
+                       (Type: list[np.ndarray])
+        """
+        self._set_values(snapshot)
+        with h5py.File(path, 'w') as f:
+            save_weights_to_hdf5_group(f, self.layers)
+            f.flush()
+
+
+def link_or_copy(src_path, dst_path):
+    """
+    Atomically replace a file with a hardlink to another file, falling back to
+    a copy if the filesystem does not support hardlinks
+
+    Args:
+        src_path:  Path to source file
+                   (Type: str)
+
+        dst_path:  Path to destination file
+                   (Type: str)
+    """
+    tmp_path = '{}.{}.tmp'.format(dst_path, os.getpid())
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+
+class AsyncCheckpointManager(keras.callbacks.Callback):
+    """
+    Keras callback that saves the latest weights, the weights with the best
+    value of each monitored quantity and periodic checkpoints of the weights.
+
+    At the end of each epoch where any checkpoint is due, the weights are
+    copied into memory once, and written to disk by a background thread. The
+    weights are written to a single file, and every checkpoint due for that
+    epoch is a hardlink to it. Files are always replaced rather than
+    rewritten, so the other checkpoints sharing the old file are unaffected.
+
+    At most one snapshot waits to be written, so if writing falls behind
+    training, the end of the epoch blocks until the previous snapshot is
+    written.
+    """
+
+    def __init__(self, model_dir, monitors=BEST_MONITORS,
+                 checkpoint_interval=10, keep_checkpoints=None, best_values=None,
+                 initial_epoch=0):
+        """
+        Creates a checkpoint manager.
+
+        Args:
+            model_dir:            Directory where checkpoints are saved
+                                  (Type: str)
+
+        Keyword Args:
+            monitors:             Sequence of (quantity, mode, filename)
+                                  tuples. For each quantity, the weights are
+                                  saved to the file when it improves, where
+                                  mode is 'max' or 'min'.
+                                  (Type: tuple[tuple[str, str, str]])
+
+            checkpoint_interval:  Number of epochs between periodic
+                                  checkpoints
+                                  (Type: int)
+
+            keep_checkpoints:     If provided, only the most recent periodic
+                                  checkpoints are kept
+                                  (Type: int or None)
+
+            best_values:          Dictionary of the best value of each
+                                  monitored quantity so far, used when
+                                  continuing training
+                                  (Type: dict[str, float] or None)
+
+            initial_epoch:        Epoch at which training starts, used to
+                                  keep the periodic checkpoints in step when
+                                  continuing training
+                                  (Type: int)
+        """
+        super(AsyncCheckpointManager, self).__init__()
+        if keep_checkpoints is not None and keep_checkpoints < 1:
+            raise ValueError('Number of checkpoints kept must be at least 1')
+
+        self.model_dir = model_dir
+        self.checkpoint_interval = checkpoint_interval
+        self.keep_checkpoints = keep_checkpoints
+        self.latest_path = os.path.join(model_dir, LATEST_FILENAME)
+
+        self.monitors = []
+        self.best = {}
+        for monitor, mode, fname in monitors:
+            if mode not in ('max', 'min'):
+                raise ValueError('Invalid monitor mode: "{}"'.format(mode))
+            self.monitors.append((monitor, mode, os.path.join(model_dir, fname)))
+            if best_values is not None and monitor in best_values:
+                self.best[monitor] = best_values[monitor]
+            else:
+                self.best[monitor] = -np.inf if mode == 'max' else np.inf
+
+        self.epochs_since_last_save = initial_epoch % checkpoint_interval
+
+        # Include periodic checkpoints that already exist in the retention
+        # policy, oldest first
+        existing = []
+        for fname in os.listdir(model_dir):
+            match = PERIODIC_FILENAME_REGEX.match(fname)
+            if match:
+                existing.append((int(match.group(1)), os.path.join(model_dir, fname)))
+        self.periodic_paths = [path for _, path in sorted(existing)]
+
+        self._queue = queue.Queue(maxsize=1)
+        self._writer = None
+        self._thread = None
+        self._error = None
+
+    def on_train_begin(self, logs=None):
+        self._writer = WeightsWriter(self.model)
+        self._thread = threading.Thread(target=self._write_loop,
+                                        name='Checkpoint writer', daemon=True)
+        self._thread.start()
+
+    def on_train_end(self, logs=None):
+        self.wait()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._check_error()
+        logs = logs or {}
+
+        paths = [self.latest_path]
+        for monitor, mode, best_path in self.monitors:
+            current = logs.get(monitor)
+            if current is None:
+                LOGGER.warning('Can save best model only with {} available, '
+                               'skipping.'.format(monitor))
+                continue
+
+            best = self.best[monitor]
+            if (mode == 'max' and current > best) or (mode == 'min' and current < best):
+                LOGGER.info('Epoch {}: {} improved from {:.5f} to {:.5f}'.format(
+                    epoch + 1, monitor, best, current))
+                self.best[monitor] = current
+                paths.append(best_path)
+
+        self.epochs_since_last_save += 1
+        if self.epochs_since_last_save >= self.checkpoint_interval:
+            self.epochs_since_last_save = 0
+            periodic_fname = PERIODIC_FILENAME_FORMAT.format(epoch=epoch + 1, **logs)
+            paths.append(os.path.join(self.model_dir, periodic_fname))
+
+        with LogTimer(LOGGER, 'Copying epoch {} weights'.format(epoch + 1),
+                      metric='Copying weights'):
+            snapshot = snapshot_weights(self.model)
+
+        # Blocks only if the previous snapshot has not started being written
+        self._queue.put((epoch, snapshot, paths))
+
+    def wait(self):
+        """
+        Wait for all pending checkpoints to be written, and stop the writer
+        thread
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._check_error()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Could not write checkpoint') from error
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            # Keep draining the queue after an error so training never blocks
+            if self._error is not None:
+                continue
+            try:
+                self._write(*item)
+            except Exception as e:
+                LOGGER.exception('Could not write checkpoint')
+                self._error = e
+
+    def _write(self, epoch, snapshot, paths):
+        tmp_path = os.path.join(self.model_dir, 'model_epoch_{}.{}.tmp.h5'.format(
+            epoch + 1, os.getpid()))
+        try:
+            with LogTimer(LOGGER, 'Writing epoch {} weights'.format(epoch + 1),
+                          metric='Writing weights'):
+                self._writer.write(tmp_path, snapshot)
+
+            for path in paths:
+                link_or_copy(tmp_path, path)
+                LOGGER.info('Epoch {}: saved weights to {}'.format(epoch + 1, path))
+                if PERIODIC_FILENAME_REGEX.match(os.path.basename(path)):
+                    self._retain(path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _retain(self, path):
+        if path in self.periodic_paths:
+            self.periodic_paths.remove(path)
+        self.periodic_paths.append(path)
+
+        if self.keep_checkpoints is None:
+            return
+
+        while len(self.periodic_paths) > self.keep_checkpoints:
+            old_path = self.periodic_paths.pop(0)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+                LOGGER.info('Removed old checkpoint {}'.format(old_path))
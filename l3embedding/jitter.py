@@ -0,0 +1,112 @@
+"""
+Fast color jitter kernels for RGB images.
+
+These are equivalent to adjusting saturation in HSV space with skimage, but
+work directly on RGB data in float32 (or uint8) without a round trip through
+float64 HSV. All functions accept a single (H, W, 3) image or a batch of
+(B, H, W, 3) images, in which case the jitter parameter can be given per image.
+"""
+import numpy as np
+
+
+def _expand_param(param, ndim, dtype):
+    """
+    Reshape a scalar or per-image parameter so that it broadcasts against
+    image data with the given number of dimensions
+    """
+    param = np.asarray(param, dtype=dtype)
+    return param.reshape(param.shape + (1,) * (ndim - param.ndim))
+
+
+def _adjust_saturation_float(rgb_img, factor):
+    """
+    Adjust saturation of float RGB data in [0, 1] in place
+    """
+    # Keeping hue and value (the max channel) fixed, each channel lies on a
+    # line between the value and the most saturated color, so scaling the
+    # saturation blends each channel with the value: c' = v - (v - c) * s'/s
+    value = rgb_img.max(axis=-1, keepdims=True)
+    chroma = value - rgb_img.min(axis=-1, keepdims=True)
+
+    # Ratio between new and old saturation, capped so saturation stays <= 1
+    factor = _expand_param(factor, rgb_img.ndim, rgb_img.dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.minimum(factor, value / chroma)
+    ratio[chroma == 0] = 1
+
+    np.subtract(value, rgb_img, out=rgb_img)
+    np.multiply(rgb_img, ratio, out=rgb_img)
+    np.subtract(value, rgb_img, out=rgb_img)
+    return rgb_img
+
+
+def _adjust_brightness_float(rgb_img, delta):
+    """
+    Adjust brightness of float RGB data in [0, 1] in place
+    """
+    delta = _expand_param(delta, rgb_img.ndim, rgb_img.dtype)
+    np.add(rgb_img, delta, out=rgb_img)
+    np.clip(rgb_img, 0, 1, out=rgb_img)
+    return rgb_img
+
+
+def _apply(kernel, rgb_img, param, out):
+    """
+    Apply a float jitter kernel to float or uint8 RGB data
+    """
+    if rgb_img.dtype == np.uint8:
+        img = rgb_img.astype(np.float32)
+        img /= 255
+        kernel(img, param)
+        img *= 255
+        np.rint(img, out=img)
+
+        if out is None:
+            return img.astype(np.uint8)
+        np.copyto(out, img, casting='unsafe')
+        return out
+
+    if out is None:
+        out = rgb_img.copy()
+    elif out is not rgb_img:
+        np.copyto(out, rgb_img)
+
+    return kernel(out, param)
+
+
+def adjust_saturation(rgb_img, factor, out=None):
+    """
+    Adjust the saturation of an RGB image
+
+    Args:
+        rgb_img: RGB image data array, either float in [0, 1] or uint8
+        factor: Multiplicative scaling factor to be applied to saturation,
+                either a scalar or one factor per image
+
+    Keyword Args:
+        out: If provided, array in which the result is stored. May be rgb_img.
+
+    Returns:
+        adjusted_img: RGB image with adjusted saturation, with the same dtype
+                      as rgb_img
+    """
+    return _apply(_adjust_saturation_float, rgb_img, factor, out)
+
+
+def adjust_brightness(rgb_img, delta, out=None):
+    """
+    Adjust the brightness of an RGB image
+
+    Args:
+        rgb_img: RGB image data array, either float in [0, 1] or uint8
+        delta: Additive (normalized) gain factor applied to each pixel, either
+               a scalar or one delta per image
+
+    Keyword Args:
+        out: If provided, array in which the result is stored. May be rgb_img.
+
+    Returns:
+        adjusted_img: RGB image with adjusted brightness, with the same dtype
+                      as rgb_img
+    """
+    return _apply(_adjust_brightness_float, rgb_img, delta, out)
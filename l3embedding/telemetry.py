@@ -0,0 +1,470 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import h5py
+import keras
+import numpy as np
+
+from log import MetricsRegistry, METRICS, TRACER
+
+LOGGER = logging.getLogger('l3embedding')
+
+TELEMETRY_FILENAME = 'telemetry.h5'
+
+# Columns of the per-batch and per-epoch telemetry tables
+BATCH_COLUMNS = (
+    ('epoch', 'int32'),
+    ('batch', 'int32'),
+    ('time', 'float64'),
+    ('batch_size', 'int32'),
+    ('data_wait', 'float32'),
+    ('step_time', 'float32'),
+)
+EPOCH_COLUMNS = (
+    ('epoch', 'int32'),
+    ('time', 'float64'),
+    ('num_samples', 'int64'),
+    ('train_time', 'float32'),
+    ('samples_per_sec', 'float32'),
+    ('data_wait', 'float32'),
+    ('step_time', 'float32'),
+    ('validation_time', 'float32'),
+    ('callback_time', 'float32'),
+)
+
+
+class ColumnarLog(object):
+    """
+    An append-only HDF5 log of tables, where each column of a table is stored
+    as a chunked, compressed dataset.
+    """
+
+    def __init__(self, path, tables, chunk_size=1024):
+        """
+        Creates a columnar log, appending to the file if it exists.
+
+        Args:
+            path:        Path to log file
+                         (Type: str)
+
+            tables:      Dictionary mapping table names to sequences of
+                         (column name, dtype) tuples
+                         (Type: dict[str, tuple])
+
+        Keyword Args:
+            chunk_size:  Number of rows per chunk
+                         (Type: int)
+        """
+        self.path = path
+        self.tables = tables
+        self.chunk_size = chunk_size
+
+    def append(self, table, rows):
+        """
+        Append rows to a table
+
+        Args:
+            table:  Name of the table
+                    (Type: str)
+
+            rows:   Dictionary mapping each column to a sequence of values
+                    (Type: dict[str, list])
+        """
+        num_rows = len(rows[self.tables[table][0][0]])
+        if num_rows == 0:
+            return
+
+        # The file is only open while writing, so it is readable during
+        # training and intact if training is killed
+        with h5py.File(self.path, 'a') as f:
+            group = f.require_group(table)
+            for column, dtype in self.tables[table]:
+                if column not in group:
+                    group.create_dataset(column, shape=(0,), maxshape=(None,),
+                                         dtype=dtype, chunks=(self.chunk_size,),
+                                         compression='lzf')
+                dset = group[column]
+                start = dset.shape[0]
+                dset.resize((start + num_rows,))
+                dset[start:] = np.asarray(rows[column], dtype=dtype)
+
+
+class MetricsServer(object):
+    """
+    A local HTTP server exposing training metrics.
+
+    Metrics are served in the Prometheus text format at /metrics, and as JSON
+    at /metrics.json.
+    """
+
+    def __init__(self, get_metrics, port, host='127.0.0.1'):
+        """
+        Creates a metrics server.
+
+        Args:
+            get_metrics:  Function with no arguments that returns a dictionary
+                          of metric names and numeric values
+                          (Type: callable)
+
+            port:         Port to listen on
+                          (Type: int)
+
+        Keyword Args:
+            host:         Address to listen on
+                          (Type: str)
+        """
+        self.get_metrics = get_metrics
+        self.port = port
+        self.host = host
+        self._server = None
+        self._thread = None
+
+    def _make_handler(self):
+        get_metrics = self.get_metrics
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                metrics = get_metrics()
+                if self.path == '/metrics':
+                    body = ''.join('l3embedding_{} {}\n'.format(name, value)
+                                   for name, value in sorted(metrics.items())
+                                   if value is not None)
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body = json.dumps(metrics)
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                LOGGER.debug('Metrics server: ' + format % args)
+
+        return MetricsHandler
+
+    def start(self):
+        """
+        Start serving metrics in a background thread
+        """
+        self._server = HTTPServer((self.host, self.port), self._make_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='metrics-server', daemon=True)
+        self._thread.start()
+        LOGGER.info('Serving training metrics at http://{}:{}/metrics'.format(
+            self.host, self._server.server_port))
+
+    def stop(self):
+        """
+        Stop serving metrics
+        """
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
+
+
+class TrainingTelemetry(keras.callbacks.Callback):
+    """
+    Keras callback that records training throughput.
+
+    For each batch, the time spent waiting for data (between the end of the
+    previous step and the start of this one) and the time spent in the
+    training step are recorded. For each epoch, the throughput, validation
+    time and time spent in the other callbacks at the end of the epoch, which
+    is mostly writing checkpoints, are recorded. Records are buffered and
+    appended to a columnar log, and summaries are logged periodically, so
+    memory use is bounded.
+
+    Keras calls the batch hooks of the callbacks in order, so this callback
+    should be first in the list of callbacks and its ``step_marker`` callback
+    last. The step time is then measured from the batch begin hook of the
+    step marker to the batch end hook of this callback, and the data wait
+    from the batch end hook of the step marker to the batch begin hook of
+    this callback, so neither includes the time spent in the other callbacks.
+    Without the step marker, the step time includes the batch hooks of the
+    other callbacks.
+
+    Keras appends its progress bar after the given callbacks, so its batch
+    hooks would run after the step marker and be counted as data wait. Train
+    with ``verbose=0`` and add an ``InlineProgbarLogger`` before the step
+    marker instead.
+    """
+
+    def __init__(self, log_path, summary_interval=100, flush_interval=100,
+                 metrics_port=None):
+        """
+        Creates a training telemetry callback.
+
+        Args:
+            log_path:          Path to the columnar telemetry log
+                               (Type: str)
+
+        Keyword Args:
+            summary_interval:  Number of batches between logged summaries
+                               (Type: int)
+
+            flush_interval:    Number of batches buffered before they are
+                               written to the telemetry log
+                               (Type: int)
+
+            metrics_port:      If provided, port of a local HTTP endpoint
+                               serving the latest metrics
+                               (Type: int or None)
+        """
+        super(TrainingTelemetry, self).__init__()
+        self.log = ColumnarLog(log_path, {'batch': BATCH_COLUMNS,
+                                          'epoch': EPOCH_COLUMNS})
+        self.summary_interval = summary_interval
+        self.flush_interval = flush_interval
+        self.metrics_port = metrics_port
+
+        self._server = None
+        self._lock = threading.Lock()
+        self._batch_rows = {column: [] for column, _ in BATCH_COLUMNS}
+        self._epoch_row = None
+        self._interval_metrics = MetricsRegistry(enabled=True)
+        self._epoch_metrics = MetricsRegistry(enabled=True)
+        self._interval_start = None
+        self._interval_batches = 0
+        self._interval_samples = 0
+        self._latest = {}
+
+        self._epoch = None
+        self._epoch_start = None
+        self._epoch_end = None
+        self._epoch_samples = 0
+        self._batch_start = None
+        self._step_start = None
+        self._last_batch_end = None
+        self._num_batches = 0
+        self._num_samples = 0
+
+        # Should be added last in the list of callbacks
+        self.step_marker = TelemetryStepMarker(self)
+
+    def get_metrics(self):
+        """
+        Get the latest training metrics
+
+        Returns:
+            metrics:  Dictionary of metric names and values
+                      (Type: dict[str, float])
+        """
+        with self._lock:
+            return dict(self._latest)
+
+    def _update_latest(self, **metrics):
+        with self._lock:
+            self._latest.update(metrics)
+
+    def on_train_begin(self, logs=None):
+        if self.metrics_port is not None:
+            self._server = MetricsServer(self.get_metrics, self.metrics_port)
+            self._server.start()
+
+    def on_train_end(self, logs=None):
+        self._finish_epoch(time.time())
+        self._flush()
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        now = time.time()
+        self._finish_epoch(now)
+
+        self._epoch = epoch
+        self._epoch_start = now
+        self._epoch_samples = 0
+        self._last_batch_end = now
+        self._epoch_metrics.reset()
+        self._interval_metrics.reset()
+        self._interval_start = now
+        self._interval_batches = 0
+        self._interval_samples = 0
+
+    def on_batch_begin(self, batch, logs=None):
+        self._batch_start = time.time()
+        # Replaced by the step marker, if it is used
+        self._step_start = self._batch_start
+
+    def on_batch_end(self, batch, logs=None):
+        now = time.time()
+        data_wait = self._batch_start - self._last_batch_end
+        step_time = now - self._step_start
+        batch_size = (logs or {}).get('size', 0)
+
+        for registry in (self._interval_metrics, self._epoch_metrics):
+            registry.record('data_wait', data_wait)
+            registry.record('step_time', step_time)
+        METRICS.record('Waiting for data', data_wait)
+        METRICS.record('Training step', step_time)
+        TRACER.add_span('Waiting for data', self._last_batch_end, data_wait, cat='train')
+        TRACER.add_span('Training step', self._step_start, step_time, cat='train')
+
+        row = {'epoch': self._epoch, 'batch': batch, 'time': now,
+               'batch_size': batch_size, 'data_wait': data_wait,
+               'step_time': step_time}
+        for column, value in row.items():
+            self._batch_rows[column].append(value)
+
+        self._last_batch_end = now
+        self._epoch_samples += batch_size
+        self._interval_batches += 1
+        self._interval_samples += batch_size
+        self._num_batches += 1
+        self._num_samples += batch_size
+        self._update_latest(epoch=self._epoch, batch=batch,
+                            batches_total=self._num_batches,
+                            samples_total=self._num_samples,
+                            data_wait_seconds=data_wait,
+                            step_time_seconds=step_time)
+
+        if len(self._batch_rows['batch']) >= self.flush_interval:
+            self._flush()
+
+        if self._interval_batches >= self.summary_interval:
+            self._log_summary(now)
+
+    def on_epoch_end(self, epoch, logs=None):
+        now = time.time()
+        train_time = self._last_batch_end - self._epoch_start
+        samples_per_sec = self._epoch_samples / train_time if train_time > 0 else 0.0
+        summary = {row['label']: row for row in self._epoch_metrics.get_summary()}
+
+        self._epoch_row = {
+            'epoch': epoch,
+            'time': now,
+            'num_samples': self._epoch_samples,
+            'train_time': train_time,
+            'samples_per_sec': samples_per_sec,
+            'data_wait': summary['data_wait']['total'] if 'data_wait' in summary else 0.0,
+            'step_time': summary['step_time']['total'] if 'step_time' in summary else 0.0,
+            'validation_time': now - self._last_batch_end,
+            # Filled in once the other callbacks are done
+            'callback_time': 0.0,
+        }
+        self._epoch_end = now
+
+        LOGGER.info('Epoch {} took {:.1f} seconds: {:.1f} samples/sec, {:.1f}s waiting for data, '
+                    '{:.1f}s in training steps, {:.1f}s validating'.format(
+                        epoch, now - self._epoch_start, samples_per_sec,
+                        self._epoch_row['data_wait'], self._epoch_row['step_time'],
+                        self._epoch_row['validation_time']))
+        self._update_latest(epoch_samples_per_sec=samples_per_sec,
+                            epoch_validation_seconds=self._epoch_row['validation_time'])
+        self._flush()
+
+    def _finish_epoch(self, now):
+        """
+        Record the previous epoch, once the time spent in the epoch end
+        callbacks is known
+        """
+        if self._epoch_row is None:
+            return
+
+        callback_time = now - self._epoch_end
+        self._epoch_row['callback_time'] = callback_time
+        self.log.append('epoch', {column: [self._epoch_row[column]]
+                                  for column, _ in EPOCH_COLUMNS})
+        METRICS.record('Epoch end callbacks', callback_time)
+        TRACER.add_span('Epoch end callbacks', self._epoch_end, callback_time, cat='train')
+        LOGGER.info('Epoch {} end callbacks (checkpoints, logging) took {:.1f} seconds'.format(
+            self._epoch_row['epoch'], callback_time))
+        self._update_latest(epoch_callback_seconds=callback_time)
+        self._epoch_row = None
+
+    def _log_summary(self, now):
+        elapsed = now - self._interval_start
+        samples_per_sec = self._interval_samples / elapsed if elapsed > 0 else 0.0
+        summary = {row['label']: row for row in self._interval_metrics.get_summary()}
+        step, wait = summary['step_time'], summary['data_wait']
+        LOGGER.info('{:.1f} samples/sec; step {:.1f} ms (p50 {:.1f}, p99 {:.1f}); '
+                    'data wait {:.1f} ms (p50 {:.1f}, p99 {:.1f})'.format(
+                        samples_per_sec,
+                        1000 * step['mean'], 1000 * step['p50'], 1000 * step['p99'],
+                        1000 * wait['mean'], 1000 * wait['p50'], 1000 * wait['p99']))
+        self._update_latest(samples_per_sec=samples_per_sec,
+                            step_time_p50_seconds=step['p50'],
+                            step_time_p99_seconds=step['p99'],
+                            data_wait_p50_seconds=wait['p50'],
+                            data_wait_p99_seconds=wait['p99'])
+
+        self._interval_metrics.reset()
+        self._interval_start = now
+        self._interval_batches = 0
+        self._interval_samples = 0
+
+    def _flush(self):
+        self.log.append('batch', self._batch_rows)
+        self._batch_rows = {column: [] for column, _ in BATCH_COLUMNS}
+
+
+class InlineProgbarLogger(keras.callbacks.ProgbarLogger):
+    """
+    Keras progress bar callback that can be placed in the list of callbacks,
+    rather than being appended by Keras after all of the other callbacks.
+    Training should be run with ``verbose=0``, so that Keras does not add its
+    own progress bar.
+    """
+
+    def __init__(self, verbose=1, count_mode='steps'):
+        """
+        Creates a progress bar callback.
+
+        Keyword Args:
+            verbose:     Verbosity mode, 1 or 2, used instead of the verbosity
+                         training is run with
+                         (Type: int)
+
+            count_mode:  'steps' or 'samples'
+                         (Type: str)
+        """
+        super(InlineProgbarLogger, self).__init__(count_mode=count_mode)
+        self._verbose = verbose
+
+    def on_train_begin(self, logs=None):
+        super(InlineProgbarLogger, self).on_train_begin(logs)
+        self.verbose = self._verbose
+        if hasattr(self, 'stateful_metrics'):
+            # Keras >= 2.2 passes these when it creates the progress bar
+            self.stateful_metrics = set(getattr(self.model, 'stateful_metric_names', None) or [])
+
+
+class TelemetryStepMarker(keras.callbacks.Callback):
+    """
+    Keras callback that marks the start of the training step and the end of
+    the batch end hooks for a TrainingTelemetry callback. Should be last in
+    the list of callbacks.
+    """
+
+    def __init__(self, telemetry):
+        """
+        Creates a step marker callback.
+
+        Args:
+            telemetry:  Telemetry callback the marks are recorded for
+                        (Type: TrainingTelemetry)
+        """
+        super(TelemetryStepMarker, self).__init__()
+        self.telemetry = telemetry
+
+    def on_batch_begin(self, batch, logs=None):
+        self.telemetry._step_start = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        # The wait for the next batch starts once all of the callbacks are done
+        self.telemetry._last_batch_end = time.time()
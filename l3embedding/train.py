@@ -7,15 +7,20 @@ import pickle
 import random
 import csv
 
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import keras
 from keras.optimizers import Adam
 import pescador
-from skimage import img_as_float
 
+from data.avc.shards import load_manifest
 from gsheets import get_credentials, append_row, update_experiment, get_row
 from .model import MODELS, load_model
-from .audio import pcm2float
+from .checkpoint import AsyncCheckpointManager
+from .telemetry import InlineProgbarLogger, TrainingTelemetry, TELEMETRY_FILENAME
 from log import *
 import h5py
 import copy
@@ -105,104 +110,401 @@ class GSheetLogger(keras.callbacks.Callback):
                           'R', 'Z', values, 'embedding')
 
 
-class TimeHistory(keras.callbacks.Callback):
+class TracedCallback(keras.callbacks.Callback):
     """
-    Keras callback to log epoch and batch running time
+    Keras callback wrapper that records the time spent in each hook of
+    another callback as a trace span
     """
-    # Copied from https://stackoverflow.com/a/43186440/1260544
+    def __init__(self, callback):
+        super(TracedCallback, self).__init__()
+        self.callback = callback
+        self.name = type(callback).__name__
+
+    def set_params(self, params):
+        super(TracedCallback, self).set_params(params)
+        self.callback.set_params(params)
+
+    def set_model(self, model):
+        super(TracedCallback, self).set_model(model)
+        self.callback.set_model(model)
+
+    def _call(self, hook, *args):
+        with LogTimer(None, '{}.{}'.format(self.name, hook)):
+            getattr(self.callback, hook)(*args)
+
     def on_train_begin(self, logs=None):
-        self.epoch_times = []
-        self.batch_times = []
+        self._call('on_train_begin', logs)
+
+    def on_train_end(self, logs=None):
+        self._call('on_train_end', logs)
 
-    def on_epoch_begin(self, batch, logs=None):
-        self.epoch_time_start = time.time()
+    def on_epoch_begin(self, epoch, logs=None):
+        self._call('on_epoch_begin', epoch, logs)
 
-    def on_epoch_end(self, batch, logs=None):
-        t = time.time() - self.epoch_time_start
-        LOGGER.info('Epoch took {} seconds'.format(t))
-        self.epoch_times.append(t)
+    def on_epoch_end(self, epoch, logs=None):
+        self._call('on_epoch_end', epoch, logs)
 
     def on_batch_begin(self, batch, logs=None):
-        self.batch_time_start = time.time()
+        self._call('on_batch_begin', batch, logs)
 
     def on_batch_end(self, batch, logs=None):
-        t = time.time() - self.batch_time_start
-        LOGGER.info('Batch took {} seconds'.format(t))
-        self.batch_times.append(t)
+        self._call('on_batch_end', batch, logs)
 
 
-def cycle_shuffle(iterable, shuffle=True):
-    lst = list(iterable)
-    while True:
-        yield from lst
-        if shuffle:
-            random.shuffle(lst)
+def batch_slices(data_dir, batch_size=512, random_state=20180123,
+                 start_batch_idx=None):
+    """
+    Plan training batches as slices of the sample files in a directory
 
+    Files are visited in a cycle, shuffling their order after each pass. If a
+    manifest of the sample files is available, the file order comes from the
+    manifest and resuming from start_batch_idx jumps directly to the file and
+    offset where that batch starts, without opening any of the prior files.
 
-def data_generator(data_dir, batch_size=512, random_state=20180123,
-                   start_batch_idx=None, keys=None):
-    random.seed(random_state)
+    Args:
+        data_dir: Directory containing sample files
+
+    Keyword Args:
+        batch_size: Number of samples per batch
+        random_state: Value used to initialize state of RNG
+        start_batch_idx: If provided, index of the first batch to produce
+
+    Returns:
+        A generator that yields lists of (file path, start index, end index)
+        slices for each batch
+    """
+    # Use a private RNG so that the order is not affected by other generators
+    rng = random.Random(random_state)
+
+    manifest = load_manifest(data_dir)
+    if manifest is not None:
+        fnames = [shard['filename'] for shard in manifest['shards']]
+        sizes = {shard['filename']: shard['num_samples']
+                 for shard in manifest['shards']}
+    else:
+        # Skip shard index files and anything else that isn't a sample file
+        fnames = [fname for fname in os.listdir(data_dir) if fname.endswith('.h5')]
+        sizes = {}
 
-    batch = None
-    curr_batch_size = 0
     batch_idx = 0
+    skip_samples = 0
+    if start_batch_idx and manifest is not None:
+        num_samples = manifest['num_samples']
+        if num_samples == 0:
+            raise ValueError('No samples in {}'.format(data_dir))
+
+        # Replay the shuffles of the skipped passes over the files, so that
+        # the file order matches that of a generator that was not resumed
+        skip_samples = start_batch_idx * batch_size
+        for _ in range(skip_samples // num_samples):
+            rng.shuffle(fnames)
+        skip_samples %= num_samples
+        batch_idx = start_batch_idx
+
+    batch = []
+    curr_batch_size = 0
+    while True:
+        for fname in fnames:
+            batch_path = os.path.join(data_dir, fname)
+            if fname not in sizes:
+                with h5py.File(batch_path, 'r') as blob:
+                    sizes[fname] = len(blob['label'])
+            blob_size = sizes[fname]
 
-    # Limit keys to avoid producing batches with all of the metadata fields
-    if not keys:
-        keys = ['audio', 'video', 'label']
+            if skip_samples >= blob_size:
+                skip_samples -= blob_size
+                continue
 
-    for fname in cycle_shuffle(os.listdir(data_dir)):
-        batch_path = os.path.join(data_dir, fname)
-        blob_start_idx = 0
+            blob_start_idx = skip_samples
+            skip_samples = 0
+            while blob_start_idx < blob_size:
+                blob_end_idx = min(blob_start_idx + batch_size - curr_batch_size, blob_size)
+                batch.append((batch_path, blob_start_idx, blob_end_idx))
+                curr_batch_size += blob_end_idx - blob_start_idx
+                blob_start_idx = blob_end_idx
 
-        blob = h5py.File(batch_path, 'r')
-        blob_size = len(blob['label'])
+                if curr_batch_size == batch_size:
+                    # If we are starting from a particular batch, skip yielding
+                    # all of the prior batches
+                    if start_batch_idx is None or batch_idx >= start_batch_idx:
+                        yield batch
 
-        while blob_start_idx < blob_size:
-            blob_end_idx = min(blob_start_idx + batch_size - curr_batch_size, blob_size)
+                    batch_idx += 1
+                    curr_batch_size = 0
+                    batch = []
 
-            # If we are starting from a particular batch, skip computing all of
-            # the prior batches
-            if start_batch_idx is None or batch_idx >= start_batch_idx:
-                if batch is None:
-                    batch = {k:blob[k][blob_start_idx:blob_end_idx]
-                             for k in keys}
-                else:
-                    for k in keys:
-                        batch[k] = np.concatenate([batch[k],
-                                                   blob[k][blob_start_idx:blob_end_idx]])
+        rng.shuffle(fnames)
 
-            curr_batch_size += blob_end_idx - blob_start_idx
-            blob_start_idx = blob_end_idx
 
-            if blob_end_idx == blob_size:
-                blob.close()
+# Lookup table mapping uint8 pixels to [-1, 1], computed the same way as
+# 2 * img_as_float(video).astype('float32') - 1
+VIDEO_LUT = 2 * (np.arange(256) / 255.).astype('float32') - 1
+
+# Maximum number of batches queued by Keras when fitting from a generator
+KERAS_MAX_QUEUE_SIZE = 10
+
+
+def open_sample_file(path, blobs, max_open=4):
+    """
+    Get an open sample file, keeping a few recently used files open
+
+    Args:
+        path: Path to sample file
+        blobs: Ordered dictionary of open sample files
 
-            if curr_batch_size == batch_size:
-                # If we are starting from a particular batch, skip yielding all
-                # of the prior batches
-                if start_batch_idx is None or batch_idx >= start_batch_idx:
-                    # Preprocess video so samples are in [-1,1]
-                    batch['video'] = 2 * img_as_float(batch['video']).astype('float32') - 1
+    Keyword Args:
+        max_open: Maximum number of files to keep open
+
+    Returns:
+        blob: Open h5py file
+    """
+    if path not in blobs:
+        while len(blobs) >= max_open:
+            blobs.pop(next(iter(blobs))).close()
+        blobs[path] = h5py.File(path, 'r')
+    return blobs[path]
 
-                    # Convert audio to float
-                    batch['audio'] = pcm2float(batch['audio'], dtype='float32')
 
-                    yield batch
+class BatchAssembler(object):
+    """
+    Assembles training batches from slices of sample files into preallocated
+    buffers.
+
+    Raw sample data is read directly from the files into a staging buffer for
+    the whole batch, and video and audio are then converted to float32 with a
+    single pass into the output buffers. Staging buffers are kept per thread.
+    Output buffers are kept in a ring of num_buffers batches, so a batch is
+    only valid until num_buffers more batches have been assembled.
+    """
 
-                batch_idx += 1
-                curr_batch_size = 0
-                batch = None
+    def __init__(self, batch_size, keys, num_buffers=None):
+        """
+        Creates a batch assembler.
+
+        Args:
+            batch_size:   Number of samples per batch
+                          (Type: int)
+
+            keys:         Keys of the data to load
+                          (Type: list[str])
+
+        Keyword Args:
+            num_buffers:  Number of output buffers to reuse. If None, new output
+                          arrays are allocated for every batch.
+                          (Type: int or None)
+        """
+        self.batch_size = batch_size
+        self.keys = keys
+        self.num_buffers = num_buffers
+
+        self._specs = None
+        self._buffers = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _init_specs(self, blob):
+        """
+        Get the shape and dtype of each key from a sample file
+        """
+        with self._lock:
+            if self._specs is None:
+                self._specs = {k: (blob[k].shape[1:], blob[k].dtype)
+                               for k in self.keys}
+        return self._specs
+
+    def _get_output_dtype(self, key, dtype):
+        if key == 'video' or (key == 'audio' and dtype.kind in 'iu'):
+            return np.dtype('float32')
+        return dtype
+
+    def _alloc(self, key, conv=True):
+        shape, dtype = self._specs[key]
+        if conv:
+            dtype = self._get_output_dtype(key, dtype)
+        return np.empty((self.batch_size,) + shape, dtype=dtype)
+
+    def _get_staging(self, key):
+        staging = getattr(self._local, 'staging', None)
+        if staging is None:
+            staging = self._local.staging = {}
+        if key not in staging:
+            staging[key] = self._alloc(key, conv=False)
+        return staging[key]
+
+    def _get_output(self, key, buffer_idx):
+        if self.num_buffers is None:
+            return self._alloc(key)
+
+        buf_key = (key, buffer_idx % self.num_buffers)
+        with self._lock:
+            if buf_key not in self._buffers:
+                self._buffers[buf_key] = self._alloc(key)
+            return self._buffers[buf_key]
+
+    def assemble(self, slices, blobs, buffer_idx=0):
+        """
+        Load a training batch from slices of sample files
+
+        Args:
+            slices:      List of (file path, start index, end index) slices
+                         (Type: list[tuple])
+
+            blobs:       Ordered dictionary of open sample files, used to reuse
+                         files across batches
+                         (Type: collections.OrderedDict)
+
+        Keyword Args:
+            buffer_idx:  Index of the batch, used to pick the output buffer
+                         (Type: int)
+
+        Returns:
+            batch:  Dictionary of batch data, with video in [-1, 1] and audio
+                    converted to float
+        """
+        open_slices = [(open_sample_file(path, blobs), start_idx, end_idx)
+                       for path, start_idx, end_idx in slices]
+        specs = self._specs or self._init_specs(open_slices[0][0])
+
+        batch = {}
+        for k in self.keys:
+            dtype = specs[k][1]
+            out = self._get_output(k, buffer_idx)
+            if dtype.kind in 'SO' or self._get_output_dtype(k, dtype) == dtype:
+                staging = out
+            else:
+                staging = self._get_staging(k)
+
+            with LogTimer(None, 'Reading HDF5'):
+                offset = 0
+                for blob, start_idx, end_idx in open_slices:
+                    num_samples = end_idx - start_idx
+                    if dtype.kind in 'SO':
+                        staging[offset:offset + num_samples] = blob[k][start_idx:end_idx]
+                    else:
+                        blob[k].read_direct(staging,
+                                            source_sel=np.s_[start_idx:end_idx],
+                                            dest_sel=np.s_[offset:offset + num_samples])
+                    offset += num_samples
+
+            with LogTimer(None, 'Converting batch'):
+                if k == 'video' and dtype == np.uint8:
+                    # Map pixels to [-1,1]
+                    np.take(VIDEO_LUT, staging, out=out)
+                elif staging is not out:
+                    # Convert audio to float, as in pcm2float
+                    abs_max = 2 ** (np.iinfo(dtype).bits - 1)
+                    pcm_offset = np.iinfo(dtype).min + abs_max
+                    if pcm_offset:
+                        np.subtract(staging, pcm_offset, out=out, casting='unsafe')
+                        out *= 1.0 / abs_max
+                    else:
+                        np.multiply(staging, np.float32(1.0 / abs_max), out=out,
+                                    casting='unsafe')
+
+            batch[k] = out
+
+        return batch
+
+
+def data_generator(data_dir, batch_size=512, random_state=20180123,
+                   start_batch_idx=None, keys=None, num_workers=0, queue_size=8,
+                   num_buffers=None):
+    """
+    Generate training batches from the sample files in a directory
+
+    If num_workers is positive, batches are loaded ahead of time by a pool of
+    worker threads, keeping up to queue_size batches ready. Batches are still
+    produced in the same order as when loading serially.
+
+    Args:
+        data_dir: Directory containing sample files
+
+    Keyword Args:
+        batch_size: Number of samples per batch
+        random_state: Value used to initialize state of RNG
+        start_batch_idx: If provided, index of the first batch to produce
+        keys: Keys of the data to load
+        num_workers: Number of threads used to load batches. If 0, batches are
+                     loaded serially when requested.
+        queue_size: Maximum number of batches loaded ahead of time
+        num_buffers: If provided, number of batch buffers that are reused. A
+                     batch is overwritten once num_buffers more batches have
+                     been produced, so this must be larger than the number of
+                     batches held by the consumer plus queue_size.
+
+    Returns:
+        A generator that yields batch dictionaries
+    """
+    # Limit keys to avoid producing batches with all of the metadata fields
+    if not keys:
+        keys = ['audio', 'video', 'label']
+
+    slices_gen = enumerate(batch_slices(data_dir, batch_size=batch_size,
+                                        random_state=random_state,
+                                        start_batch_idx=start_batch_idx))
+    assembler = BatchAssembler(batch_size, keys, num_buffers=num_buffers)
+
+    if num_workers <= 0:
+        blobs = OrderedDict()
+        try:
+            for idx, slices in slices_gen:
+                # Only record timing, since this runs for every batch
+                with LogTimer(None, 'Assembling batch'):
+                    batch = assembler.assemble(slices, blobs, buffer_idx=idx)
+                yield batch
+        finally:
+            for blob in blobs.values():
+                blob.close()
+        return
+
+    # Each worker thread keeps its own open files
+    local = threading.local()
+    all_blobs = []
+    all_blobs_lock = threading.Lock()
+
+    def load_func(slices, buffer_idx):
+        if not hasattr(local, 'blobs'):
+            local.blobs = OrderedDict()
+            with all_blobs_lock:
+                all_blobs.append(local.blobs)
+        with LogTimer(None, 'Assembling batch'):
+            return assembler.assemble(slices, local.blobs, buffer_idx=buffer_idx)
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    futures = deque()
+    try:
+        while True:
+            # Keep the queue of pending batches full
+            while len(futures) < max(queue_size, 1):
+                idx, slices = next(slices_gen)
+                futures.append(executor.submit(load_func, slices, idx))
+
+            # Time spent blocked on loading, i.e. not hidden by prefetching
+            with LogTimer(None, 'Waiting for batch'):
+                batch = futures.popleft().result()
+            yield batch
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        for blobs in all_blobs:
+            for blob in blobs.values():
+                blob.close()
 
 
 def single_epoch_data_generator(data_dir, epoch_size, **kwargs):
     while True:
         data_gen = data_generator(data_dir, **kwargs)
-        for idx, item in enumerate(data_gen):
-            yield item
-            # Once we generate all batches for an epoch, restart the generator
-            if (idx + 1) == epoch_size:
-                break
+        try:
+            for idx, item in enumerate(data_gen):
+                yield item
+                # Once we generate all batches for an epoch, restart the generator
+                if (idx + 1) == epoch_size:
+                    break
+        finally:
+            # Stop the prefetching workers and release the batch buffers now,
+            # rather than when the generator is garbage collected
+            data_gen.close()
 
 
 def get_restart_info(history_path):
@@ -221,13 +523,19 @@ def train(train_data_dir, validation_data_dir, output_dir,
           model_type='cnn_L3_orig', random_state=20180123,
           learning_rate=1e-4, verbose=False, checkpoint_interval=10,
           log_path=None, disable_logging=False, gpus=1, continue_model_dir=None,
-          gsheet_id=None, google_dev_app_name=None):
+          gsheet_id=None, google_dev_app_name=None, data_workers=2,
+          data_queue_size=8, timing_metrics=False, trace_dir=None,
+          metrics_port=None, keep_checkpoints=None):
 
     init_console_logger(LOGGER, verbose=verbose)
     if not disable_logging:
         init_file_logger(LOGGER, log_path=log_path)
     LOGGER.debug('Initialized logging.')
 
+    METRICS.enabled = timing_metrics
+    if trace_dir:
+        TRACER.start(trace_dir, process_name='train')
+
     # Form model ID
     data_subset_name = os.path.basename(train_data_dir)
     data_subset_name = data_subset_name[:data_subset_name.rindex('_')]
@@ -313,11 +621,6 @@ def train(train_data_dir, validation_data_dir, output_dir,
     with open(model_json_path, 'w') as fd:
         json.dump(model_json, fd, indent=2)
 
-    latest_weight_path = os.path.join(model_dir, 'model_latest.h5')
-    best_valid_acc_weight_path = os.path.join(model_dir, 'model_best_valid_accuracy.h5')
-    best_valid_loss_weight_path = os.path.join(model_dir, 'model_best_valid_loss.h5')
-    checkpoint_weight_path = os.path.join(model_dir, 'model_checkpoint.{epoch:02d}.h5')
-
     # Load information about last epoch for initializing callbacks and data generators
     if continue_model_dir is not None:
         prev_train_hist_path = os.path.join(continue_model_dir, 'history_csvlog.csv')
@@ -325,37 +628,17 @@ def train(train_data_dir, validation_data_dir, output_dir,
 
     # Set up callbacks
     cb = []
-    cb.append(keras.callbacks.ModelCheckpoint(latest_weight_path,
-                                              save_weights_only=True,
-                                              verbose=1))
-
-    best_val_acc_cb = keras.callbacks.ModelCheckpoint(best_valid_acc_weight_path,
-                                              save_weights_only=True,
-                                              save_best_only=True,
-                                              verbose=1,
-                                              monitor='val_acc')
-    if continue_model_dir is not None:
-        best_val_acc_cb.best = last_val_acc
-    cb.append(best_val_acc_cb)
-
-    best_val_loss_cb = keras.callbacks.ModelCheckpoint(best_valid_loss_weight_path,
-                                              save_weights_only=True,
-                                              save_best_only=True,
-                                              verbose=1,
-                                              monitor='val_loss')
     if continue_model_dir is not None:
-        best_val_loss_cb.best = last_val_loss
-    cb.append(best_val_loss_cb)
-
-    checkpoint_cb = keras.callbacks.ModelCheckpoint(checkpoint_weight_path,
-                                              save_weights_only=True,
-                                              period=checkpoint_interval)
-    if continue_model_dir is not None:
-        checkpoint_cb.epochs_since_last_save = (last_epoch_idx + 1) % checkpoint_interval
-    cb.append(checkpoint_cb)
-
-    timer_cb = TimeHistory()
-    cb.append(timer_cb)
+        best_values = {'val_acc': last_val_acc, 'val_loss': last_val_loss}
+        initial_epoch = last_epoch_idx + 1
+    else:
+        best_values = None
+        initial_epoch = 0
+    cb.append(AsyncCheckpointManager(model_dir,
+                                     checkpoint_interval=checkpoint_interval,
+                                     keep_checkpoints=keep_checkpoints,
+                                     best_values=best_values,
+                                     initial_epoch=initial_epoch))
 
     history_checkpoint = os.path.join(model_dir, 'history_checkpoint.pkl')
     cb.append(LossHistory(history_checkpoint))
@@ -368,6 +651,9 @@ def train(train_data_dir, validation_data_dir, output_dir,
         cb.append(GSheetLogger(google_dev_app_name, gsheet_id, param_dict))
 
     LOGGER.info('Setting up train data generator...')
+    # Batch buffers are reused, so there must be more of them than the batches
+    # queued by us and by Keras, plus the ones being consumed and produced
+    num_batch_buffers = data_queue_size + KERAS_MAX_QUEUE_SIZE + 2
     if continue_model_dir is not None:
         train_start_batch_idx = train_epoch_size * (last_epoch_idx + 1)
     else:
@@ -377,7 +663,10 @@ def train(train_data_dir, validation_data_dir, output_dir,
         train_data_dir,
         batch_size=train_batch_size,
         random_state=random_state,
-        start_batch_idx=train_start_batch_idx)
+        start_batch_idx=train_start_batch_idx,
+        num_workers=data_workers,
+        queue_size=data_queue_size,
+        num_buffers=num_batch_buffers)
 
     train_gen = pescador.maps.keras_tuples(train_gen,
                                            ['video', 'audio'],
@@ -388,29 +677,43 @@ def train(train_data_dir, validation_data_dir, output_dir,
         validation_data_dir,
         validation_epoch_size,
         batch_size=validation_batch_size,
-        random_state=random_state)
+        random_state=random_state,
+        num_workers=data_workers,
+        queue_size=data_queue_size,
+        num_buffers=num_batch_buffers)
 
     val_gen = pescador.maps.keras_tuples(val_gen,
                                          ['video', 'audio'],
                                          'label')
 
-    # Fit the model
-    LOGGER.info('Fitting model...')
+    if trace_dir:
+        # Record the time spent in checkpointing, logging, etc.
+        cb = [TracedCallback(c) for c in cb]
+
     if verbose:
         verbosity = 1
     else:
         verbosity = 2
 
-    if continue_model_dir is not None:
-        initial_epoch = last_epoch_idx + 1
-    else:
-        initial_epoch = 0
+    # Telemetry must be the first callback and its step marker the last, so
+    # that the step time and data wait do not include the other callbacks.
+    # Keras would append the progress bar after the step marker, so it is
+    # added here and Keras is run with verbose=0.
+    telemetry_path = os.path.join(model_dir, TELEMETRY_FILENAME)
+    telemetry_cb = TrainingTelemetry(telemetry_path, metrics_port=metrics_port)
+    cb.insert(0, telemetry_cb)
+    cb.append(InlineProgbarLogger(verbosity))
+    cb.append(telemetry_cb.step_marker)
+
+    # Fit the model
+    LOGGER.info('Fitting model...')
     history = m.fit_generator(train_gen, train_epoch_size, num_epochs,
                               validation_data=val_gen,
                               validation_steps=validation_epoch_size,
+                              max_queue_size=KERAS_MAX_QUEUE_SIZE,
                               #use_multiprocessing=True,
                               callbacks=cb,
-                              verbose=verbosity,
+                              verbose=0,
                               initial_epoch=initial_epoch)
 
     LOGGER.info('Done training. Saving results to disk...')
@@ -418,4 +721,11 @@ def train(train_data_dir, validation_data_dir, output_dir,
     with open(os.path.join(model_dir, 'history.pkl'), 'wb') as fd:
         pickle.dump(history.history, fd)
 
+    if timing_metrics:
+        LOGGER.info('Time breakdown:\n' + METRICS.format_summary())
+
+    if trace_dir:
+        TRACER.stop()
+        LOGGER.info('Wrote trace to {}'.format(merge_traces(trace_dir)))
+
     LOGGER.info('Done!')
@@ -1,6 +1,407 @@
+import atexit
+import glob
+import json
+import math
+import os
 import time
 import logging
 import logging.handlers
+import multiprocessing
+import threading
+from collections import OrderedDict
+
+
+class MetricsRegistry(object):
+    """
+    A registry of per-label counts and duration histograms.
+
+    Durations are counted in logarithmically spaced buckets, so percentiles
+    can be estimated in constant memory, and snapshots from worker processes
+    can be merged by adding their counts. Nothing is recorded unless the
+    registry is enabled.
+    """
+
+    def __init__(self, buckets_per_decade=20, min_value=1e-6, enabled=False):
+        """
+        Creates a metrics registry.
+
+        Kwargs:
+            buckets_per_decade:  Number of histogram buckets per power of ten
+                                 (Type: int)
+
+            min_value:           Upper bound of the first histogram bucket
+                                 (Type: float)
+
+            enabled:             If True, record metrics
+                                 (Type: bool)
+        """
+        ## If True, record metrics
+        ## (Type: bool)
+        self.enabled = enabled
+        self.buckets_per_decade = buckets_per_decade
+        self.min_value = min_value
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_bucket(self, value):
+        if value <= self.min_value:
+            return 0
+        return int(math.log10(value / self.min_value) * self.buckets_per_decade) + 1
+
+    def _get_bucket_value(self, bucket):
+        # Geometric center of the bucket
+        if bucket == 0:
+            return self.min_value
+        return self.min_value * 10 ** ((bucket - 0.5) / self.buckets_per_decade)
+
+    def record(self, label, value):
+        """
+        Record a value, such as a duration in seconds
+
+        Args:
+            label:  Label of the metric
+                    (Type: str)
+
+            value:  Value to record
+                    (Type: float)
+        """
+        if not self.enabled:
+            return
+
+        bucket = self._get_bucket(value)
+        with self._lock:
+            metric = self._metrics.get(label)
+            if metric is None:
+                metric = self._metrics[label] = {'count': 0, 'total': 0.0,
+                                                 'min': value, 'max': value,
+                                                 'buckets': {}}
+            metric['count'] += 1
+            metric['total'] += value
+            if value < metric['min']:
+                metric['min'] = value
+            if value > metric['max']:
+                metric['max'] = value
+            metric['buckets'][bucket] = metric['buckets'].get(bucket, 0) + 1
+
+    def snapshot(self):
+        """
+        Get a picklable copy of the recorded metrics, e.g. to send them from
+        a worker process to be merged
+
+        Returns:
+            snapshot:  Dictionary of metrics for each label
+                       (Type: dict[str, dict])
+        """
+        with self._lock:
+            return {label: dict(metric, buckets=dict(metric['buckets']))
+                    for label, metric in self._metrics.items()}
+
+    def merge(self, snapshot):
+        """
+        Add the metrics in a snapshot to this registry
+
+        Args:
+            snapshot:  Snapshot returned by MetricsRegistry.snapshot
+                       (Type: dict[str, dict])
+        """
+        with self._lock:
+            for label, other in snapshot.items():
+                metric = self._metrics.get(label)
+                if metric is None:
+                    self._metrics[label] = dict(other, buckets=dict(other['buckets']))
+                    continue
+
+                metric['count'] += other['count']
+                metric['total'] += other['total']
+                metric['min'] = min(metric['min'], other['min'])
+                metric['max'] = max(metric['max'], other['max'])
+                for bucket, count in other['buckets'].items():
+                    metric['buckets'][bucket] = metric['buckets'].get(bucket, 0) + count
+
+    def reset(self):
+        """
+        Discard all recorded metrics
+        """
+        with self._lock:
+            self._metrics = {}
+
+    def get_percentile(self, label, q):
+        """
+        Estimate a percentile of the values recorded for a label
+
+        Args:
+            label:  Label of the metric
+                    (Type: str)
+
+            q:      Percentile, between 0 and 100
+                    (Type: float)
+
+        Returns:
+            value:  Estimated percentile value, accurate to the width of a
+                    histogram bucket
+                    (Type: float)
+        """
+        with self._lock:
+            metric = self._metrics[label]
+            buckets = sorted(metric['buckets'].items())
+
+        rank = q / 100.0 * metric['count']
+        cumulative = 0
+        for bucket, count in buckets:
+            cumulative += count
+            if cumulative >= rank:
+                break
+
+        value = self._get_bucket_value(bucket)
+        return min(max(value, metric['min']), metric['max'])
+
+    def get_summary(self):
+        """
+        Summarize the recorded metrics, in decreasing order of total value
+
+        Returns:
+            summary:  List of summary dictionaries with the label, count,
+                      total, mean, median, 90th and 99th percentiles, and
+                      maximum of each metric
+                      (Type: list[collections.OrderedDict])
+        """
+        summary = []
+        for label, metric in self.snapshot().items():
+            row = OrderedDict()
+            row['label'] = label
+            row['count'] = metric['count']
+            row['total'] = metric['total']
+            row['mean'] = metric['total'] / metric['count']
+            row['p50'] = self.get_percentile(label, 50)
+            row['p90'] = self.get_percentile(label, 90)
+            row['p99'] = self.get_percentile(label, 99)
+            row['max'] = metric['max']
+            summary.append(row)
+
+        return sorted(summary, key=lambda row: -row['total'])
+
+    def format_summary(self):
+        """
+        Format the summary of the recorded metrics as a table of durations
+
+        Returns:
+            table:  Summary table
+                    (Type: str)
+        """
+        lines = ['{:<32} {:>10} {:>12} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            'label', 'count', 'total (s)', 'mean (ms)', 'p50 (ms)',
+            'p90 (ms)', 'p99 (ms)', 'max (ms)')]
+        for row in self.get_summary():
+            lines.append('{:<32} {:>10d} {:>12.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                row['label'][:32], row['count'], row['total'], row['mean'] * 1000,
+                row['p50'] * 1000, row['p90'] * 1000, row['p99'] * 1000,
+                row['max'] * 1000))
+        return '\n'.join(lines)
+
+
+## Registry that LogTimer records durations to. Disabled by default.
+## (Type: MetricsRegistry)
+METRICS = MetricsRegistry()
+
+
+class TraceRecorder(object):
+    """
+    A recorder of timed spans in the Chrome trace event format, which can be
+    viewed in chrome://tracing or Perfetto.
+
+    Each process appends its events to its own file in the trace directory,
+    as an unterminated JSON array, which the trace viewers accept. A process
+    forked while tracing starts a new file, so worker processes are traced
+    as long as they flush their events before exiting. The per-process files
+    can be combined with merge_traces.
+    """
+
+    def __init__(self, flush_size=1000):
+        """
+        Creates a trace recorder. Tracing is disabled until it is started.
+
+        Kwargs:
+            flush_size:  Number of events buffered before they are written
+                         (Type: int)
+        """
+        ## If True, record spans
+        ## (Type: bool)
+        self.enabled = False
+        ## Directory where trace files are written
+        ## (Type: str)
+        self.trace_dir = None
+        self.process_name = None
+        self.flush_size = flush_size
+        self._pid = None
+        self._events = []
+        self._threads = set()
+        self._lock = threading.Lock()
+
+    def start(self, trace_dir, process_name=None):
+        """
+        Start recording spans for this process
+
+        Args:
+            trace_dir:     Directory where trace files are written
+                           (Type: str)
+
+        Kwargs:
+            process_name:  Name of the process shown in the trace viewer
+                           (Type: str)
+        """
+        if not os.path.isdir(trace_dir):
+            os.makedirs(trace_dir, exist_ok=True)
+
+        with self._lock:
+            self.trace_dir = trace_dir
+            self.process_name = process_name
+            self._reset()
+            self.enabled = True
+
+    def stop(self):
+        """
+        Write buffered events and stop recording spans
+        """
+        self.flush()
+        self.enabled = False
+
+    def get_path(self):
+        """
+        Get the path of the trace file of this process
+        """
+        return os.path.join(self.trace_dir, 'trace_{}.json'.format(self._pid))
+
+    def _reset(self):
+        # Discard events inherited from the parent of a forked process
+        self._pid = os.getpid()
+        self._events = []
+        self._threads = set()
+        self._add_metadata('process_name', 0, self.process_name or 'pid {}'.format(self._pid))
+
+    def _add_metadata(self, name, tid, value):
+        self._events.append({'name': name, 'ph': 'M', 'pid': self._pid,
+                             'tid': tid, 'args': {'name': value}})
+
+    def add_span(self, name, start_time, duration, cat='', args=None):
+        """
+        Record a span
+
+        Args:
+            name:        Name of the span
+                         (Type: str)
+
+            start_time:  Wall clock start time (seconds)
+                         (Type: float)
+
+            duration:    Duration (seconds)
+                         (Type: float)
+
+        Kwargs:
+            cat:         Category of the span
+                         (Type: str)
+
+            args:        Arguments shown with the span
+                         (Type: dict or None)
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            if os.getpid() != self._pid:
+                self._reset()
+
+            tid = threading.get_ident()
+            if tid not in self._threads:
+                self._threads.add(tid)
+                self._add_metadata('thread_name', tid, threading.current_thread().name)
+
+            event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': self._pid,
+                     'tid': tid, 'ts': start_time * 1e6, 'dur': duration * 1e6}
+            if args:
+                event['args'] = args
+            self._events.append(event)
+
+            if len(self._events) >= self.flush_size:
+                self._flush()
+
+    def flush(self):
+        """
+        Write buffered events to the trace file of this process
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            if os.getpid() != self._pid:
+                self._reset()
+            self._flush()
+
+    def _flush(self):
+        if not self._events:
+            return
+
+        path = self.get_path()
+        with open(path, 'a') as f:
+            if f.tell() == 0:
+                f.write('[\n')
+            for event in self._events:
+                f.write(json.dumps(event) + ',\n')
+        self._events = []
+
+
+## Recorder that LogTimer records spans to. Disabled by default.
+## (Type: TraceRecorder)
+TRACER = TraceRecorder()
+
+
+def load_trace_events(path):
+    """
+    Load the events of a trace file written by TraceRecorder
+
+    Args:
+        path:  Path to trace file
+               (Type: str)
+
+    Returns:
+        events:  List of trace events
+                 (Type: list[dict])
+    """
+    with open(path, 'r') as f:
+        data = f.read().rstrip()
+
+    # Terminate the array, ignoring a partially written last event
+    data = data[:data.rfind('}') + 1] + ']'
+    return json.loads(data)
+
+
+def merge_traces(trace_dir, output_path=None):
+    """
+    Combine the trace files of all processes in a trace directory
+
+    Args:
+        trace_dir:    Directory where trace files are written
+                      (Type: str)
+
+    Kwargs:
+        output_path:  Path to combined trace file. By default, "trace.json"
+                      in the trace directory.
+                      (Type: str)
+
+    Returns:
+        output_path:  Path to combined trace file
+                      (Type: str)
+    """
+    if not output_path:
+        output_path = os.path.join(trace_dir, 'trace.json')
+
+    events = []
+    for path in sorted(glob.glob(os.path.join(trace_dir, 'trace_*.json'))):
+        events.extend(load_trace_events(path))
+
+    with open(output_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    return output_path
 
 
 class LogTimer(object):
@@ -8,7 +409,7 @@ class LogTimer(object):
     A context manager that times the execution of a block of code and logs it.
     """
 
-    def __init__(self, logger, desc, log_level=logging.DEBUG):
+    def __init__(self, logger, desc, log_level=logging.DEBUG, metric=None):
         """
         Creates an instance of a log timer context manager.
 
@@ -17,10 +418,15 @@ class LogTimer(object):
 
         '<desc>' took <duration> seconds
 
+        If the metrics registry or the trace recorder are enabled, the
+        duration is also recorded to them. If none are enabled, the block is
+        not timed at all.
+
 
         Args:
-            logger:     Logger to log to
-                        (Type: logging.Logger)
+            logger:     Logger to log to. If None, the duration is only
+                        recorded to the metrics registry.
+                        (Type: logging.Logger or None)
 
             desc:       Description of the code to time
                         (Type: str)
@@ -28,6 +434,10 @@ class LogTimer(object):
             log_level:  Logging level to log to. By default, the level is
                         set to logging.DEBUG.
                         (Type: int, logging.{NOTSET, DEBUG, INFO, WARNING, ERROR, CRITICAL})
+
+            metric:     Label the duration is recorded under in the metrics
+                        registry. By default, the description is used.
+                        (Type: str)
         """
         ## Logger used to log timing information
         ## (Type: logging.Logger)
@@ -38,7 +448,12 @@ class LogTimer(object):
         ## Description of the code block being timed
         ## (Type: str)
         self.desc = desc
+        ## Label the duration is recorded under in the metrics registry
+        ## (Type: str)
+        self.metric = metric or desc
         self._start_time = None
+        self._wall_start_time = None
+        self._log = False
 
         if log_level == logging.NOTSET:
             raise ValueError('Cannot use NOTSET logging level.')
@@ -47,7 +462,10 @@ class LogTimer(object):
         """
         Get the execution start time before the code block starts executing.
         """
-        self._start_time = time.time()
+        self._log = self.logger is not None and self.logger.isEnabledFor(self.log_level)
+        self._wall_start_time = time.time() if TRACER.enabled else None
+        if self._log or METRICS.enabled or TRACER.enabled:
+            self._start_time = time.perf_counter()
 
     def __exit__(self, type_, value, tb):
         """
@@ -68,8 +486,12 @@ class LogTimer(object):
             tb:     The traceback of the error that occurred.
                     (Type: str)
         """
+        # Nothing to do if the block was not timed
+        if self._start_time is None:
+            return
+
         # Compute the duration that the block of code took to execute
-        end_time = time.time()
+        end_time = time.perf_counter()
         duration = end_time - self._start_time
         self._start_time = None
 
@@ -77,6 +499,15 @@ class LogTimer(object):
         if type_ or value or tb:
             return
 
+        METRICS.record(self.metric, duration)
+        if TRACER.enabled and self._wall_start_time is not None:
+            cat = self.logger.name if self.logger is not None else ''
+            args = {'desc': self.desc} if self.desc != self.metric else None
+            TRACER.add_span(self.metric, self._wall_start_time, duration,
+                            cat=cat, args=args)
+        if not self._log:
+            return
+
         # Make the message out of the given description and the duration
         msg = "{0} took {1} seconds".format(self.desc, duration)
 
@@ -135,3 +566,230 @@ def init_console_logger(logger, verbose=False):
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     stream_handler.setFormatter(formatter)
     logger.addHandler(stream_handler)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    A filter that limits how often repetitive records are logged.
+
+    Records with the same message from the same call site are allowed up to
+    burst times per interval. The rest are dropped and counted, and the count
+    is appended to the next identical record that is let through. Records with
+    different messages, e.g. about different files, are never dropped.
+    """
+
+    def __init__(self, interval=60.0, burst=5, min_level=logging.WARNING,
+                 max_windows=10000):
+        """
+        Creates a rate limiting filter.
+
+        Kwargs:
+            interval:     Length of the rate limiting window (seconds)
+                          (Type: float)
+
+            burst:        Number of identical records allowed per window
+                          (Type: int)
+
+            min_level:    Records below this level are never dropped
+                          (Type: int)
+
+            max_windows:  Number of tracked messages above which expired
+                          windows are forgotten
+                          (Type: int)
+        """
+        super(RateLimitFilter, self).__init__()
+        self.interval = interval
+        self.burst = burst
+        self.min_level = min_level
+        self.max_windows = max_windows
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def get_key(self, record):
+        """
+        Get the key that repetitive records are grouped by
+        """
+        # Captured warnings all come from the warnings module, but their
+        # message includes the warning location and category
+        return (record.name, record.levelno, record.pathname, record.lineno,
+                record.getMessage())
+
+    def filter(self, record):
+        if record.levelno < self.min_level:
+            return True
+
+        key = self.get_key(record)
+        with self._lock:
+            if len(self._windows) >= self.max_windows:
+                self._prune(record.created)
+
+            window = self._windows.get(key)
+            if window is None or record.created - window['start'] >= self.interval:
+                suppressed = window['suppressed'] if window else 0
+                self._windows[key] = {'start': record.created, 'count': 1,
+                                      'suppressed': 0, 'sample': record.getMessage()}
+                if suppressed:
+                    record.msg = '{} ({} similar messages suppressed)'.format(
+                        record.getMessage(), suppressed)
+                    record.args = None
+                return True
+
+            if window['count'] < self.burst:
+                window['count'] += 1
+                return True
+
+            window['suppressed'] += 1
+            return False
+
+    def _prune(self, now):
+        """
+        Forget expired windows with no dropped records, so that the number of
+        windows does not grow with the number of distinct messages. Must be
+        called with the lock held.
+        """
+        for key, window in list(self._windows.items()):
+            if not window['suppressed'] and now - window['start'] >= self.interval:
+                del self._windows[key]
+
+    def pop_suppressed(self):
+        """
+        Get and reset the number of records dropped in the current windows
+
+        Returns:
+            suppressed:  List of (number of dropped records, sample message)
+                         tuples
+                         (Type: list[tuple])
+        """
+        with self._lock:
+            suppressed = [(window['suppressed'], window['sample'])
+                          for window in self._windows.values() if window['suppressed']]
+            for window in self._windows.values():
+                window['suppressed'] = 0
+        return suppressed
+
+
+class RateLimitedQueueListener(logging.handlers.QueueListener):
+    """
+    A queue listener that passes records through a rate limiting filter
+    before handing them to its handlers, and reports the records that were
+    dropped when it is stopped.
+    """
+
+    def __init__(self, queue, *handlers, rate_limit_filter=None):
+        super(RateLimitedQueueListener, self).__init__(queue, *handlers,
+                                                       respect_handler_level=True)
+        self.rate_limit_filter = rate_limit_filter
+
+    def handle(self, record):
+        if self.rate_limit_filter is None or self.rate_limit_filter.filter(record):
+            super(RateLimitedQueueListener, self).handle(record)
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        super(RateLimitedQueueListener, self).stop()
+        if self.rate_limit_filter is None:
+            return
+
+        for num_suppressed, sample in self.rate_limit_filter.pop_suppressed():
+            record = logging.LogRecord('log', logging.WARNING, __file__, 0,
+                                       'Suppressed %d messages similar to: %s',
+                                       (num_suppressed, sample), None)
+            super(RateLimitedQueueListener, self).handle(record)
+
+
+def init_queue_worker(queue, logger_names, level=logging.NOTSET, capture_warnings=True):
+    """
+    Route the records of the given loggers in this process to a logging queue.
+    Can be used as a multiprocessing.Pool initializer.
+
+    Args:
+        queue:             Queue read by the listener in the parent process
+                           (Type: multiprocessing.Queue)
+
+        logger_names:      Names of loggers to route through the queue
+                           (Type: list[str])
+
+    Kwargs:
+        level:             Records below this level are not enqueued
+                           (Type: int)
+
+        capture_warnings:  If True, warnings are also routed through the queue
+                           (Type: bool)
+    """
+    handler = logging.handlers.QueueHandler(queue)
+    handler.setLevel(level)
+
+    if capture_warnings:
+        logging.captureWarnings(True)
+        logger_names = list(logger_names) + ['py.warnings']
+
+    for name in logger_names:
+        logger = logging.getLogger(name)
+        logger.handlers = [handler]
+        # Records are handled by the listener, not by ancestor loggers
+        logger.propagate = False
+
+
+def init_queue_logging(loggers, rate_limit_interval=60.0, rate_limit_burst=5,
+                       capture_warnings=True):
+    """
+    Initializes non-blocking logging through a queue.
+
+    The handlers of the given loggers are moved to a listener thread, and the
+    loggers enqueue their records instead, so that formatting and writing
+    records does not block the caller. Worker processes forked afterwards
+    inherit this setup, and spawned workers can be set up by passing
+    init_queue_worker and the returned arguments as a Pool initializer.
+    Repetitive warnings are rate limited by the listener, across all
+    processes.
+
+    Args:
+        loggers:              Loggers whose handlers are moved to the listener
+                              (Type: list[logging.Logger])
+
+    Kwargs:
+        rate_limit_interval:  Length of the rate limiting window (seconds). If
+                              None, records are not rate limited.
+                              (Type: float or None)
+
+        rate_limit_burst:     Number of repetitive warnings allowed per window
+                              (Type: int)
+
+        capture_warnings:     If True, warnings are logged and rate limited
+                              (Type: bool)
+
+    Returns:
+        listener:     Queue listener. It is stopped at exit, which writes the
+                      remaining records.
+                      (Type: RateLimitedQueueListener)
+
+        worker_args:  Arguments to init_queue_worker for worker processes
+                      (Type: tuple)
+    """
+    queue = multiprocessing.Queue(-1)
+
+    handlers = []
+    for logger in loggers:
+        for handler in logger.handlers:
+            if handler not in handlers:
+                handlers.append(handler)
+
+    if rate_limit_interval is not None:
+        rate_limit_filter = RateLimitFilter(interval=rate_limit_interval,
+                                            burst=rate_limit_burst)
+    else:
+        rate_limit_filter = None
+
+    listener = RateLimitedQueueListener(queue, *handlers,
+                                        rate_limit_filter=rate_limit_filter)
+    listener.start()
+    atexit.register(listener.stop)
+
+    # Avoid enqueuing records that no handler would write
+    level = min([handler.level for handler in handlers] or [logging.NOTSET])
+    worker_args = (queue, [logger.name for logger in loggers], level, capture_warnings)
+    init_queue_worker(*worker_args)
+
+    return listener, worker_args
@@ -7,9 +7,9 @@ import warnings
 import multiprocessing as mp
 import traceback
 import sys
-from data.avc.sample import get_max_abs_sample_value, write_to_h5
+from data.avc.audio_corpus import AudioCorpus
+from data.avc.sample import get_max_abs_sample_value, write_to_h5, read_audio
 from data.utils import read_csv_as_dicts
-import soundfile as sf
 from IPython.display import Audio
 import matplotlib.pyplot as plt
 
@@ -56,70 +56,246 @@ def sample_one_second(audio_data, sampling_frequency, start, augment=False):
 
     return audio_data, audio_aug_params
 
-def process_batch(*args):
-    if len(args) == 2:
-        batch_path, fname_to_path = args
-    elif len(args) == 1:
-        batch_path, fname_to_path = args[0]
+
+def print_flush(*args, **kwargs):
+    print(*args, **kwargs)
+    sys.stdout.flush()
+
+
+def read_batch_audio_metadata(batch_path):
+    with h5py.File(batch_path, 'r') as blob:
+        audio_files = [x.decode('utf8') for x in blob['audio_file']]
+        audio_start_sample_indices = np.array(blob['audio_start_sample_idx'], dtype=np.int64)
+    return audio_files, audio_start_sample_indices
+
+
+def build_inverted_index(batch_paths, pool=None):
+    """Build an index from each audio file to the batch entries that use it
+
+    Args:
+        batch_paths: list of batch file paths
+
+    Keyword Args:
+        pool: if provided, process pool used to read batch metadata
+
+    Returns:
+        fname_to_entries: dictionary mapping audio filenames to arrays of entry indices
+        entry_batch_idxs: batch index of each entry
+        entry_rows: row of each entry in its batch
+        entry_starts: audio start sample index of each entry
+    """
+    if not batch_paths:
+        empty = np.zeros((0,), dtype=np.int64)
+        return {}, empty, empty, empty
+
+    if pool is not None:
+        metadata_gen = pool.imap(read_batch_audio_metadata, batch_paths)
     else:
-        raise ValueError('Invalid number of arguments')
+        metadata_gen = map(read_batch_audio_metadata, batch_paths)
+
+    fname_ids = {}
+    entry_fname_ids = []
+    entry_batch_idxs = []
+    entry_rows = []
+    entry_starts = []
+    for batch_idx, (audio_files, starts) in enumerate(metadata_gen):
+        entry_fname_ids.append(np.array([fname_ids.setdefault(fname, len(fname_ids))
+                                         for fname in audio_files], dtype=np.int64))
+        entry_batch_idxs.append(np.full(len(audio_files), batch_idx, dtype=np.int64))
+        entry_rows.append(np.arange(len(audio_files), dtype=np.int64))
+        entry_starts.append(starts)
+
+    entry_fname_ids = np.concatenate(entry_fname_ids)
+    entry_batch_idxs = np.concatenate(entry_batch_idxs)
+    entry_rows = np.concatenate(entry_rows)
+    entry_starts = np.concatenate(entry_starts)
+
+    # Group entries by audio file
+    order = np.argsort(entry_fname_ids, kind='stable')
+    boundaries = np.searchsorted(entry_fname_ids[order], np.arange(len(fname_ids) + 1))
+    fname_to_entries = {fname: order[boundaries[fname_id]:boundaries[fname_id + 1]]
+                        for fname, fname_id in fname_ids.items()}
+
+    return fname_to_entries, entry_batch_idxs, entry_rows, entry_starts
+
+
+# Audio corpus used by recompute_file_audio, set once in each process by
+# init_worker rather than being sent with every task
+_AUDIO_CORPUS = None
+
+
+def init_worker(audio_corpus):
+    """Set the audio corpus that audio is read from in this process
+
+    Args:
+        audio_corpus: packed audio corpus, or None to decode audio files
+    """
+    global _AUDIO_CORPUS
+    _AUDIO_CORPUS = audio_corpus
+
+
+def recompute_file_audio(args):
+    """Decode an audio file once and recompute the audio of all of its entries
+
+    Args:
+        args: tuple of audio filename, audio path, entry indices and entry
+              start sample indices
 
+    Returns:
+        fname: audio filename
+        entry_idxs: entry indices
+        audio: recomputed (n_entries, n_samples) audio
+        audio_gain: recomputed audio gains
+    """
+    fname, audio_path, entry_idxs, starts = args
     try:
-        with h5py.File(batch_path, 'r+') as blob:
-            audio_files = [x.decode('utf8') for x in blob['audio_file']]
-            audio_start_sample_indices = [int(x) for x in blob['audio_start_sample_idx']]
-
-            audio = []
-            audio_gain = []
-            for fname, start_idx in zip(audio_files, audio_start_sample_indices):
-                audio_path = fname_to_path[fname]
-                audio_data, sampling_frequency = sf.read(audio_path,
-                                                         dtype='int16',
-                                                         always_2d=True)
-                audio_data = audio_data.mean(axis=-1).astype('int16')
-                audio_data, aug_params = sample_one_second(audio_data, 48000, start_idx, augment=True)
-                audio.append(audio_data)
-                gain = aug_params['gain']
-
-                if not (0.9 <= gain <= 1.1):
-                    err_msg = "File {} in batch {} has invalid audio gain {}"
-                    raise ValueError(err_msg.format(audio_path, batch_path, gain))
-
-                audio_gain.append(gain)
-
-            blob['audio'][:,:,:] = np.ascontiguousarray(np.vstack(audio)[:,None,:])
-            blob['audio_gain'][:] = np.array(audio_gain)
+        if _AUDIO_CORPUS is not None and fname in _AUDIO_CORPUS:
+            audio_data, _ = _AUDIO_CORPUS.get(fname)
+        else:
+            audio_data, _ = read_audio(audio_path)
+
+        audio = []
+        audio_gain = []
+        for start_idx in starts:
+            window, aug_params = sample_one_second(audio_data, 48000, int(start_idx), augment=True)
+            gain = aug_params['gain']
+            if not (0.9 <= gain <= 1.1):
+                err_msg = "File {} has invalid audio gain {}"
+                raise ValueError(err_msg.format(audio_path, gain))
+            audio.append(window)
+            audio_gain.append(gain)
     except Exception as e:
         print_flush(traceback.format_exc())
         print_flush()
         raise e
 
+    return fname, entry_idxs, np.vstack(audio), np.array(audio_gain)
 
 
-def print_flush(*args, **kwargs):
-    print(*args, **kwargs)
-    sys.stdout.flush()
+def read_journal(journal_path):
+    if not os.path.exists(journal_path):
+        return set()
+    with open(journal_path, 'r') as f:
+        return set(line.rstrip('\n') for line in f if line.endswith('\n'))
+
+
+def flush_results(results, batch_paths, entry_batch_idxs, entry_rows, journal_path):
+    """Scatter recomputed audio into the batch files, writing each batch once,
+    and record the completed audio files in the journal
+    """
+    entry_idxs = np.concatenate([r[1] for r in results])
+    audio = np.concatenate([r[2] for r in results])
+    audio_gain = np.concatenate([r[3] for r in results])
+
+    batch_idxs = entry_batch_idxs[entry_idxs]
+    order = np.lexsort((entry_rows[entry_idxs], batch_idxs))
+    boundaries = np.flatnonzero(np.diff(batch_idxs[order])) + 1
+    for group in np.split(order, boundaries):
+        batch_path = batch_paths[batch_idxs[group[0]]]
+        rows = entry_rows[entry_idxs[group]]
+        with h5py.File(batch_path, 'r+') as blob:
+            blob['audio'][rows, :, :] = audio[group][:, None, :]
+            blob['audio_gain'][rows] = audio_gain[group]
+
+    # Only mark files as done once their audio is written
+    with open(journal_path, 'a') as f:
+        for r in results:
+            f.write(r[0] + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
 
+def process_subset(subset_batch_dir, subset_path, n_jobs=1, verbose=0,
+                   audio_corpus_dir=None, journal_path=None, flush_size=10000,
+                   chunk_size=16):
+    """Recompute the audio of all batches in a directory, decoding each source
+    audio file only once
+
+    Args:
+        subset_batch_dir: directory containing batch files
+        subset_path: path to subset file
+
+    Keyword Args:
+        n_jobs: number of parallel jobs to run
+        verbose: print progress every this many audio files
+        audio_corpus_dir: if provided, path to packed audio corpus to read audio from
+        journal_path: path to journal of completed audio files, used to resume
+                      an interrupted run
+        flush_size: number of recomputed samples to buffer before writing them
+                    to the batch files
+        chunk_size: number of audio files sent to a job at a time
+    """
+    if not os.path.isdir(subset_batch_dir):
+        print_flush("Batch directory {} does not exist; Nothing to do".format(subset_batch_dir))
+        return
+
+    # Sort so that entry indices are the same when resuming
+    file_list = sorted(fname for fname in os.listdir(subset_batch_dir) if fname.endswith('.h5'))
+    if not file_list:
+        print_flush("No batch files in {}; Nothing to do".format(subset_batch_dir))
+        return
+    batch_paths = [os.path.join(subset_batch_dir, fname) for fname in file_list]
+
+    if audio_corpus_dir:
+        audio_corpus = AudioCorpus(audio_corpus_dir)
+    else:
+        audio_corpus = None
+
+    if journal_path is None:
+        journal_path = os.path.join(subset_batch_dir, 'recompute_audio_journal.txt')
 
-def process_subset(subset_batch_dir, subset_path, n_jobs=1, verbose=0):
     fname_to_path = {os.path.basename(x['audio_filepath']): x['audio_filepath'] for x in read_csv_as_dicts(subset_path)}
-    file_list = os.listdir(subset_batch_dir)
-    num_files = len(file_list)
 
+    init_worker(audio_corpus)
     if n_jobs > 1:
-        worker_args_gen = ((os.path.join(subset_batch_dir, fname), fname_to_path)
-                           for fname in file_list)
-        with mp.Pool(n_jobs) as pool:
-            for idx, res in enumerate(pool.imap_unordered(process_batch, worker_args_gen)):
-                if verbose > 0 and ((idx+1) % verbose == 0):
-                    print_flush("Processed {}/{}".format(idx+1, num_files))
+        pool = mp.Pool(n_jobs, initializer=init_worker, initargs=(audio_corpus,))
     else:
-        for idx, fname in enumerate(file_list):
-            process_batch(os.path.join(subset_batch_dir, fname), fname_to_path)
+        pool = None
+    try:
+        print_flush("Indexing {} batches".format(len(batch_paths)))
+        fname_to_entries, entry_batch_idxs, entry_rows, entry_starts \
+            = build_inverted_index(batch_paths, pool=pool)
+
+        done = read_journal(journal_path)
+        if done:
+            print_flush("Resuming, skipping {} completed audio files".format(len(done)))
+
+        tasks = []
+        for fname, entry_idxs in fname_to_entries.items():
+            if fname in done:
+                continue
+            if fname not in fname_to_path:
+                warnings.warn('Audio file {} is not in the subset; Skipping...'.format(fname))
+                continue
+            tasks.append((fname, fname_to_path[fname], entry_idxs,
+                          entry_starts[entry_idxs]))
+        num_files = len(tasks)
+
+        if pool is not None:
+            results_gen = pool.imap_unordered(recompute_file_audio, tasks, chunksize=chunk_size)
+        else:
+            results_gen = map(recompute_file_audio, tasks)
+
+        results = []
+        num_buffered = 0
+        for idx, res in enumerate(results_gen):
+            results.append(res)
+            num_buffered += len(res[1])
+            if num_buffered >= flush_size:
+                flush_results(results, batch_paths, entry_batch_idxs, entry_rows, journal_path)
+                results = []
+                num_buffered = 0
 
             if verbose > 0 and ((idx+1) % verbose == 0):
                 print_flush("Processed {}/{}".format(idx+1, num_files))
 
+        if results:
+            flush_results(results, batch_paths, entry_batch_idxs, entry_rows, journal_path)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Recompute batch audio')
@@ -127,5 +303,14 @@ if __name__ == '__main__':
     parser.add_argument('subset_path', type=str, help='Path to directory csv file')
     parser.add_argument('--n-jobs', type=int, default=1, help='Number of parallel jobs to run')
     parser.add_argument('--verbose', type=int, default=0, help='Verbosity level')
+    parser.add_argument('--audio-corpus-dir', type=str, default=None, help='Path to packed audio corpus to read audio from')
+    parser.add_argument('--journal-path', type=str, default=None,
+                        help='Path to journal of completed audio files, used to resume an interrupted run. '
+                             'By default, "recompute_audio_journal.txt" in the batch directory')
+    parser.add_argument('--flush-size', type=int, default=10000,
+                        help='Number of recomputed samples to buffer before writing them to the batch files')
+    parser.add_argument('--chunk-size', type=int, default=16, help='Number of audio files sent to a job at a time')
     args = parser.parse_args()
-    process_subset(args.batch_dir, args.subset_path, n_jobs=args.n_jobs, verbose=args.verbose)
+    process_subset(args.batch_dir, args.subset_path, n_jobs=args.n_jobs, verbose=args.verbose,
+                   audio_corpus_dir=args.audio_corpus_dir, journal_path=args.journal_path,
+                   flush_size=args.flush_size, chunk_size=args.chunk_size)